@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Peak RSS of ESAP2SAClass.get_file for different payload sizes.
+
+Each size is measured in a fresh interpreter so that the reported peak
+belongs to that download only. The payload is generated on the fly and
+written to os.devnull, so the benchmark needs neither network nor disk.
+
+Usage:
+    python benchmarks/bench_download_memory.py [size_in_bytes ...]
+"""
+import os
+import resource
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_SIZES = [10 * 1024 ** 2, 5 * 1024 ** 3]
+
+
+class GeneratedResponse(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.position = 0
+
+    def readinto(self, buffer):
+        read_bytes = min(len(buffer), self.size - self.position)
+        self.position = self.position + read_bytes
+        return read_bytes
+
+
+def run_single(size):
+    from esa_p2sa.p2sa_core import ESAP2SAClass
+    from esa_p2sa.tests.dummy_tap_handler import DummyTapHandler
+
+    p2sa = ESAP2SAClass(DummyTapHandler())
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    written = p2sa.get_file(os.devnull, response=GeneratedResponse(size))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("%d %d %d" % (written, baseline, peak))
+
+
+def main(sizes):
+    print("%15s %15s %15s %15s" % ("payload (B)", "written (B)", "RSS before (kB)", "RSS peak (kB)"))
+    for size in sizes:
+        output = subprocess.check_output([sys.executable, __file__, "--single", str(size)],
+                                         stderr=subprocess.DEVNULL)
+        written, baseline, peak = output.split()[-3:]
+        print("%15d %15s %15s %15s" % (size, written.decode(), baseline.decode(), peak.decode()))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--single":
+        run_single(int(sys.argv[2]))
+    else:
+        main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
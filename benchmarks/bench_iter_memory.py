@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Peak RSS of decoding a CSV result of p2sa.v_observation at once or in batches.
+
+The response is generated on the fly, row by row, so that only the decoding
+takes memory. 'table' reads the whole body and decodes it with
+parse_observations, 'batches' decodes it with iter_csv_batches while it is
+read, as iter_query and iter_p2sa_observations do. Each measure runs in a
+fresh interpreter.
+
+Usage:
+    python benchmarks/bench_iter_memory.py [rows [batch_size]]
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_ROWS = 2000000
+DEFAULT_BATCH_SIZE = 50000
+HEADER = b"observation_oid,instrument_name,observation_type,begin_date,end_date,processing_level,file_name," \
+         b"file_size,calibrated\n"
+ROW = "{0},SWAP,SCIENCE,2015-08-01 10:{1:02d}:00,2015-08-01 11:{1:02d}:00,LV1,swap_{0}.fits,{2},true\n"
+
+
+class GeneratedResponse(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.position = 0
+        self.pending = HEADER
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = sys.maxsize
+        # __end_if
+        pieces = [self.pending]
+        length = len(self.pending)
+        while length < size and self.position < self.rows:
+            piece = ROW.format(self.position, self.position % 60, 1000 + self.position % 5000).encode('ascii')
+            pieces.append(piece)
+            length = length + len(piece)
+            self.position = self.position + 1
+        # __end_while
+        data = b"".join(pieces)
+        self.pending = data[size:]
+        return data[:size]
+
+
+def run_single(mode, rows, batch_size):
+    from esa_p2sa.p2sa_parser import iter_csv_batches, parse_observations
+
+    response = GeneratedResponse(rows)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if mode == "table":
+        count = len(parse_observations(response.read(), 'csv'))
+    else:
+        count = sum(len(batch) for batch in iter_csv_batches(response, batch_size))
+    # __end_if
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("%d %d %d %.3f" % (count, baseline, peak, elapsed))
+
+
+def main(argv):
+    rows = int(argv[0]) if len(argv) > 0 else DEFAULT_ROWS
+    batch_size = int(argv[1]) if len(argv) > 1 else DEFAULT_BATCH_SIZE
+    print("{0} rows, batches of {1} rows".format(rows, batch_size))
+    print("%8s %10s %15s %15s %10s" % ("mode", "rows", "RSS before (kB)", "RSS peak (kB)", "seconds"))
+    for mode in ("table", "batches"):
+        output = subprocess.check_output([sys.executable, __file__, "--single", mode, str(rows), str(batch_size)],
+                                         stderr=subprocess.DEVNULL)
+        count, baseline, peak, elapsed = output.split()[-4:]
+        print("%8s %10s %15s %15s %10s" % (mode, count.decode(), baseline.decode(), peak.decode(), elapsed.decode()))
+    # __end_for
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--single":
+        run_single(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main(sys.argv[1:])
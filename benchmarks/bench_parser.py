@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Decoding time of p2sa.v_observation responses by format and parser.
+
+A synthetic result of the view is serialized as the TAP service sends it, in
+CSV, JSON and VOTable. Each response is decoded with the astropy readers used
+by astroquery, which leave dates as text, then converted to the types returned
+by esa_p2sa.p2sa_parser. CSV and JSON are also decoded with the parser itself.
+
+Usage:
+    python benchmarks/bench_parser.py [rows]
+"""
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_ROWS = 1000000
+REPEATS = 3
+
+
+def best_time(function):
+    duration = None
+    for attempt in range(REPEATS):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        duration = elapsed if duration is None else min(duration, elapsed)
+    return duration
+
+
+def read_astropy(body, output_format):
+    from astropy.table import Table
+    if output_format == 'json':
+        # astropy has no TAP JSON reader: the generic decoding is json plus a row-wise Table
+        import json
+        document = json.loads(body)
+        return Table(rows=document["data"], names=[column["name"] for column in document["metadata"]])
+    return Table.read(io.BytesIO(body), format='ascii.csv' if output_format == 'csv' else 'votable')
+
+
+def to_types(table):
+    """
+    Converts the dates and flags of a table read by astropy to the types of parse_observations
+    """
+    import numpy as np
+    for name in ('begin_date', 'end_date'):
+        table[name] = np.array(table[name].tolist(), dtype='datetime64[ms]')
+    table['calibrated'] = np.array(table['calibrated'].tolist()) == 'true'
+    return table
+
+
+def main(argv):
+    from esa_p2sa.p2sa_parser import parse_observations
+    from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+
+    rows = int(argv[0]) if len(argv) > 0 else DEFAULT_ROWS
+    observations = make_observations(rows)
+    print("{0} rows of p2sa.v_observation, best of {1}".format(rows, REPEATS))
+    print("{0:<8} {1:<22} {2:>10} {3:>10} {4:>12}".format("format", "parser", "MB", "seconds", "rows/s"))
+    for output_format in ('csv', 'json', 'votable'):
+        body = DummyTapServer.serialize(observations, output_format)
+        parsers = [("astropy", lambda: read_astropy(body, output_format)),
+                   ("astropy + types", lambda: to_types(read_astropy(body, output_format)))]
+        if output_format != 'votable':
+            parsers.append(("parse_observations", lambda: parse_observations(body, output_format)))
+            parsers.append(("  categorical", lambda: parse_observations(body, output_format, categorical=True)))
+        # __end_if
+        for label, parse in parsers:
+            duration = best_time(parse)
+            print("{0:<8} {1:<22} {2:>10.1f} {3:>10.3f} {4:>12.0f}".format(
+                output_format, label, len(body) / 1048576.0, duration, rows / duration))
+        # __end_for
+    # __end_for
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Requests per second of small downloads with and without the pooled transport.
+
+A local stand-in server answers postcard-sized payloads. The same requests are
+sent with one new connection per request (urllib, as before P2SATransport) and
+through a P2SATransport, sequentially and from a thread pool.
+
+Usage:
+    python benchmarks/bench_transport.py [requests] [payload_bytes]
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_REQUESTS = 2000
+DEFAULT_PAYLOAD = 20 * 1024
+WORKERS = 8
+
+
+def run(server, label, fetch, count, workers):
+    link = server.url + "p2sa-sl-tap/data?observation_oid=1"
+    server.reset_counters()
+    start = time.time()
+    if workers == 1:
+        for index in range(count):
+            fetch(link)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda index: fetch(link), range(count)))
+    duration = time.time() - start
+    print("{0:<28} {1:>10.0f} req/s {2:>8.3f} ms/req {3:>6d} connections".format(
+        label, count / duration, 1000.0 * duration / count, server.connections))
+
+
+def main(argv):
+    from esa_p2sa.p2sa_download import open_url
+    from esa_p2sa.p2sa_transport import P2SATransport
+    from esa_p2sa.tests.dummy_http_server import DummyHTTPServer
+
+    count = int(argv[0]) if len(argv) > 0 else DEFAULT_REQUESTS
+    payload = int(argv[1]) if len(argv) > 1 else DEFAULT_PAYLOAD
+
+    def fetch_urllib(link):
+        response = open_url(link)
+        response.read()
+        response.close()
+
+    transport = P2SATransport(max_connections_per_host=WORKERS)
+
+    def fetch_transport(link):
+        transport.get(link).read()
+
+    with DummyHTTPServer() as server:
+        server.set_payload(server.url + "p2sa-sl-tap/data?observation_oid=1", b"x" * payload)
+        print("{0} requests of {1} bytes".format(count, payload))
+        run(server, "urllib, sequential", fetch_urllib, count, 1)
+        run(server, "P2SATransport, sequential", fetch_transport, count, 1)
+        run(server, "urllib, %d threads" % WORKERS, fetch_urllib, count, WORKERS)
+        run(server, "P2SATransport, %d threads" % WORKERS, fetch_transport, count, WORKERS)
+    transport.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -30,11 +30,99 @@ class Conf(_config.ConfigNamespace):
                                        "Base url of P2SA TAP")
     SERVER_CONTEXT = _config.ConfigItem(TAP_CONTEXT,
                                        "Server context of P2SA TAP")
+    DOWNLOAD_CHUNK_SIZE = _config.ConfigItem(1048576,
+                                             "Size in bytes of the buffer used to stream downloads to disk")
+    DOWNLOAD_WORKERS = _config.ConfigItem(4,
+                                          "Number of concurrent downloads used by the bulk download methods")
+    PRODUCT_MAX_OIDS_PER_REQUEST = _config.ConfigItem(500,
+                                                      "Maximum number of file_oids requested in one product download")
+    PRODUCT_MAX_URL_LENGTH = _config.ConfigItem(4000,
+                                                "Maximum length of a product download url")
+    PRODUCT_CACHE_DIR = _config.ConfigItem("",
+                                           "Directory of the on-disk product cache. Empty disables the cache")
+    PRODUCT_CACHE_MAX_BYTES = _config.ConfigItem(10 * 1024 ** 3,
+                                                 "Maximum size in bytes of the on-disk product cache")
+    MOVIE_CACHE_DIR = _config.ConfigItem("",
+                                         "Directory of the on-disk Carrington movie cache. "
+                                         "Empty uses esa_p2sa/movies in the astropy cache directory")
+    MOVIE_CACHE_MAX_BYTES = _config.ConfigItem(2 * 1024 ** 3,
+                                               "Maximum size in bytes of the on-disk Carrington movie cache")
+    QUERY_CACHE_DIR = _config.ConfigItem("",
+                                         "Directory of the on-disk tier of the query result cache. "
+                                         "Empty disables the cache")
+    QUERY_CACHE_MAX_ENTRIES = _config.ConfigItem(128,
+                                                 "Number of query results kept in memory by the query cache")
+    QUERY_CACHE_TTL = _config.ConfigItem(24 * 3600.0,
+                                         "Seconds during which a query result is served from the query cache")
+    RANGE_CACHE_MAX_ROWS = _config.ConfigItem(1000000,
+                                              "Maximum number of observations kept in memory by the "
+                                              "time-range cache of query_p2sa_observations")
+    MIRROR_BATCH_ROWS = _config.ConfigItem(50000,
+                                           "Number of observations fetched per TAP query when synchronizing "
+                                           "a local mirror of p2sa.v_observation")
+    SCHEMA_CACHE_DIR = _config.ConfigItem("",
+                                          "Directory where the table and column catalog of the TAP service "
+                                          "is saved. Empty keeps it in memory only")
+    SCHEMA_CACHE_TTL = _config.ConfigItem(7 * 24 * 3600.0,
+                                          "Seconds during which the table and column catalog is used "
+                                          "without reloading it")
+    HTTP_MAX_CONNECTIONS_PER_HOST = _config.ConfigItem(10,
+                                                       "Maximum number of pooled connections open to a single host")
+    HTTP_MAX_HOSTS = _config.ConfigItem(10,
+                                        "Number of hosts whose connection pools are kept open")
+    HTTP_CONNECT_TIMEOUT = _config.ConfigItem(10.0,
+                                              "Seconds to wait for a connection to the server")
+    HTTP_READ_TIMEOUT = _config.ConfigItem(60.0,
+                                           "Seconds to wait for data from the server")
+    HTTP_POOL_TIMEOUT = _config.ConfigItem(60.0,
+                                           "Seconds a request waits for a free pooled connection when "
+                                           "HTTP_MAX_CONNECTIONS_PER_HOST connections are in use")
+    PARTITION_TARGET_ROWS = _config.ConfigItem(20000,
+                                               "Expected number of rows per window of a partitioned query")
+    PARTITION_WORKERS = _config.ConfigItem(4,
+                                           "Number of windows of a partitioned query executed at the same time")
+    PARTITION_MAX_WINDOWS = _config.ConfigItem(64,
+                                               "Maximum number of windows of a partitioned query")
+    QUERY_EXECUTION = _config.ConfigItem("auto",
+                                         "Default execution of query_p2sa_observations and query_p2sa_tap: "
+                                         "'auto' (chosen from a COUNT(*) query), 'sync', 'async' or 'partitioned'")
+    SYNC_MAX_ROWS = _config.ConfigItem(2000,
+                                       "Largest expected result, in rows, run as a synchronous TAP query in "
+                                       "'auto' execution. Synchronous queries return at most 2000 rows")
+    ASYNC_MAX_ROWS = _config.ConfigItem(200000,
+                                        "Largest expected result, in rows, run as one asynchronous TAP job in "
+                                        "'auto' execution. Larger observation queries are partitioned")
+    ITER_BATCH_SIZE = _config.ConfigItem(100000,
+                                         "Number of rows of each table yielded by iter_query and "
+                                         "iter_p2sa_observations")
+    TAP_JOB_WORKERS = _config.ConfigItem(8,
+                                         "Number of asynchronous TAP jobs followed and fetched at the same time "
+                                         "by a TapJobManager")
+    TAP_JOB_WAIT = _config.ConfigItem(30,
+                                      "Seconds the TAP service may hold a UWS WAIT request on a running job. "
+                                      "Must be lower than HTTP_READ_TIMEOUT")
+    TAP_JOB_POLL_INTERVAL = _config.ConfigItem(0.5,
+                                               "First pause, in seconds, between two polls of a job when the TAP "
+                                               "service answers before the job ends. It doubles on every poll")
+    TAP_JOB_MAX_POLL_INTERVAL = _config.ConfigItem(10.0,
+                                                   "Longest pause, in seconds, between two polls of a job")
+    TAP_JOB_TIMEOUT = _config.ConfigItem(3600.0,
+                                         "Seconds to wait for an asynchronous TAP job to end. 0 waits forever")
+    ASYNC_MAX_CONCURRENCY = _config.ConfigItem(16,
+                                               "Maximum number of requests in flight in an AsyncESAP2SA client")
     TIMEOUT = 60
 
 
 conf = Conf()
 
+from .p2sa_cache import ObservationRangeCache, ProductCache, QueryCache, SchemaCatalog
+from .p2sa_transport import P2SATransport
+from .p2sa_mirror import ObservationMirror
+from .p2sa_jobs import TapJobManager
+from .p2sa_parser import parse_observations
 from .p2sa_core import ESAP2SA, ESAP2SAClass
+from .p2sa_async import AsyncESAP2SA
 
-__all__ = ['ESAP2SA', 'ESAP2SAClass', 'Conf', 'conf']
+__all__ = ['ESAP2SA', 'ESAP2SAClass', 'AsyncESAP2SA', 'P2SATransport', 'ObservationMirror', 'ObservationRangeCache',
+           'ProductCache', 'QueryCache', 'SchemaCatalog', 'TapJobManager', 'parse_observations', 'Conf',
+           'conf']
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento Carrión
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+
+asyncio client for P2SA queries and downloads. It requires the aiohttp package.
+"""
+import asyncio
+import io
+import os
+import time
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+from astropy import log
+from astroquery.utils.tap.xmlparser import utils
+
+from . import conf
+from .p2sa_cache import ProductCache
+from .p2sa_core import DEFAULT_ORDER, ESAP2SAClass
+from .p2sa_download import PART_SUFFIX, DownloadResult
+
+__all__ = ['AsyncESAP2SA']
+
+
+class AsyncESAP2SA(object):
+    """
+    Awaitable version of the ESAP2SAClass query and download methods.
+
+    All the coroutines of a client share one pool of keep-alive connections and
+    at most ``max_concurrency`` requests are in flight at the same time. Every
+    coroutine can be cancelled: a cancelled download leaves no partial file.
+    The client must be used from a single event loop and closed at the end,
+    preferably with ``async with``.
+
+    In Jupyter, long downloads can run in the background of the kernel loop::
+
+        p2sa = AsyncESAP2SA()
+        task = asyncio.ensure_future(p2sa.get_p2sa_observations(obs_oids, out_dir="data"))
+
+    Parameters
+    ----------
+    client : ESAP2SAClass, optional, default None
+        synchronous client whose urls and product cache are used. If not
+        provided, a new ESAP2SAClass is created
+    max_concurrency : int, optional, default conf.ASYNC_MAX_CONCURRENCY
+        maximum number of requests in flight
+    max_connections_per_host : int, optional, default conf.HTTP_MAX_CONNECTIONS_PER_HOST
+        maximum number of open connections to a single host
+    connect_timeout : float, optional, default conf.HTTP_CONNECT_TIMEOUT
+        seconds to wait for a connection to be established
+    read_timeout : float, optional, default conf.HTTP_READ_TIMEOUT
+        seconds to wait for data from the server
+    """
+
+    def __init__(self, client=None, max_concurrency=None, max_connections_per_host=None, connect_timeout=None,
+                 read_timeout=None):
+        if aiohttp is None:
+            raise ImportError("AsyncESAP2SA requires the aiohttp package")
+        if client is None:
+            client = ESAP2SAClass()
+        if max_concurrency is None:
+            max_concurrency = conf.ASYNC_MAX_CONCURRENCY
+        if max_connections_per_host is None:
+            max_connections_per_host = conf.HTTP_MAX_CONNECTIONS_PER_HOST
+        if connect_timeout is None:
+            connect_timeout = conf.HTTP_CONNECT_TIMEOUT
+        if read_timeout is None:
+            read_timeout = conf.HTTP_READ_TIMEOUT
+        if int(max_concurrency) < 1:
+            raise ValueError("Value for parameter 'max_concurrency' must be positive")
+
+        self.client = client
+        self.max_concurrency = int(max_concurrency)
+        self.max_connections_per_host = int(max_connections_per_host)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """
+        Closes every pooled connection
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.max_connections_per_host)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout,
+                                            sock_read=self.read_timeout)
+            # Bodies are stored as sent: sizes refer to the raw bytes
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False,
+                                                  headers={"Accept-Encoding": "identity"})
+        return self._session
+
+    @staticmethod
+    def _check_response(response, link):
+        if response.status >= 400:
+            raise IOError("HTTP error {0} {1} for {2}".format(response.status, response.reason, link))
+
+    async def query_p2sa_tap(self, query, output_format='votable', use_cache=True, refresh_cache=False):
+        """
+        Runs a synchronous ADQL query on the P2SA TAP
+
+        Parameters
+        ----------
+        query : str, mandatory
+            query (adql) to be executed
+        output_format : str, optional, default 'votable'
+            results format
+        use_cache : bool, optional, default True
+            serve the result from the query cache of the client, if any, and store it there
+        refresh_cache : bool, optional, default False
+            run the query on the server even if its result is cached
+
+        Returns
+        -------
+        A table object. Errors are raised to the caller
+        """
+        loop = asyncio.get_running_loop()
+        cache = self.client.query_cache if use_cache else None
+        if cache is not None and not refresh_cache:
+            table = await loop.run_in_executor(None, cache.get, query, output_format)
+            if table is not None:
+                return table
+        # __end_if
+
+        link = self.client.metadata_url.rstrip("?")
+        data = {"REQUEST": "doQuery", "LANG": "ADQL", "FORMAT": output_format, "PHASE": "RUN", "QUERY": query}
+        try:
+            async with self._semaphore:
+                async with self._get_session().post(yarl.URL(link, encoded=True), data=data) as response:
+                    self._check_response(response, link)
+                    content = await response.read()
+        except aiohttp.ClientError as e:
+            raise IOError("Error requesting {0}: {1}".format(link, e)) from e
+        # __end_try
+
+        # Parsing large results takes a while: keep the event loop free
+        table = await loop.run_in_executor(None, utils.read_http_response, io.BytesIO(content), output_format)
+        if cache is not None:
+            await loop.run_in_executor(None, cache.put, query, output_format, table)
+        # __end_if
+        return table
+
+    # _end_of_query_p2sa_tap
+
+    async def query_p2sa_observations(self, instruments=None, from_date=None, to_date=None, output_format='csv',
+                                      columns=None, order_by=DEFAULT_ORDER, top=None, offset=None, **filters):
+        """
+        Queries p2sa.v_observation as ESAP2SAClass.query_p2sa_observations does.
+        columns, order_by, top, offset and the keyword filters (processing_level,
+        observation_type, wavelength_range, file_format, calibrated, min_file_size,
+        max_file_size) are the ones of ESAP2SAClass.query_p2sa_observations
+
+        Returns
+        -------
+        A table object. Errors are raised to the caller
+        """
+        query = ESAP2SAClass._build_observations_query(instruments, from_date, to_date,
+                                                       ESAP2SAClass._build_filter_conditions(filters),
+                                                       columns=columns, order_by=order_by, top=top, offset=offset)
+        log.info("Metadata Query: %s" % query)
+        return await self.query_p2sa_tap(query, output_format=output_format)
+
+    # _end_of_query_p2sa_observations
+
+    async def get_p2sa_postcard(self, observation_oid, filename=None, resolution="low", retrieval_type="PRODUCT",
+                                product_type="POSTCARD", data_retrieval_origin="P2SAPY"):
+        """
+        Downloads the postcard of an observation
+
+        Returns
+        -------
+        Name of the downloaded file. Errors are raised to the caller
+        """
+        observation_oid = str(observation_oid)
+        link = self.client._build_postcard_link(observation_oid, resolution, retrieval_type, product_type,
+                                                data_retrieval_origin)
+        if filename is None:
+            filename = "postcard_" + observation_oid + ".jpg"
+        # __end_if
+        cache_key = ProductCache.key(retrieval_type, observation_oid, product_type, resolution)
+        await self._download_to_file(link, filename, cache_key=cache_key)
+        return filename
+
+    # _end_of_get_p2sa_postcard
+
+    async def get_p2sa_observation(self, obs_oid, filename=None, product_type='OBSERVATION',
+                                   retrieval_type='PRODUCT', data_retrieval_origin='P2SAPY', chunk_size=None):
+        """
+        Downloads the tar archive of an observation
+
+        Parameters
+        ----------
+        obs_oid : str, mandatory
+            observation_oid of the observation
+        filename : str, optional, default obs_oid
+            name of the archive, '.tar' is appended
+
+        Returns
+        -------
+        Name of the downloaded file. Errors are raised to the caller
+        """
+        obs_oid = str(obs_oid)
+        link = self.client._build_observation_link(obs_oid, retrieval_type, product_type, data_retrieval_origin)
+        output_file_name = (obs_oid if filename is None else filename) + ".tar"
+        cache_key = ProductCache.key(retrieval_type, obs_oid, product_type)
+        await self._download_to_file(link, output_file_name, chunk_size, cache_key)
+        return output_file_name
+
+    # _end_of_get_p2sa_observation
+
+    async def get_p2sa_observations(self, obs_oids, out_dir=None, product_type='OBSERVATION',
+                                    retrieval_type='PRODUCT', data_retrieval_origin='P2SAPY', chunk_size=None):
+        """
+        Downloads many observations concurrently, see ESAP2SAClass.get_p2sa_observations
+
+        Returns
+        -------
+        List of DownloadResult(oid, path, bytes, duration, error) in the order of obs_oids
+        """
+        if obs_oids is None:
+            raise ValueError("Value for mandatory parameter 'obs_oids' is missed")
+        if out_dir is None:
+            out_dir = os.curdir
+        elif not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        # __end_if
+
+        async def download(obs_oid):
+            obs_oid = str(obs_oid)
+            output_file_name = os.path.join(out_dir, obs_oid + ".tar")
+            start = time.time()
+            try:
+                link = self.client._build_observation_link(obs_oid, retrieval_type, product_type,
+                                                           data_retrieval_origin)
+                cache_key = ProductCache.key(retrieval_type, obs_oid, product_type)
+                written_bytes = await self._download_to_file(link, output_file_name, chunk_size, cache_key)
+            except Exception as e:
+                log.error("[get_p2sa_observations()] Observation {0} failed: {1}".format(obs_oid, e))
+                return DownloadResult(obs_oid, None, 0, time.time() - start, e)
+            # __end_try
+            return DownloadResult(obs_oid, output_file_name, written_bytes, time.time() - start, None)
+
+        return list(await asyncio.gather(*[download(obs_oid) for obs_oid in obs_oids]))
+
+    # _end_of_get_p2sa_observations
+
+    async def get_p2sa_product(self, file_oid_list, filename=None, retrieval_type='PRODUCT',
+                               data_retrieval_origin='P2SAPY', chunk_size=None):
+        """
+        Downloads the files of file_oid_list, see ESAP2SAClass.get_p2sa_product
+
+        Returns
+        -------
+        Manifest of the downloaded archives: a list of DownloadResult(oid, path, bytes,
+        duration, error), one per request
+        """
+        chunks = self.client._build_product_links(file_oid_list, retrieval_type, data_retrieval_origin)
+
+        async def download(index):
+            selected_oids, link = chunks[index]
+            output_file_name = ESAP2SAClass._get_product_filename(filename, selected_oids, index, len(chunks))
+            start = time.time()
+            try:
+                cache_key = ProductCache.key(retrieval_type, selected_oids)
+                written_bytes = await self._download_to_file(link, output_file_name, chunk_size, cache_key)
+            except Exception as e:
+                log.error("[get_p2sa_product()] Archive {0} failed: {1}".format(output_file_name, e))
+                return DownloadResult(selected_oids, None, 0, time.time() - start, e)
+            # __end_try
+            return DownloadResult(selected_oids, output_file_name, written_bytes, time.time() - start, None)
+
+        return list(await asyncio.gather(*[download(index) for index in range(len(chunks))]))
+
+    # _end_of_get_p2sa_product
+
+    async def _download_to_file(self, link, filename, chunk_size=None, cache_key=None):
+        """
+        Streams the product behind link into filename through a temporary '.part'
+        file, which is removed if the download fails or is cancelled. Disk and
+        cache operations run in the default executor
+
+        Returns
+        -------
+        Number of bytes written to filename
+        """
+        loop = asyncio.get_running_loop()
+        cache = self.client.product_cache
+        if cache is not None and cache_key is not None:
+            if await loop.run_in_executor(None, cache.get, cache_key, filename):
+                return os.path.getsize(filename)
+        # __end_if
+        if chunk_size is None:
+            chunk_size = conf.DOWNLOAD_CHUNK_SIZE
+        # __end_if
+
+        part_file = filename + PART_SUFFIX
+        written_bytes = 0
+        try:
+            async with self._semaphore:
+                # Links are sent exactly as built, without re-quoting
+                async with self._get_session().get(yarl.URL(link, encoded=True)) as response:
+                    self._check_response(response, link)
+                    fh = await loop.run_in_executor(None, open, part_file, 'wb')
+                    try:
+                        async for data in response.content.iter_chunked(int(chunk_size)):
+                            await loop.run_in_executor(None, fh.write, data)
+                            written_bytes = written_bytes + len(data)
+                    finally:
+                        await loop.run_in_executor(None, fh.close)
+                    # __end_try
+            os.replace(part_file, filename)
+        except aiohttp.ClientError as e:
+            raise IOError("Error requesting {0}: {1}".format(link, e)) from e
+        finally:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+        # __end_try
+        log.info("File {0} downloaded".format(filename))
+
+        if cache is not None and cache_key is not None:
+            await loop.run_in_executor(None, cache.put, cache_key, filename)
+        # __end_if
+        return written_bytes
+
+    # __end_of_download_to_file
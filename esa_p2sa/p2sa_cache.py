@@ -0,0 +1,817 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento Carrión
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+
+Local caches used by ESAP2SAClass to avoid downloading the same data twice.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+from astropy import log
+from astropy.table import MaskedColumn, Table, vstack
+from astroquery.utils.tap.model.tapcolumn import TapColumn
+from astroquery.utils.tap.model.taptable import TapTableMeta
+
+from . import conf
+
+__all__ = ['ObservationRangeCache', 'ProductCache', 'QueryCache', 'SchemaCatalog']
+
+LOCK_FILE_NAME = ".lock"
+TMP_PREFIX = ".tmp-"
+# Temporary files older than this belong to a crashed process and can be removed
+STALE_TMP_SECONDS = 24 * 3600
+QUERY_SUFFIX = ".ecsv.gz"
+# Names of the masked columns of a stored table, ECSV only keeps masks with masked values
+MASKED_COLUMNS_KEY = "p2sa_masked_columns"
+# Layout of the persisted schema catalogs, files with another version are ignored
+SCHEMA_FORMAT_VERSION = 1
+
+
+class _FileLock(object):
+    """
+    Exclusive lock on a file, shared by all the processes that use the same cache
+    directory, including processes on other hosts when the filesystem supports it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = None
+
+    def __enter__(self):
+        self.fh = open(self.path, 'a+b')
+        if fcntl is not None:
+            fcntl.flock(self.fh.fileno(), fcntl.LOCK_EX)
+        else:
+            self.fh.seek(0)
+            msvcrt.locking(self.fh.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            fcntl.flock(self.fh.fileno(), fcntl.LOCK_UN)
+        else:
+            self.fh.seek(0)
+            msvcrt.locking(self.fh.fileno(), msvcrt.LK_UNLCK, 1)
+        self.fh.close()
+        self.fh = None
+
+
+class ProductCache(object):
+    """
+    Size-bounded on-disk cache of downloaded P2SA products.
+
+    Every entry is a file named after the hash of its key. The modification time of
+    the entry is its last access time: it is refreshed on every hit and the oldest
+    entries are evicted first once the cache grows over ``max_bytes``. Entries are
+    written to a temporary file and renamed into place, and insertions and
+    evictions run under a lock file, so several processes can share the directory.
+
+    Parameters
+    ----------
+    directory : str, optional, default conf.PRODUCT_CACHE_DIR
+        directory where the products are stored. It is created if needed
+    max_bytes : int, optional, default conf.PRODUCT_CACHE_MAX_BYTES
+        maximum total size of the cached products
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        if directory is None or directory == "":
+            directory = conf.PRODUCT_CACHE_DIR
+        if directory is None or directory == "":
+            raise ValueError("Value for mandatory parameter 'directory' is missed")
+        if max_bytes is None:
+            max_bytes = conf.PRODUCT_CACHE_MAX_BYTES
+        if int(max_bytes) < 0:
+            raise ValueError("Value for parameter 'max_bytes' must not be negative")
+
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_bytes = int(max_bytes)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = os.path.join(self.directory, LOCK_FILE_NAME)
+
+    @staticmethod
+    def key(retrieval_type, oid, product_type=None, resolution=None):
+        """
+        Builds the cache key of a request
+
+        Returns
+        -------
+        Hexadecimal digest identifying the request
+        """
+        parts = [retrieval_type, oid, product_type, resolution]
+        text = "|".join("" if part is None else str(part).upper() for part in parts)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """
+        Returns the path of the entry stored under key, whether it exists or not
+        """
+        return os.path.join(self.directory, key)
+
+    def get(self, key, filename):
+        """
+        Copies the entry stored under key to filename
+
+        Returns
+        -------
+        True on a cache hit, False otherwise
+        """
+        entry = self.path(key)
+        try:
+            # Refresh the last access time first so that a concurrent eviction keeps it
+            os.utime(entry, None)
+            shutil.copyfile(entry, filename)
+        except (IOError, OSError):
+            return False
+        log.info("File {0} served from the product cache".format(filename))
+        return True
+
+    def put(self, key, filename):
+        """
+        Stores a copy of filename under key and evicts the least recently used
+        entries if the cache is over its size limit
+        """
+        if os.path.getsize(filename) > self.max_bytes:
+            log.info("File {0} is larger than the product cache, not cached".format(filename))
+            return
+        fd, tmp_file = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fh, open(filename, 'rb') as src:
+                shutil.copyfileobj(src, fh, conf.DOWNLOAD_CHUNK_SIZE)
+            with _FileLock(self._lock_file):
+                os.replace(tmp_file, self.path(key))
+                self._evict()
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+    def size(self):
+        """
+        Returns the total size in bytes of the cached products
+        """
+        return sum(size for name, size, atime in self._entries())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes
+        """
+        with _FileLock(self._lock_file):
+            self._evict()
+
+    def clear(self):
+        """
+        Removes every entry of the cache
+        """
+        with _FileLock(self._lock_file):
+            for name, size, atime in self._entries():
+                self._remove(name)
+
+    def _entries(self):
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith(TMP_PREFIX):
+                if now - stat.st_mtime > STALE_TMP_SECONDS:
+                    self._remove(name)
+                continue
+            if name.startswith("."):
+                continue
+            entries.append((name, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(entry[1] for entry in entries)
+        for name, size, atime in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(name)
+            total = total - size
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+
+class QueryCache(object):
+    """
+    Two-tier cache of ADQL query results.
+
+    The first tier keeps the ``max_entries`` most recently used tables in memory.
+    The second tier stores every table on disk as gzip-compressed ECSV, which
+    keeps column types, units and masks, so results survive the session. Entries
+    of both tiers expire ``ttl`` seconds after the query was run.
+
+    Results are stored under the normalized query text, the output format and the
+    row limit of the job, such as the TOP added to synchronous jobs, so that a
+    capped result is never served for an uncapped query.
+    Tables are copied in and out of the cache, so callers may modify them.
+    Hits and misses are counted in ``memory_hits``, ``disk_hits`` and ``misses``.
+
+    Parameters
+    ----------
+    directory : str, optional, default conf.QUERY_CACHE_DIR
+        directory of the on-disk tier. It is created if needed
+    max_entries : int, optional, default conf.QUERY_CACHE_MAX_ENTRIES
+        number of tables kept in memory. 0 disables the memory tier
+    ttl : float, optional, default conf.QUERY_CACHE_TTL
+        seconds during which a result is served from the cache
+    """
+
+    def __init__(self, directory=None, max_entries=None, ttl=None):
+        if directory is None or directory == "":
+            directory = conf.QUERY_CACHE_DIR
+        if directory is None or directory == "":
+            raise ValueError("Value for mandatory parameter 'directory' is missed")
+        if max_entries is None:
+            max_entries = conf.QUERY_CACHE_MAX_ENTRIES
+        if ttl is None:
+            ttl = conf.QUERY_CACHE_TTL
+        if int(max_entries) < 0:
+            raise ValueError("Value for parameter 'max_entries' must not be negative")
+        if float(ttl) <= 0:
+            raise ValueError("Value for parameter 'ttl' must be positive")
+
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_entries = int(max_entries)
+        self.ttl = float(ttl)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # The memory tier and the counters stay in the process that filled them
+        return {'directory': self.directory, 'max_entries': self.max_entries, 'ttl': self.ttl}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def normalize(query):
+        """
+        Returns the text of query with runs of white space outside string
+        literals collapsed and without a trailing semicolon
+        """
+        parts = re.split(r"('(?:[^']|'')*')", query.strip().rstrip(";").strip())
+        return "".join(part if index % 2 else re.sub(r"\s+", " ", part)
+                       for index, part in enumerate(parts))
+
+    @classmethod
+    def key(cls, query, output_format, row_limit=None):
+        """
+        Builds the cache key of a query
+
+        Returns
+        -------
+        Hexadecimal digest identifying the query, its output format and its row limit
+        """
+        text = cls.normalize(query) + "|" + str(output_format).lower()
+        if row_limit is not None:
+            text = text + "|" + str(int(row_limit))
+        # __end_if
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """
+        Returns the path of the on-disk entry stored under key, whether it exists or not
+        """
+        return os.path.join(self.directory, key + QUERY_SUFFIX)
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    def stats(self):
+        """
+        Returns the hit and miss counters and the number of tables held in memory
+        """
+        with self._lock:
+            return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'memory_entries': len(self._memory)}
+
+    def reset_stats(self):
+        with self._lock:
+            self.memory_hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+
+    def get(self, query, output_format, row_limit=None):
+        """
+        Looks up the result of query, run with row_limit
+
+        Returns
+        -------
+        A copy of the cached table, or None on a miss
+        """
+        key = self.key(query, output_format, row_limit)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits = self.memory_hits + 1
+                return entry[1].copy()
+            # __end_if
+            self._memory.pop(key, None)
+        # __end_with
+
+        table = None
+        try:
+            created = os.path.getmtime(self.path(key))
+            if now - created < self.ttl:
+                table = self._read(self.path(key))
+            else:
+                self._remove(key)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(self.path(key)):
+                log.warning("Query cache entry {0} cannot be read and is discarded: {1}".format(key, e))
+                self._remove(key)
+        # __end_try
+
+        with self._lock:
+            if table is None:
+                self.misses = self.misses + 1
+                return None
+            # __end_if
+            self.disk_hits = self.disk_hits + 1
+            self._remember(key, created, table)
+        # __end_with
+        return table.copy()
+
+    def put(self, query, output_format, table, row_limit=None):
+        """
+        Stores a copy of table as the result of query, run with row_limit, in both tiers
+        """
+        key = self.key(query, output_format, row_limit)
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, table.copy())
+        # __end_with
+        fd, tmp_file = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.directory)
+        os.close(fd)
+        try:
+            self._write(table, tmp_file)
+            os.replace(tmp_file, self.path(key))
+        except Exception as e:
+            # The memory tier still holds the result
+            log.warning("Query result cannot be stored in {0}: {1}".format(self.directory, e))
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        # __end_try
+
+    def invalidate(self, query, output_format, row_limit=None):
+        """
+        Removes the result of query, run with row_limit, from both tiers
+        """
+        key = self.key(query, output_format, row_limit)
+        with self._lock:
+            self._memory.pop(key, None)
+        self._remove(key)
+
+    def prune(self):
+        """
+        Removes the expired entries of both tiers
+        """
+        now = time.time()
+        with self._lock:
+            for key in [key for key, entry in self._memory.items() if now - entry[0] >= self.ttl]:
+                del self._memory[key]
+        # __end_with
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+            if (name.endswith(QUERY_SUFFIX) and age >= self.ttl) or \
+                    (name.startswith(TMP_PREFIX) and age > STALE_TMP_SECONDS):
+                self._remove_file(path)
+        # __end_for
+
+    def clear(self):
+        """
+        Removes every entry of both tiers
+        """
+        with self._lock:
+            self._memory.clear()
+        for name in os.listdir(self.directory):
+            if name.endswith(QUERY_SUFFIX):
+                self._remove_file(os.path.join(self.directory, name))
+
+    def _remember(self, key, created, table):
+        # Called with the lock held
+        if self.max_entries == 0:
+            return
+        self._memory[key] = (created, table)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    @staticmethod
+    def _write(table, filename):
+        table = table.copy(copy_data=False)
+        table.meta[MASKED_COLUMNS_KEY] = [column.name for column in table.itercols()
+                                          if isinstance(column, MaskedColumn)]
+        with gzip.open(filename, 'wt', encoding='utf-8', compresslevel=1) as fh:
+            table.write(fh, format='ascii.ecsv')
+
+    @staticmethod
+    def _read(filename):
+        with gzip.open(filename, 'rt', encoding='utf-8') as fh:
+            table = Table.read(fh.read(), format='ascii.ecsv')
+        for name in table.meta.pop(MASKED_COLUMNS_KEY, []):
+            if not isinstance(table[name], MaskedColumn):
+                table[name] = MaskedColumn(table[name], copy=False)
+        return table
+
+    def _remove(self, key):
+        self._remove_file(self.path(key))
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ObservationRangeCache(object):
+    """
+    In-memory cache of the observations returned by query_p2sa_observations,
+    aware of the time ranges already fetched.
+
+    For every instrument set and column set it keeps the observations fetched
+    so far and the time intervals they cover. ``missing`` returns the parts of a
+    new time range that are not covered yet, ``add`` stores the observations of
+    a fetched gap and ``select`` answers a covered range from memory with the
+    rows and the order (begin_date, then observation_oid) of a fresh query.
+    Observations overlapping several fetched ranges are stored once.
+
+    Open ends of a range (no from_date or no to_date) are represented by
+    ``START`` and ``END``. When the cache holds more than ``max_rows`` rows, the
+    least recently used instrument and column sets are dropped.
+
+    Parameters
+    ----------
+    max_rows : int, optional, default conf.RANGE_CACHE_MAX_ROWS
+        maximum number of observations kept in memory
+    """
+
+    START = np.datetime64('0001-01-01T00:00:00', 'ms')
+    END = np.datetime64('9999-12-31T23:59:59', 'ms')
+
+    def __init__(self, max_rows=None):
+        if max_rows is None:
+            max_rows = conf.RANGE_CACHE_MAX_ROWS
+        if int(max_rows) < 0:
+            raise ValueError("Value for parameter 'max_rows' must not be negative")
+        self.max_rows = int(max_rows)
+        # key => [covered intervals, table of observations]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.served_ranges = 0
+        self.fetched_gaps = 0
+
+    def __getstate__(self):
+        return {'max_rows': self.max_rows}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def key(instruments, columns, conditions=()):
+        """
+        Builds the key of a set of instruments, a set of columns and the extra
+        conditions of the WHERE clause
+        """
+        instruments = tuple(sorted(set(str(instrument).upper() for instrument in (instruments or ()))))
+        return instruments, tuple(columns), tuple(sorted(conditions or ()))
+
+    @classmethod
+    def to_datetime(cls, date, start=True):
+        """
+        Converts a date of query_p2sa_observations into numpy.datetime64[ms].
+        Missing dates are the open START or END of the range
+        """
+        if date is None or date == "":
+            return cls.START if start else cls.END
+        return np.datetime64(str(date).strip().rstrip("Z"), 'ms')
+
+    @classmethod
+    def to_text(cls, date):
+        """
+        Formats a date for an ADQL query, '' for the open START or END
+        """
+        if date == cls.START or date == cls.END:
+            return ""
+        seconds = date.astype('datetime64[s]')
+        return str(seconds if seconds == date else date).replace("T", " ")
+
+    def missing(self, key, start, end):
+        """
+        Returns the list of (start, end) intervals of [start, end) not covered yet
+        """
+        with self._lock:
+            covered = list(self._entries[key][0]) if key in self._entries else []
+        # __end_with
+        gaps = []
+        position = start
+        for covered_start, covered_end in covered:
+            if covered_end <= position:
+                continue
+            if covered_start >= end:
+                break
+            if covered_start > position:
+                gaps.append((position, covered_start))
+            position = max(position, covered_end)
+        # __end_for
+        if position < end:
+            gaps.append((position, end))
+        return gaps
+
+    def add(self, key, start, end, table):
+        """
+        Stores the observations fetched for [start, end) and marks it as covered.
+        table must hold every observation ending at or after start and beginning
+        before end
+        """
+        with self._lock:
+            covered, rows = self._entries.pop(key, ([], None))
+            if rows is None:
+                rows = table
+            elif len(table) > 0:
+                new = ~np.isin(np.asarray(table['observation_oid']), np.asarray(rows['observation_oid']))
+                if new.any():
+                    rows = vstack([rows, table[new]], join_type='exact', metadata_conflicts='silent')
+            # __end_if
+            order = np.lexsort((np.asarray(rows['observation_oid']), self.to_datetimes(rows['begin_date'])))
+            rows = rows[order]
+            self._entries[key] = (self._merge(covered + [(start, end)]), rows)
+            self.fetched_gaps = self.fetched_gaps + 1
+            self._evict(key)
+        # __end_with
+
+    def select(self, key, start, end):
+        """
+        Returns the cached observations ending after start and beginning before end,
+        sorted by begin_date. [start, end) must be covered
+        """
+        with self._lock:
+            covered, rows = self._entries[key]
+            self._entries.move_to_end(key)
+            self.served_ranges = self.served_ranges + 1
+        # __end_with
+        mask = (self.to_datetimes(rows['end_date']) > start) & (self.to_datetimes(rows['begin_date']) < end)
+        return rows[mask]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def rows(self):
+        """
+        Returns the number of observations held in memory
+        """
+        with self._lock:
+            return sum(len(entry[1]) for entry in self._entries.values())
+
+    @staticmethod
+    def to_datetimes(column):
+        """
+        Converts a column of dates returned by the TAP into numpy.datetime64[ms]
+        """
+        return np.char.rstrip(np.char.strip(np.asarray(column).astype(str)), "Z").astype('datetime64[ms]')
+
+    @staticmethod
+    def _merge(intervals):
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def _evict(self, current):
+        # Called with the lock held, the entry just updated is kept
+        total = sum(len(entry[1]) for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.max_rows:
+                break
+            if key != current:
+                total = total - len(self._entries.pop(key)[1])
+
+
+class SchemaCatalog(object):
+    """
+    Catalog of the tables and columns published by TAP services.
+
+    The table metadata of a service is loaded once and indexed by table name,
+    so later lookups do not go back to the server. Table names alone are
+    cached separately from the full metadata, which is only loaded when
+    columns are needed. The catalog is reloaded once it is older than ``ttl``.
+
+    With a ``directory``, catalogs are also saved to disk, one JSON file per
+    service, and used by later sessions. Files written by another version of
+    the catalog or for another service url are ignored.
+
+    Tables and columns are astroquery TapTableMeta and TapColumn objects
+    shared by every caller: they must not be modified.
+
+    Parameters
+    ----------
+    directory : str, optional, default conf.SCHEMA_CACHE_DIR
+        directory where the catalogs are saved. Empty keeps them in memory only
+    ttl : float, optional, default conf.SCHEMA_CACHE_TTL
+        seconds during which a catalog is used without reloading it
+    """
+
+    def __init__(self, directory=None, ttl=None):
+        if directory is None:
+            directory = conf.SCHEMA_CACHE_DIR
+        if ttl is None:
+            ttl = conf.SCHEMA_CACHE_TTL
+        if float(ttl) <= 0:
+            raise ValueError("Value for parameter 'ttl' must be positive")
+
+        self.directory = os.path.abspath(os.path.expanduser(directory)) if directory else ""
+        self.ttl = float(ttl)
+        if self.directory and not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        # (url, only_names) => (loading time, {table name: TapTableMeta})
+        self._catalogs = {}
+        self._lock = threading.RLock()
+        self.loads = 0
+
+    def __getstate__(self):
+        return {'directory': self.directory, 'ttl': self.ttl}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def path(self, url, only_names=False):
+        """
+        Returns the file where the catalog of url is saved, None without directory
+        """
+        if not self.directory:
+            return None
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.directory, "schema-" + digest + ("-names" if only_names else "") + ".json")
+
+    def tables(self, url, load, only_names=False, refresh=False):
+        """
+        Returns the tables of the service at url
+
+        Parameters
+        ----------
+        url : str, mandatory
+            url of the TAP service, used as key of its catalog
+        load : callable, mandatory
+            load(only_names) returns the list of TapTableMeta of the service
+        only_names : bool, optional, default False
+            the tables may come without their columns
+        refresh : bool, optional, default False
+            reload the catalog from the service
+
+        Returns
+        -------
+        A list of TapTableMeta
+        """
+        return list(self._get(url, load, only_names, refresh).values())
+
+    def table(self, url, name, load, refresh=False):
+        """
+        Returns the table of the service at url called name, with its columns.
+        Names are compared exactly, then ignoring case, then without schema
+
+        Returns
+        -------
+        A TapTableMeta, or None if the service has no such table
+        """
+        tables = self._get(url, load, False, refresh)
+        table = tables.get(str(name))
+        if table is None:
+            lower_name = str(name).lower()
+            matches = [candidate for key, candidate in tables.items() if key.lower() == lower_name]
+            if not matches:
+                matches = [candidate for key, candidate in tables.items()
+                           if key.lower().rsplit(".", 1)[-1] == lower_name]
+            table = matches[0] if len(matches) == 1 else None
+        # __end_if
+        return table
+
+    def clear(self):
+        """
+        Forgets every catalog, in memory and on disk
+        """
+        with self._lock:
+            self._catalogs.clear()
+            if self.directory:
+                for name in os.listdir(self.directory):
+                    if name.startswith("schema-") and name.endswith(".json"):
+                        QueryCache._remove_file(os.path.join(self.directory, name))
+            # __end_if
+        # __end_with
+
+    def _get(self, url, load, only_names, refresh):
+        now = time.time()
+        with self._lock:
+            if not refresh:
+                # The full catalog also answers requests of names
+                for key in ((url, False), (url, True)) if only_names else ((url, False),):
+                    entry = self._catalogs.get(key)
+                    if entry is None:
+                        entry = self._read(url, key[1])
+                        if entry is not None:
+                            self._catalogs[key] = entry
+                    # __end_if
+                    if entry is not None and now - entry[0] < self.ttl:
+                        return entry[1]
+                # __end_for
+            # __end_if
+
+            tables = OrderedDict((str(table.name), table) for table in load(only_names))
+            self.loads = self.loads + 1
+            self._catalogs[(url, only_names)] = (now, tables)
+            self._write(url, only_names, now, tables)
+            return tables
+        # __end_with
+
+    def _read(self, url, only_names):
+        path = self.path(url, only_names)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as fh:
+                content = json.load(fh)
+            if content.get("version") != SCHEMA_FORMAT_VERSION or content.get("url") != url:
+                return None
+            tables = OrderedDict()
+            for description in content["tables"]:
+                table = TapTableMeta()
+                for column_description in description.pop("columns"):
+                    column = TapColumn(column_description.pop("flags"))
+                    column.__dict__.update(column_description)
+                    table.add_column(column)
+                table.__dict__.update(description)
+                tables[str(table.name)] = table
+            return content["loaded_at"], tables
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("Schema catalog {0} cannot be read and is ignored: {1}".format(path, e))
+            return None
+        # __end_try
+
+    def _write(self, url, only_names, loaded_at, tables):
+        path = self.path(url, only_names)
+        if path is None:
+            return
+        descriptions = []
+        for table in tables.values():
+            description = dict((key, value) for key, value in vars(table).items() if key != "columns")
+            description["columns"] = [dict(vars(column)) for column in table.columns]
+            descriptions.append(description)
+        # __end_for
+        content = {"version": SCHEMA_FORMAT_VERSION, "url": url, "loaded_at": loaded_at, "tables": descriptions}
+        fd, tmp_file = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(content, fh, default=str)
+            os.replace(tmp_file, path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            log.warning("Schema catalog cannot be saved in {0}: {1}".format(path, e))
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        # __end_try
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento Carrión
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+
+Conversion between dates and Carrington rotation numbers.
+"""
+import numpy as np
+
+__all__ = ['carrington_rotation_to_date', 'date_to_carrington_rotation']
+
+# Start of Carrington rotation 1 (1853-11-09 17:27 UT) as Julian Date
+CARRINGTON_EPOCH_JD = 2398140.2270
+# Mean synodic rotation period of the Sun, in days
+SYNODIC_PERIOD = 27.2752316
+UNIX_EPOCH_JD = 2440587.5
+SECONDS_PER_DAY = 86400.0
+
+
+def date_to_carrington_rotation(dates):
+    """
+    Converts dates to (fractional) Carrington rotation numbers.
+
+    The integer part is the rotation in progress at that date. Mean rotation
+    periods are used, so values are accurate to a few hours, which is enough
+    to select the P2SA Carrington movies.
+
+    Parameters
+    ----------
+    dates: string, datetime or array-like of them
+        dates in UTC, anything accepted by numpy.datetime64
+
+    Returns
+    -------
+    numpy array of floats (a float for scalar input)
+    """
+    values = np.asarray(dates, dtype='datetime64[ms]')
+    seconds = values.astype('int64') / 1000.0
+    julian_dates = seconds / SECONDS_PER_DAY + UNIX_EPOCH_JD
+    rotations = (julian_dates - CARRINGTON_EPOCH_JD) / SYNODIC_PERIOD + 1
+    return rotations if rotations.ndim else float(rotations)
+
+
+def carrington_rotation_to_date(rotations):
+    """
+    Converts Carrington rotation numbers to the date in which they start.
+
+    Parameters
+    ----------
+    rotations: number or array-like of numbers
+        Carrington rotation numbers, fractional values are allowed
+
+    Returns
+    -------
+    numpy array of datetime64[s] (a datetime64 for scalar input)
+    """
+    values = np.asarray(rotations, dtype='float64')
+    julian_dates = (values - 1) * SYNODIC_PERIOD + CARRINGTON_EPOCH_JD
+    seconds = np.round((julian_dates - UNIX_EPOCH_JD) * SECONDS_PER_DAY).astype('int64')
+    dates = seconds.astype('datetime64[s]')
+    return dates if dates.ndim else dates[()]
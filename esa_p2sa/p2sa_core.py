@@ -7,20 +7,60 @@ European Space Agency (ESA)
 Created on 5 Aug. 2019
 """
 import datetime
+import hashlib
 import json
 import os
+import re
 import sys
+import threading
+import time
+import warnings
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Dict, Any, Union
+from urllib.parse import urlencode
 
 import dateutil
+import numpy as np
+from astropy import config as _config
 from astropy import log
-from astroquery.utils.tap.core import TapPlus
-from astroquery.utils.tap.model import modelutils
+from astropy.table import Table, vstack
+from astropy.utils.exceptions import AstropyDeprecationWarning
+from astroquery.utils.tap import taputils
+from astroquery.utils.tap.core import TAP_CLIENT_ID, TapPlus
 
 from . import conf
-
-__all__ = ['ESAP2SA', 'ESAP2SAClass']
+from .p2sa_cache import ObservationRangeCache, ProductCache, QueryCache, SchemaCatalog
+from .p2sa_carrington import carrington_rotation_to_date, date_to_carrington_rotation
+from .p2sa_download import DownloadResult, download_resumable, download_segmented, extract_tar_stream, \
+    read_response, split_oid_list, stream_response
+from .p2sa_jobs import TapJobManager
+from .p2sa_mirror import ObservationMirror
+from .p2sa_parser import PARSER_FORMATS, iter_csv_batches, parse_observations, parse_table, recode_categories
+from .p2sa_transport import HTTPStatusError, P2SATransport, TransportTapConn
+
+__all__ = ['ESAP2SA', 'ESAP2SAClass', 'QueryPlan']
+
+# Columns of p2sa.v_observation returned by query_p2sa_observations
+OBSERVATION_COLUMNS = ('observation_oid', 'instrument_name', 'observation_type', 'begin_date', 'end_date',
+                       'processing_level', 'science_objective', 'wavelength_range', 'science_object_name',
+                       'file_name', 'file_format', 'file_size', 'observatory_name', 'calibrated')
+# Filters of query_p2sa_observations added to the WHERE clause of the query
+OBSERVATION_FILTERS = ('processing_level', 'observation_type', 'wavelength_range', 'file_format', 'calibrated',
+                       'min_file_size', 'max_file_size')
+# Sort order of query_p2sa_observations
+DEFAULT_ORDER = "begin_date"
+# Tables that query_p2sa_oids joins with an uploaded list of oids, and their primary key
+UPLOAD_JOIN_TABLES = {'p2sa.v_observation': 'observation_oid', 'p2sa.file': 'file_oid'}
+# Name of the uploaded table of oids, read by the query as tap_upload.<name>
+UPLOAD_TABLE_NAME = "oids"
+# Rows of a synchronous query without TOP, as capped by launch_job
+SYNC_TOP = 2000
+
+# Estimate returned by dry runs: the expected number of rows and the execution
+# chosen for them, 'sync', 'async' or 'partitioned'
+QueryPlan = namedtuple('QueryPlan', ['query', 'count_query', 'row_count', 'execution'])
 
 
 # -------------------------------
@@ -28,20 +68,109 @@ __all__ = ['ESAP2SA', 'ESAP2SAClass']
 # -------------------------------
 
 class ESAP2SAClass(TapPlus):
+    """
+    Client of the PROBA2 Science Archive (P2SA).
+
+    Thread safety: one instance, e.g. the module-level ESAP2SA, can be shared by
+    any number of threads. Requests are sent through a P2SATransport, whose
+    connection pool hands every request its own connection, and the response
+    status is kept per thread. The methods write no shared state besides the
+    product and movie caches, which are safe for concurrent use. Downloads of
+    different threads must target different files. Connection handlers
+    injected with tap_plus_conn_handler must give the same guarantee.
+
+    Pickling: an instance is pickled as its configuration (urls, connection
+    handler, transport settings and caches) and rebuilt on unpickling, so it
+    can be sent to multiprocessing and dask workers. Connections are opened
+    again by the worker on its first request. Login sessions are not kept.
+    """
+
+    _CONFIGURATION_ATTRIBUTES = ('data_url', 'metadata_url', 'video_url', 'p2sa_url', 'server_context')
     data_url = conf.DATA_ACTION
     metadata_url = conf.METADATA_ACTION
     video_url = conf.VIDEO_ACTION
     p2sa_url = conf.P2SA_BASE_URL
     server_context = conf.SERVER_CONTEXT
 
-    TIMEOUT = conf.TIMEOUT
-
-    def __init__(self, tap_plus_conn_handler=None):
+    def __init__(self, tap_plus_conn_handler=None, product_cache=None, movie_cache=None, transport=None,
+                 query_cache=None, range_cache=None, schema_catalog=None):
+        """
+        Parameters
+        ----------
+        tap_plus_conn_handler : connection handler object, optional, default None
+            HTTP(s) connection handler used by TapPlus. If not provided, TAP queries
+            and downloads are sent through transport
+        product_cache : ProductCache, optional, default None
+            on-disk cache of downloaded observations, products and postcards.
+            If not provided, a cache is created in conf.PRODUCT_CACHE_DIR when it is set
+        movie_cache : ProductCache, optional, default None
+            on-disk cache of Carrington movies. If not provided, a cache is created in
+            conf.MOVIE_CACHE_DIR the first time a movie is downloaded
+        transport : P2SATransport, optional, default None
+            pooled HTTP transport shared by all the requests of the client.
+            If not provided, one is created from the conf.HTTP_* settings
+        query_cache : QueryCache, optional, default None
+            cache of the results of query_p2sa_tap, execute_query and query_p2sa_observations.
+            If not provided, a cache is created in conf.QUERY_CACHE_DIR when it is set
+        range_cache : ObservationRangeCache, optional, default None
+            in-memory cache of the observations fetched by query_p2sa_observations with
+            incremental=True. If not provided, it is created on the first incremental query
+        schema_catalog : SchemaCatalog, optional, default None
+            catalog of tables and columns used by get_p2sa_tables and get_p2sa_columns.
+            If not provided, one is created in conf.SCHEMA_CACHE_DIR
+        """
+        if transport is None:
+            transport = P2SATransport()
+        # __end_if
+        self.transport = transport
+        if tap_plus_conn_handler is None:
+            tap_plus_conn_handler = TransportTapConn(transport, self.p2sa_url,
+                                                     server_context=self.server_context,
+                                                     tap_context="tap",
+                                                     data_context="data")
+        # __end_if
         super(ESAP2SAClass, self).__init__(url=self.p2sa_url,
                                            server_context=self.server_context,
                                            tap_context="tap",
                                            data_context="data",
                                            connhandler=tap_plus_conn_handler)
+        if product_cache is None and conf.PRODUCT_CACHE_DIR:
+            product_cache = ProductCache(conf.PRODUCT_CACHE_DIR, conf.PRODUCT_CACHE_MAX_BYTES)
+        self.product_cache = product_cache
+        self.movie_cache = movie_cache
+        if query_cache is None and conf.QUERY_CACHE_DIR:
+            query_cache = QueryCache(conf.QUERY_CACHE_DIR)
+        self.query_cache = query_cache
+        self.range_cache = range_cache
+        if schema_catalog is None:
+            schema_catalog = SchemaCatalog()
+        self.schema_catalog = schema_catalog
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        configuration = dict((name, getattr(self, name)) for name in self._CONFIGURATION_ATTRIBUTES)
+        return _restore_client, (type(self), configuration, self._Tap__connHandler, self.product_cache,
+                                 self.movie_cache, self.transport, self.query_cache, self.range_cache,
+                                 self.schema_catalog)
+
+    # __end_of_reduce
+
+    @property
+    def TIMEOUT(self):
+        """
+        Deprecated alias of the read timeout of the transport, see conf.HTTP_READ_TIMEOUT
+        """
+        warnings.warn("ESAP2SAClass.TIMEOUT is deprecated, use conf.HTTP_READ_TIMEOUT instead",
+                      AstropyDeprecationWarning)
+        return self.transport.read_timeout
+
+    @TIMEOUT.setter
+    def TIMEOUT(self, value):
+        warnings.warn("ESAP2SAClass.TIMEOUT is deprecated, use conf.HTTP_READ_TIMEOUT instead",
+                      AstropyDeprecationWarning)
+        self.transport.read_timeout = value
+
+    # __end_of_timeout
 
     def get_p2sa_observation(self, **kwargs):
 
@@ -70,14 +199,40 @@ class ESAP2SAClass(TapPlus):
 
         filename: string
             (Description TBD)
+
+        chunk_size: int
+            optional, default conf.DOWNLOAD_CHUNK_SIZE
+            size in bytes of the buffer used to stream the observation to disk
+
+        resume: bool
+            optional, default 'False'
+            keep the partial file of an interrupted download and resume it with
+            HTTP Range requests on the next call
+
+        segments: int
+            optional, default None
+            download the product over this number of parallel connections, each one
+            fetching a byte range. Falls back to a single stream when the server does
+            not support ranges. Cannot be combined with resume
+
+        extract_to: string
+            optional, default None
+            directory where the observation archive is unpacked while it is being
+            downloaded. The .tar file itself is not written
         
+        members: string, list of strings or callable
+            optional, default None (all files)
+            with extract_to, glob patterns (or a callable receiving the TarInfo) selecting
+            the archive members to extract. The other members are skipped
+
         verbose : bool
             optional, default 'False'
             flag to display information about the process
 
         Returns
         -------
-        None. It downloads the observation indicated
+        None. It downloads the observation indicated. With extract_to, the list of
+        extracted files
 
         """
 
@@ -88,6 +243,11 @@ class ESAP2SAClass(TapPlus):
         data_retrieval_origin = 'P2SAPY'
         filename = None
         retrieval_type = 'PRODUCT'
+        chunk_size = None
+        resume = False
+        segments = None
+        extract_to = None
+        members = None
         verbose = False
         # -- end of local variables declaration
 
@@ -104,43 +264,25 @@ class ESAP2SAClass(TapPlus):
                 filename = kwargs[kwarg]
             elif kwarg == "retrieval_type":
                 retrieval_type = kwargs[kwarg]
+            elif kwarg == "chunk_size":
+                chunk_size = kwargs[kwarg]
+            elif kwarg == "resume":
+                resume = kwargs[kwarg]
+            elif kwarg == "segments":
+                segments = kwargs[kwarg]
+            elif kwarg == "extract_to":
+                extract_to = kwargs[kwarg]
+            elif kwarg == "members":
+                members = kwargs[kwarg]
             elif kwarg == "verbose":
                 verbose = kwargs[kwarg]
-            # print current value
-            print(kwarg, "=>", kwargs[kwarg])
+            # log current value
+            log.debug("{0} => {1}".format(kwarg, kwargs[kwarg]))
 
         # -- end of local variables declaration
 
-        # Build download condition
-
-        retrieval_condition = ""
-
-        # Check retrieval type
-        if retrieval_type is not None:
-            retrieval_condition = 'retrieval_type=' + retrieval_type
-        else:
-            raise ValueError("Value for mandatory parameter 'retrieval_type' is missed")
-
-        # Check obs_oid
-        if obs_oid is not None:
-            retrieval_condition = retrieval_condition + "&" + 'observation_oid=' + obs_oid
-        else:
-            raise ValueError("Value for mandatory parameter 'observation_oid' is missed")
-
-        # Check product_type
-        if product_type is not None:
-            retrieval_condition = retrieval_condition + "&" + 'product_type=' + product_type
-        else:
-            raise ValueError("Value for mandatory parameter 'product_type' is missed")
-
-        # Check data_retrieval_origin
-        if data_retrieval_origin is not None:
-            retrieval_condition = retrieval_condition + "&" + 'data_retrieval_origin=' + data_retrieval_origin
-        else:
-            raise ValueError("Value for mandatory parameter 'data_retrieval_origin' is missed")
-
         # Build link to download P2SA observation
-        link = self.data_url + retrieval_condition
+        link = self._build_observation_link(obs_oid, retrieval_type, product_type, data_retrieval_origin)
 
         # #######################################################
         # The following lines are only for debug purposes
@@ -150,21 +292,23 @@ class ESAP2SAClass(TapPlus):
 
         try:
             # Sending download request to P2SA TAP
-            response = self.execute_query(link)
-            if response is not None:
-                if filename is not None:
-                    output_file_name = filename + ".tar"
-                else:
-                    output_file_name = obs_oid + ".tar"
-                self.get_file(
-                    output_file_name, response=response)
+            cache_key = ProductCache.key(retrieval_type, obs_oid, product_type)
+            if extract_to is not None:
+                extracted = self._extract_to_dir(link, extract_to, members, chunk_size, cache_key)
                 if verbose:
-                    log.info("[get_p2sa_observation()] Wrote {0} to {1}".format(link, output_file_name))
+                    log.info("[get_p2sa_observation()] Extracted {0} files from {1} to {2}".format(
+                        len(extracted), link, extract_to))
                 # __end_if
-                # return link
+                return extracted
             # __end_if
+            if filename is not None:
+                output_file_name = filename + ".tar"
             else:
-                log.error("Error occurred when downloading the requested observation: " + response.raise_for_status())
+                output_file_name = obs_oid + ".tar"
+            self._download_to_file(link, output_file_name, chunk_size, resume, segments, cache_key)
+            if verbose:
+                log.info("[get_p2sa_observation()] Wrote {0} to {1}".format(link, output_file_name))
+            # __end_if
 
         except IOError as e:
             log.error('An error occurred trying to read the file.')
@@ -186,11 +330,134 @@ class ESAP2SAClass(TapPlus):
 
     # _end_of_get_p2sa_observation
 
+    def get_p2sa_observations(self, obs_oids, workers=None, out_dir=None, product_type='OBSERVATION',
+                              retrieval_type='PRODUCT', data_retrieval_origin='P2SAPY', chunk_size=None,
+                              resume=False, extract=False, members=None, verbose=False):
+        """
+        Download several observation products from P2SA concurrently
+
+        Every observation is written to ``<out_dir>/<observation_oid>.tar``. Downloads run
+        on a pool of threads; a failure in one of them is reported in its result and does
+        not stop the rest of the batch.
+
+        Parameters
+        ----------
+        obs_oids : list of strings, mandatory
+            observation_oids to download
+        workers : int, optional, default conf.DOWNLOAD_WORKERS
+            number of downloads running at the same time
+        out_dir : string, optional, default current directory
+            directory where the observations are written. It is created if needed
+        product_type : string, optional, default 'OBSERVATION'
+            product type requested for every observation
+        retrieval_type : string, optional, default 'PRODUCT'
+            retrieval type requested for every observation
+        data_retrieval_origin : string, optional, default 'P2SAPY'
+            origin of the request
+        chunk_size : int, optional, default conf.DOWNLOAD_CHUNK_SIZE
+            size in bytes of the buffer used to stream every observation to disk
+        resume : bool, optional, default 'False'
+            resume interrupted downloads with HTTP Range requests, see get_p2sa_observation
+        extract : bool, optional, default 'False'
+            unpack every observation into ``<out_dir>/<observation_oid>/`` while it is
+            downloaded instead of writing the .tar file
+        members : string, list of strings or callable, optional, default None (all files)
+            with extract, archive members to extract, see get_p2sa_observation
+        verbose : bool, optional, default 'False'
+            flag to display information about the process
+
+        Returns
+        -------
+        A list of DownloadResult(oid, path, bytes, duration, error), in the same order as
+        obs_oids. ``error`` is None for the successful downloads. With extract, path is the
+        directory of the observation and bytes the size of the extracted files.
+        """
+        if obs_oids is None:
+            raise ValueError("Value for mandatory parameter 'obs_oids' is missed")
+        if workers is None:
+            workers = conf.DOWNLOAD_WORKERS
+        if int(workers) <= 0:
+            raise ValueError("Value for parameter 'workers' must be a positive integer")
+        if out_dir is None:
+            out_dir = os.curdir
+        elif not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        # __end_if
+
+        def download(obs_oid):
+            obs_oid = str(obs_oid)
+            output_file_name = os.path.join(out_dir, obs_oid if extract else obs_oid + ".tar")
+            start = time.time()
+            try:
+                link = self._build_observation_link(obs_oid, retrieval_type, product_type,
+                                                    data_retrieval_origin)
+                cache_key = ProductCache.key(retrieval_type, obs_oid, product_type)
+                if extract:
+                    extracted = self._extract_to_dir(link, output_file_name, members, chunk_size, cache_key)
+                    written_bytes = sum(os.path.getsize(path) for path in extracted)
+                else:
+                    written_bytes = self._download_to_file(link, output_file_name, chunk_size, resume,
+                                                           cache_key=cache_key)
+                # __end_if
+            except Exception as e:
+                if os.path.isfile(output_file_name):
+                    os.remove(output_file_name)
+                log.error("[get_p2sa_observations()] Observation {0} failed: {1}".format(obs_oid, e))
+                return DownloadResult(obs_oid, None, 0, time.time() - start, e)
+            # __end_try
+            if verbose:
+                log.info("[get_p2sa_observations()] Wrote {0} to {1}".format(link, output_file_name))
+            # __end_if
+            return DownloadResult(obs_oid, output_file_name, written_bytes, time.time() - start, None)
+
+        with ThreadPoolExecutor(max_workers=int(workers)) as executor:
+            return list(executor.map(download, obs_oids))
+
+    # _end_of_get_p2sa_observations
+
+    def _build_observation_link(self, obs_oid, retrieval_type, product_type, data_retrieval_origin):
+        """
+        Builds the data link used to download one observation product
+        """
+        retrieval_condition = ""
+
+        # Check retrieval type
+        if retrieval_type is not None:
+            retrieval_condition = 'retrieval_type=' + retrieval_type
+        else:
+            raise ValueError("Value for mandatory parameter 'retrieval_type' is missed")
+
+        # Check obs_oid
+        if obs_oid is not None:
+            retrieval_condition = retrieval_condition + "&" + 'observation_oid=' + obs_oid
+        else:
+            raise ValueError("Value for mandatory parameter 'observation_oid' is missed")
+
+        # Check product_type
+        if product_type is not None:
+            retrieval_condition = retrieval_condition + "&" + 'product_type=' + product_type
+        else:
+            raise ValueError("Value for mandatory parameter 'product_type' is missed")
+
+        # Check data_retrieval_origin
+        if data_retrieval_origin is not None:
+            retrieval_condition = retrieval_condition + "&" + 'data_retrieval_origin=' + data_retrieval_origin
+        else:
+            raise ValueError("Value for mandatory parameter 'data_retrieval_origin' is missed")
+
+        return self.data_url + retrieval_condition
+
+    # _end_of_build_observation_link
+
     def get_p2sa_product(self, **kwargs):
         """
         Example: http://p2sa.esac.esa.int/p2sa-sl-tap/data?retrieval_type=PRODUCT&QUERY=SELECT%20*%20
         FROM%20p2sa.file%20where%20file_oid%20%20in%20(6550)&data_retrieval_origin=P2SAPY
 
+        Long lists of file_oids are split into several requests, bounded by
+        conf.PRODUCT_MAX_OIDS_PER_REQUEST oids and conf.PRODUCT_MAX_URL_LENGTH characters
+        per url, which are downloaded concurrently into one archive each.
+
         Parameters
         ----------
         input_retrieval_type: string
@@ -205,7 +472,28 @@ class ESAP2SAClass(TapPlus):
             (Description TBD)
 
         filename: string
-            (Description TBD)
+            optional, name of the output archive. When the list is split in several
+            requests, a zero-padded index is appended to it for every archive. By default
+            the archives are named 'p2sa_product_<hash of their file_oids>.tar'
+
+        chunk_size: int
+            optional, default conf.DOWNLOAD_CHUNK_SIZE
+            size in bytes of the buffer used to stream the product to disk
+
+        resume: bool
+            optional, default 'False'
+            keep the partial file of an interrupted download and resume it with
+            HTTP Range requests on the next call
+
+        segments: int
+            optional, default None
+            download the product over this number of parallel connections, each one
+            fetching a byte range. Falls back to a single stream when the server does
+            not support ranges. Cannot be combined with resume
+
+        workers: int
+            optional, default conf.DOWNLOAD_WORKERS
+            number of archives downloaded at the same time
 
         verbose : bool
             optional, default 'False'
@@ -213,22 +501,22 @@ class ESAP2SAClass(TapPlus):
 
         Returns
         -------
-        None. It downloads the files indicated
+        Manifest of the downloaded archives: a list of DownloadResult(oid, path, bytes,
+        duration, error), one per request, where oid holds the comma separated
+        file_oids included in the archive
         """
 
         # Default values for variables
         # -----------------------------------
-        select_query = 'QUERY=SELECT+file_name%2C+file_path+FROM+p2sa.file+where+file_oid+in+%28@fileOidList@%29'
-        replace_pattern = '@fileOidList@'
         file_oid_list = None
-        selected_oids = ""
-        download_filename = ""
-        retrieval_condition = ""
         retrieval_type = 'PRODUCT'
         filename = None
         data_retrieval_origin = 'P2SAPY'
+        chunk_size = None
+        resume = False
+        segments = None
+        workers = None
         verbose = False
-        array_index = 0
 
         # Load variables values from the call
         # -----------------------------------
@@ -241,13 +529,72 @@ class ESAP2SAClass(TapPlus):
                 data_retrieval_origin = kwargs[kwarg]
             elif kwarg == "filename":
                 filename = kwargs[kwarg]
+            elif kwarg == "chunk_size":
+                chunk_size = kwargs[kwarg]
+            elif kwarg == "resume":
+                resume = kwargs[kwarg]
+            elif kwarg == "segments":
+                segments = kwargs[kwarg]
+            elif kwarg == "workers":
+                workers = kwargs[kwarg]
             elif kwarg == "verbose":
                 verbose = kwargs[kwarg]
-            # print current value
-            print(kwarg, "=>", kwargs[kwarg])
+            # log current value
+            log.debug("{0} => {1}".format(kwarg, kwargs[kwarg]))
 
-        # Check parameters and build the request
+        # Check parameters and build the requests
         # ---------------------------------------
+        chunks = self._build_product_links(file_oid_list, retrieval_type, data_retrieval_origin)
+
+        if workers is None:
+            workers = conf.DOWNLOAD_WORKERS
+
+        def download(index):
+            selected_oids, link = chunks[index]
+            output_file_name = self._get_product_filename(filename, selected_oids, index, len(chunks))
+
+            ########################################################
+            # The following lines are only for debug purposes
+            ########################################################
+            log.info("Filename: %s" % output_file_name)
+            log.info("Download url: %s" % str(link))
+            ########################################################
+
+            start = time.time()
+            try:
+                # Launch the request to P2SA tap
+                cache_key = ProductCache.key(retrieval_type, selected_oids)
+                written_bytes = self._download_to_file(link, output_file_name, chunk_size, resume, segments,
+                                                       cache_key)
+            except Exception as e:
+                if os.path.isfile(output_file_name):
+                    os.remove(output_file_name)
+                log.error("[get_p2sa_product()] Archive {0} failed: {1}".format(output_file_name, e))
+                return DownloadResult(selected_oids, None, 0, time.time() - start, e)
+            # __end_try
+
+            if verbose:
+                log.info("[get_p2sa_product()] Wrote {0} to {1}".format(link, output_file_name))
+            # __end_if
+            return DownloadResult(selected_oids, output_file_name, written_bytes, time.time() - start, None)
+
+        if len(chunks) == 1:
+            return [download(0)]
+        with ThreadPoolExecutor(max_workers=max(1, min(int(workers), len(chunks)))) as executor:
+            return list(executor.map(download, range(len(chunks))))
+
+    def _build_product_links(self, file_oid_list, retrieval_type='PRODUCT', data_retrieval_origin='P2SAPY'):
+        """
+        Builds the data links used to download the products of file_oid_list, split so
+        that every link stays below the url length limit
+
+        Returns
+        -------
+        List of (comma separated file_oids, link) tuples
+        """
+        select_query = 'QUERY=SELECT+file_name%2C+file_path+FROM+p2sa.file+where+file_oid+in+%28@fileOidList@%29'
+        replace_pattern = '@fileOidList@'
+        retrieval_condition = ""
 
         # Check product_type
         if retrieval_type is not None:
@@ -256,99 +603,57 @@ class ESAP2SAClass(TapPlus):
             raise ValueError("Value for mandatory parameter 'product_type' is missed")
 
         # Check list of file_oids
-        if file_oid_list is not None:
-
-            for file_oid in file_oid_list:
-                selected_oids = selected_oids + file_oid
-                download_filename = download_filename + file_oid
-                array_index = array_index + 1
-                if array_index < len(file_oid_list):
-                    selected_oids = selected_oids + ","
-                    download_filename = download_filename + "_"
-                # __end_if
-            # __end_for
-            # Replace the list of file_oids in the query String
-            select_query_with_oids = select_query.replace(replace_pattern, selected_oids)
-
-        else:
+        if file_oid_list is None or len(file_oid_list) == 0:
             raise ValueError("Value for mandatory parameter 'file_oid_list' is missed")
-
-        # With the list of file_oids replaced now we can build the final query
-        retrieval_condition = retrieval_condition + "&" + select_query_with_oids
+        file_oid_list = [str(file_oid) for file_oid in file_oid_list]
 
         # Check data_retrieval_origin
-        if data_retrieval_origin is not None:
-            retrieval_condition = retrieval_condition + "&" + 'data_retrieval_origin=' + data_retrieval_origin
-        else:
+        if data_retrieval_origin is None:
             raise ValueError("Value for mandatory parameter 'data_retrieval_origin' is missed")
 
-        # Build link to download P2SA observation
-        link = self.data_url + retrieval_condition
-
-        try:
-            # Launch the request to P2SA tap
-            result = self.execute_download_query(link)
-
-            ########################################################
-            # The following lines are only for debug purposes
-            ########################################################
-            log.info("Filename: %s" % filename)
-            log.info("Download url: %s" % str(link))
-            ########################################################
-            # return link
-
-            if result is not None:
+        link_pattern = self.data_url + retrieval_condition + "&" + select_query + "&" + \
+            'data_retrieval_origin=' + data_retrieval_origin
+        chunks = split_oid_list(file_oid_list, conf.PRODUCT_MAX_OIDS_PER_REQUEST,
+                                conf.PRODUCT_MAX_URL_LENGTH - len(link_pattern) + len(replace_pattern))
+        return [(",".join(chunk), link_pattern.replace(replace_pattern, ",".join(chunk))) for chunk in chunks]
 
-                if filename is None:
-                    filename = "" + download_filename + ".tar"
-                # __end_if
-
-                self.get_file(filename, response=result)
+    # _end_of_build_product_links
 
-                if verbose:
-                    log.info("[get_p2sa_product()] Wrote {0} to {1}".format(link, filename))
-                # __end_if
-                # return link
-            else:
-                log.error("Error occurred when downloading the requested product")
-            # __end_if
-        except IOError as e:
-            log.error('An error occurred trying to read the file.')
-            log.error(e)
-        except ValueError as e:
-            log.error('Error found in Value')
-            log.error(e)
-        except ImportError as e:
-            log.error("NO module found")
-            log.error(e)
-        except EOFError as e:
-            log.error('EOF found!!')
-            log.error(e)
-        except KeyboardInterrupt as e:
-            log.error('Operation cancelled by User')
-            log.error(e)
-        # except:
-        # log.error("Error. Please review your request", str(sys.exc_info()[0]), "occurred.")
+    @staticmethod
+    def _get_product_filename(filename, selected_oids, index, count):
+        """
+        Returns the name of the archive number index of a product request split in count archives
+        """
+        if filename is None:
+            digest = hashlib.sha1(selected_oids.encode('utf-8')).hexdigest()[:16]
+            return "p2sa_product_" + digest + ".tar"
+        if count == 1:
+            return filename
+        base, extension = os.path.splitext(filename)
+        return "{0}_{1:0{2}d}{3}".format(base, index, len(str(count - 1)), extension or ".tar")
 
     # _end_of_get_p2sa_product
 
     def display_p2sa_movie_file(self, **kwargs):
-        """Download postcards from P2SA
+        """Build the link to a P2SA movie file
 
         Example: http://p2sa.esac.esa.int/p2sa-sl-tap/video?file_oid=13785&data_retrieval_origin=P2SAPY
 
+        The link is built locally, no request is sent unless ``check`` is set.
+
         Parameters
         ----------
         :param kwargs, undefined number of parameters in a format of key=value. The following is a list with the
-        accepted parameters, file_oid, data_retrieval_origin, verbose, retrieval_condition.
+        accepted parameters, file_oid, data_retrieval_origin, verbose, check. With check=True a HEAD
+        request verifies that the movie exists before returning its link.
 
         Returns
         -------
-        Link to download the movie
+        Link to download the movie, None if the check fails
 
         Raises
         ------
-        ValueError, IOError, ImportError, EOFError, KeyboardInterrupt
+        ValueError
         """
 
         # Default values for variables
@@ -356,6 +661,7 @@ class ESAP2SAClass(TapPlus):
         file_oid = None
         data_retrieval_origin = 'P2SAPY'
         verbose = False
+        check = False
         retrieval_condition = ""
 
         # Load variables values from the call
@@ -365,6 +671,8 @@ class ESAP2SAClass(TapPlus):
                 file_oid = kwargs[kwarg]
             elif kwarg == "data_retrieval_origin":
                 data_retrieval_origin = kwargs[kwarg]
+            elif kwarg == "check":
+                check = kwargs[kwarg]
             elif kwarg == "verbose":
                 verbose = kwargs[kwarg]
             # print current value
@@ -375,7 +683,7 @@ class ESAP2SAClass(TapPlus):
 
         # Check product_type
         if file_oid is not None:
-            retrieval_condition = retrieval_condition + 'file_oid=' + file_oid
+            retrieval_condition = retrieval_condition + 'file_oid=' + str(file_oid)
         else:
             raise ValueError("Value for mandatory parameter 'file_oid' is missed")
 
@@ -383,45 +691,25 @@ class ESAP2SAClass(TapPlus):
         if data_retrieval_origin is not None:
             retrieval_condition = retrieval_condition + "&" + 'data_retrieval_origin=' + data_retrieval_origin
         else:
-            raise ValueError("Value for mandatory parameter 'file_oid' is missed")
+            raise ValueError("Value for mandatory parameter 'data_retrieval_origin' is missed")
 
         # Build link to display P2SA video.
-        link: object = self.video_url + retrieval_condition
-        try:
-            # Launch the request to P2SA tap
-            result = self.execute_download_query(link)
-
-            if result is not None:
-
-                ########################################################
-                # The following lines are only for debug purposes
-                ########################################################
-                # log.info("Download url: %s" % str(link))
-                ########################################################
-                return link
-            else:
-                log.error("Error occurred when downloading the requested observation: " + result.raise_for_status())
+        link = self.video_url + retrieval_condition
+
+        if check:
+            try:
+                response = self._open_url(link, method="HEAD")
+                response.close()
+            except IOError as e:
+                log.error("Movie file {0} is not available: {1}".format(file_oid, e))
+                return None
+            # __end_try
+        # __end_if
 
-            if verbose:
-                log.info(link)
-            # __end_if
-        except IOError as e:
-            log.error('An error occurred trying to read the file.')
-            log.error(e)
-        except ValueError as e:
-            log.error('Error found in Value')
-            log.error(e)
-        except ImportError as e:
-            log.error("NO module found")
-            log.error(e)
-        except EOFError as e:
-            log.error('EOF found!!')
-            log.error(e)
-        except KeyboardInterrupt as e:
-            log.error('Operation cancelled by User')
-            log.error(e)
-        # except:
-        #   log.error("Error. Please review your request", str(sys.exc_info()[0]), "occurred.")
+        if verbose:
+            log.info(link)
+        # __end_if
+        return link
 
     # display_p2sa_movie_file
 
@@ -476,7 +764,6 @@ class ESAP2SAClass(TapPlus):
         product_type = "POSTCARD"
         verbose = False
         data_retrieval_origin = "P2SAPY"
-        retrieval_condition = None
 
         # Load variables values from the call
         # -----------------------------------
@@ -495,11 +782,59 @@ class ESAP2SAClass(TapPlus):
                 data_retrieval_origin = kwargs[kwarg]
             elif kwarg == "verbose":
                 verbose = kwargs[kwarg]
-            # print current value
-            print(kwarg, "=>", kwargs[kwarg])
+            # log current value
+            log.debug("{0} => {1}".format(kwarg, kwargs[kwarg]))
 
-        # Check parameters and build the request
-        # ---------------------------------------
+        # Build link to download P2SA postcard
+        link = self._build_postcard_link(observation_oid, resolution, retrieval_type, product_type,
+                                         data_retrieval_origin)
+
+        try:
+            if filename is None:
+                filename = "postcard_" + observation_oid + ".jpg"
+            # __end_if
+
+            # Launch the request to P2SA tap
+            cache_key = ProductCache.key(retrieval_type, observation_oid, product_type, resolution)
+            self._download_to_file(link, filename, cache_key=cache_key)
+
+            if verbose:
+                log.info("[get_p2sa_postcard()] Wrote {0} to {1}".format(link, filename))
+            # __end_if
+
+            ########################################################
+            # The following lines are only for debug purposes
+            ########################################################
+            log.info("Filename: %s" % filename)
+            log.info("Download url: %s" % str(link))
+            ########################################################
+            return link
+        except IOError as e:
+            log.error('An error occurred trying to read the file.')
+            log.error(e)
+        except ValueError as e:
+            log.error('Error found in Value')
+            log.error(e)
+        except ImportError as e:
+            log.error("NO module found")
+            log.error(e)
+        except EOFError as e:
+            log.error('EOF found!!')
+            log.error(e)
+        except KeyboardInterrupt as e:
+            log.error('Operation cancelled by User')
+            log.error(e)
+        # except:
+        # log.error("Error. Please review your request", str(sys.exc_info()[0]), "occurred.")
+
+    # _end_of_get_p2sa_postcard
+
+    def _build_postcard_link(self, observation_oid, resolution="low", retrieval_type="PRODUCT",
+                             product_type="POSTCARD", data_retrieval_origin="P2SAPY"):
+        """
+        Builds the data link used to download one postcard
+        """
+        retrieval_condition = None
 
         # Check retrieval_type
         if retrieval_type is not None:
@@ -531,53 +866,9 @@ class ESAP2SAClass(TapPlus):
         else:
             raise ValueError("Value for mandatory parameter 'data_retrieval_origin' is missed")
 
-        # Build link to download P2SA postcard
-        link = self.data_url + retrieval_condition
+        return self.data_url + retrieval_condition
 
-        try:
-            # Launch the request to P2SA tap
-            result = self.execute_download_query(link)
-
-            if result is not None:
-                if filename is None:
-                    filename = "postcard_" + observation_oid + ".jpg"
-                # __end_if
-
-                self.get_file(filename, response=result)
-
-                if verbose:
-                    log.info("[get_p2sa_postcard()] Wrote {0} to {1}".format(link, filename))
-                # __end_if
-
-                ########################################################
-                # The following lines are only for debug purposes
-                ########################################################
-                log.info("Filename: %s" % filename)
-                log.info("Download url: %s" % str(link))
-                ########################################################
-                return link
-            else:
-                log.error("Error occurred when downloading the requested observation: ")
-            # __end_if
-        except IOError as e:
-            log.error('An error occurred trying to read the file.')
-            log.error(e)
-        except ValueError as e:
-            log.error('Error found in Value')
-            log.error(e)
-        except ImportError as e:
-            log.error("NO module found")
-            log.error(e)
-        except EOFError as e:
-            log.error('EOF found!!')
-            log.error(e)
-        except KeyboardInterrupt as e:
-            log.error('Operation cancelled by User')
-            log.error(e)
-        # except:
-        # log.error("Error. Please review your request", str(sys.exc_info()[0]), "occurred.")
-
-    # _end_of_get_p2sa_postcard
+    # _end_of_build_postcard_link
 
     def query_carrington_movie(self, **kwargs):
         """
@@ -627,8 +918,8 @@ class ESAP2SAClass(TapPlus):
                 input_date = kwargs[kwarg]
             elif kwarg == "file_type":
                 file_type = kwargs[kwarg]
-            # print current value
-            print(kwarg, "=>", kwargs[kwarg])
+            # log current value
+            log.debug("{0} => {1}".format(kwarg, kwargs[kwarg]))
 
         # Check fromDate parameter
         if file_type is not None:
@@ -677,9 +968,14 @@ class ESAP2SAClass(TapPlus):
             result = self.execute_download_query(link)
             index = 0
             if result is not None:
-                response_content = result.read()
+                try:
+                    response_content = result.read()
+                finally:
+                    result.close()
+                # __end_try
                 result_text = json.loads(response_content)
                 file_oid_list = result_text["data"]
+                # The file_oids come from the catalogue, so the links are built without any check
                 for file_oid_element in file_oid_list:
                     movie_link = self.display_p2sa_movie_file(file_oid=file_oid_element[0])
                     links_to_movies_array[index] = movie_link
@@ -712,6 +1008,184 @@ class ESAP2SAClass(TapPlus):
 
     # _end_of_query_carrington_movie
 
+    def query_carrington_movies(self, from_date=None, to_date=None, from_rotation=None, to_rotation=None,
+                                file_type=None, data_retrieval_origin='P2SAPY', verbose=False):
+        """
+        Queries the Carrington movies of a range of dates or Carrington rotations
+
+        All the movies overlapping the range are fetched from p2sa.v_carrington_rotation_file
+        in a single query. Rotation numbers are converted to dates locally
+        (see p2sa_carrington.carrington_rotation_to_date).
+
+        Parameters
+        ----------
+        from_date : str, optional, default None
+            start of the range, in a format of 'yyyy-mm-dd' or 'yyyy-mm-dd hh:mm:ss'
+        to_date : str, optional, default from_date plus one day
+            end of the range, not included
+        from_rotation : int, optional, default None
+            first Carrington rotation of the range. It cannot be combined with dates
+        to_rotation : int, optional, default from_rotation
+            last Carrington rotation of the range, included
+        file_type : str or list of str, optional, default None
+            'CR' and/or 'CR_YELLOW'. If not provided both types of files are returned
+        data_retrieval_origin : str, optional, default 'P2SAPY'
+            origin recorded in the movie links
+        verbose : bool, optional, default 'False'
+            flag to display information about the process
+
+        Returns
+        -------
+        A table with columns file_oid, file_type, start_date, end_date, carrington_rotation
+        and link, sorted by start_date. None if the query fails
+
+        Raises
+        ------
+        ValueError
+        """
+        # Check parameters and build the request
+        # ---------------------------------------
+        if from_rotation is not None or to_rotation is not None:
+            if from_date is not None or to_date is not None:
+                raise ValueError("Dates and Carrington rotations cannot be combined")
+            # __end_if
+            if from_rotation is None:
+                from_rotation = to_rotation
+            if to_rotation is None:
+                to_rotation = from_rotation
+            # The range ends where the rotation after the last one starts
+            bounds = carrington_rotation_to_date([int(from_rotation), int(to_rotation) + 1])
+        elif from_date is not None:
+            bounds = np.array([from_date, from_date if to_date is None else to_date], dtype='datetime64[s]')
+            if to_date is None:
+                bounds[1] = bounds[0] + np.timedelta64(1, 'D')
+            # __end_if
+        else:
+            raise ValueError("Value for mandatory parameter 'from_date' or 'from_rotation' is missed")
+        # __end_if
+
+        if bounds[1] <= bounds[0]:
+            raise ValueError("The end of the range must be after its start")
+        # __end_if
+
+        if file_type is None:
+            file_type = ['CR', 'CR_YELLOW']
+        elif isinstance(file_type, str):
+            file_type = [file_type]
+        # __end_if
+
+        from_text, to_text = [str(bound).replace("T", " ") for bound in bounds]
+        metadata_query = "REQUEST=doQuery&LANG=ADQL&FORMAT=JSON&PHASE=RUN" \
+                         "&QUERY=SELECT file_oid, file_type, start_date, end_date" \
+                         " FROM p2sa.v_carrington_rotation_file" \
+                         " WHERE (end_date > '" + from_text + "') AND (start_date < '" + to_text + "')" \
+                         " AND (file_type in (" + ",".join("'" + t + "'" for t in file_type) + "))" \
+                         " ORDER BY start_date ASC"
+        link = self.metadata_url + self.encode_string_if_needed(metadata_query)
+
+        if verbose:
+            log.info("Metadata Query: %s" % link)
+        # __end_if
+
+        try:
+            response = self._execute_get(link)
+            try:
+                result_text = json.loads(response.read())
+            finally:
+                response.close()
+            # __end_try
+            names = [column["name"] for column in result_text["metadata"]]
+            rows = result_text["data"]
+            if len(rows) > 0:
+                table = Table(rows=rows, names=names)
+            else:
+                table = Table(names=names, dtype=[str] * len(names))
+            # __end_if
+
+            start_dates = np.asarray(table["start_date"], dtype='datetime64[ms]')
+            end_dates = np.asarray(table["end_date"], dtype='datetime64[ms]')
+            middle_dates = start_dates + (end_dates - start_dates) / 2
+            table["carrington_rotation"] = np.floor(date_to_carrington_rotation(middle_dates)).astype(int)
+            table["link"] = [self.display_p2sa_movie_file(file_oid=file_oid,
+                                                          data_retrieval_origin=data_retrieval_origin)
+                             for file_oid in table["file_oid"]]
+            return table
+        except IOError as e:
+            log.error('An error occurred trying to read the file.')
+            log.error(e)
+        except ValueError as e:
+            log.error('Error found in Value')
+            log.error(e)
+        except KeyError as e:
+            log.error('Unexpected response format')
+            log.error(e)
+        except KeyboardInterrupt as e:
+            log.error('Operation cancelled by User')
+            log.error(e)
+        return None
+
+    # _end_of_query_carrington_movies
+
+    def get_p2sa_movie_file(self, file_oid, filename=None, data_retrieval_origin='P2SAPY'):
+        """
+        Downloads a Carrington movie through the local movie cache
+
+        A movie already in the cache is copied to filename without any request,
+        so displaying the same rotation again does not download it again.
+
+        Parameters
+        ----------
+        file_oid : str or int, mandatory
+            file_oid of the movie, as returned by query_carrington_movies
+        filename : str, optional, default 'p2sa_movie_<file_oid>.mp4'
+            name of the local file
+        data_retrieval_origin : str, optional, default 'P2SAPY'
+            origin recorded in the request
+
+        Returns
+        -------
+        Name of the local file. Errors are raised to the caller
+        """
+        link = self.display_p2sa_movie_file(file_oid=file_oid, data_retrieval_origin=data_retrieval_origin)
+        if filename is None:
+            filename = "p2sa_movie_" + str(file_oid) + ".mp4"
+        # __end_if
+        self._download_to_file(link, filename, cache_key=ProductCache.key("VIDEO", file_oid),
+                               cache=self._get_movie_cache())
+        return filename
+
+    # _end_of_get_p2sa_movie_file
+
+    def _get_movie_cache(self):
+        """
+        Returns the movie cache, creating it in conf.MOVIE_CACHE_DIR on first use
+        """
+        with self._lock:
+            if self.movie_cache is None:
+                directory = conf.MOVIE_CACHE_DIR
+                if not directory:
+                    directory = os.path.join(_config.get_cache_dir(), "esa_p2sa", "movies")
+                # __end_if
+                self.movie_cache = ProductCache(directory, conf.MOVIE_CACHE_MAX_BYTES)
+            # __end_if
+        # __end_with
+        return self.movie_cache
+
+    # __end_of_get_movie_cache
+
+    def _get_range_cache(self):
+        """
+        Returns the time-range cache of query_p2sa_observations, creating it on first use
+        """
+        with self._lock:
+            if self.range_cache is None:
+                self.range_cache = ObservationRangeCache()
+            # __end_if
+        # __end_with
+        return self.range_cache
+
+    # __end_of_get_range_cache
+
     def query_p2sa_observations(self, **kwargs):
 
         """
@@ -723,79 +1197,834 @@ class ESAP2SAClass(TapPlus):
             optional
             output format of the query
 
-        input_fromDate: String
-            TBD
+        input_fromDate: String
+            TBD
+
+        input_toDate: String
+            TBD
+        filename : string
+            file name to be used to store the metadata, optional, default None.
+            The response of the service is saved while it is read. Results of the
+            query cache, of the mirror or of several queries are written as VOTable
+        output_format : array of string
+            optional, default 'votable'
+            output format of the query
+        verbose : bool
+            optional, default 'False'
+            Flag to display information about the process
+        partitioned : bool
+            optional, default 'False'
+            split [from_date, to_date) into time windows queried concurrently. The number
+            of windows comes from a COUNT query and target_rows. Both dates are mandatory
+        target_rows : int
+            optional, default conf.PARTITION_TARGET_ROWS
+            expected number of rows per window in partitioned mode
+        workers : int
+            optional, default conf.PARTITION_WORKERS
+            number of windows queried at the same time in partitioned mode
+        mirror : str or ObservationMirror
+            optional, default None
+            answer the query from the local mirror of p2sa.v_observation built by
+            sync_observations instead of the TAP service
+        incremental : bool
+            optional, default 'False'
+            keep the observations in the time-range cache of the client and fetch from the
+            server only the parts of [from_date, to_date) not fetched before for the same
+            instruments. The result is the same as the one of a fresh query
+        use_cache : bool
+            optional, default 'True'
+            serve the result from the query cache, if the client has one, and store it there
+        refresh_cache : bool
+            optional, default 'False'
+            run the query on the server even if its result is cached
+        columns : list of str
+            optional, default all the columns listed in OBSERVATION_COLUMNS
+            columns of p2sa.v_observation to return
+        processing_level, observation_type, wavelength_range, file_format : str or list of str
+            optional, default None
+            return only the observations with this value, or with one of these values
+        calibrated : bool
+            optional, default None
+            return only the calibrated (True) or the non calibrated (False) observations
+        min_file_size, max_file_size : int
+            optional, default None
+            return only the observations whose file has at least / at most this size in bytes
+        order_by : str or list of str
+            optional, default 'begin_date'
+            columns to sort by, each one optionally followed by ASC or DESC. None does
+            not sort. Partitioned and incremental results are always sorted by begin_date
+        top : int
+            optional, default None
+            maximum number of observations to return. Without it, synchronous queries
+            return at most 2000 observations
+        offset : int
+            optional, default None
+            number of observations to skip, to read the result page by page together with
+            top. observation_oid is added to the sort so that pages do not overlap
+        execution : str
+            optional, default conf.QUERY_EXECUTION
+            'sync' runs a synchronous TAP job, 'async' an asynchronous one and 'partitioned'
+            is the same as partitioned=True. 'auto' first runs a COUNT(*) query with the same
+            WHERE clause and chooses from the expected number of rows: synchronous up to
+            conf.SYNC_MAX_ROWS, partitioned above conf.ASYNC_MAX_ROWS when both dates are
+            given, asynchronous otherwise. Cached results are returned without COUNT(*) query
+        dry_run : bool
+            optional, default 'False'
+            only run the COUNT(*) query and return the QueryPlan (query, count_query,
+            row_count, execution) of the query instead of its result
+        typed : bool
+            optional, default 'False'
+            decode the 'csv' or 'json' response with parse_observations instead of the
+            astropy readers, into int64 oids and sizes, datetime64 dates and bool
+            calibrated flags. Typed results are not cached, and filename receives the
+            response as sent by the server. Not available for mirror, incremental and
+            partitioned queries
+
+        Returns
+        -------
+        Table with the result of the query. It downloads metadata as a file.
+
+
+        Examples
+        --------
+        REQUEST=doQuery&LANG=ADQL&FORMAT=json&QUERY=SELECT+*+FROM+v_observation+ WHERE+((instrument_name='SWAP')+OR+(instrument_name='LYRA'))+AND+begin_date>'2017-01-07'&PAGE=1&PAGE_SIZE=1000
+
+        """
+
+        # Default values for variables
+        # -----------------------------------
+
+        verbose = False
+        filename = ""
+        from_date = ""
+        to_date = ""
+        instruments = ""
+        output_format = "csv"
+        partitioned = False
+        target_rows = None
+        workers = None
+        mirror = None
+        incremental = False
+        use_cache = True
+        refresh_cache = False
+        columns = None
+        filters = {}
+        order_by = DEFAULT_ORDER
+        top = None
+        offset = None
+        execution = conf.QUERY_EXECUTION
+        dry_run = False
+        typed = False
+
+        # Load variables values from the call
+        # -----------------------------------
+        for kwarg in kwargs:
+            if kwarg == "instruments":
+                instruments = kwargs[kwarg]
+            elif kwarg == "columns":
+                columns = kwargs[kwarg]
+            elif kwarg in OBSERVATION_FILTERS:
+                filters[kwarg] = kwargs[kwarg]
+            elif kwarg == "order_by":
+                order_by = kwargs[kwarg] or None
+            elif kwarg == "top":
+                top = kwargs[kwarg]
+            elif kwarg == "offset":
+                offset = kwargs[kwarg]
+            elif kwarg == "execution":
+                execution = kwargs[kwarg]
+            elif kwarg == "dry_run":
+                dry_run = kwargs[kwarg]
+            elif kwarg == "typed":
+                typed = kwargs[kwarg]
+            elif kwarg == "partitioned":
+                partitioned = kwargs[kwarg]
+            elif kwarg == "target_rows":
+                target_rows = kwargs[kwarg]
+            elif kwarg == "workers":
+                workers = kwargs[kwarg]
+            elif kwarg == "mirror":
+                mirror = kwargs[kwarg]
+            elif kwarg == "incremental":
+                incremental = kwargs[kwarg]
+            elif kwarg == "use_cache":
+                use_cache = kwargs[kwarg]
+            elif kwarg == "refresh_cache":
+                refresh_cache = kwargs[kwarg]
+            elif kwarg == "from_date":
+                from_date = kwargs[kwarg]
+            elif kwarg == "to_date":
+                to_date = kwargs[kwarg]
+            elif kwarg == "output_format":
+                output_format = kwargs[kwarg]
+            elif kwarg == "filename":
+                filename = kwargs[kwarg]
+            elif kwarg == "verbose":
+                verbose = kwargs[kwarg]
+            # log current value
+            log.debug("{0} => {1}".format(kwarg, kwargs[kwarg]))
+
+        try:
+            # Build the ADQL query
+            # -----------------------------------
+            conditions = self._build_filter_conditions(filters)
+            link = self._build_observations_query(instruments, from_date, to_date, conditions, columns=columns,
+                                                  order_by=order_by, top=top, offset=offset)
+
+            ########################################################
+            # The following lines are only for debug purposes
+            ########################################################
+            log.info("Metadata Query: %s" % link)
+            ########################################################
+
+            if partitioned:
+                execution = "partitioned"
+            # __end_if
+            if (incremental or execution == "partitioned") and (top is not None or offset is not None):
+                raise ValueError("Partitioned and incremental queries cannot use 'top' or 'offset'")
+            if dry_run and (mirror is not None or incremental):
+                raise ValueError("Only queries run on the TAP service can be planned with 'dry_run'")
+            if typed and (mirror is not None or incremental or execution == "partitioned"):
+                raise ValueError("Only queries run on the TAP service without partitions can be 'typed'")
+            if typed and str(output_format).lower() not in PARSER_FORMATS:
+                raise ValueError("Typed results are parsed from one of the formats {0}".format(PARSER_FORMATS))
+            # __end_if
+
+            # Queries sorted by begin_date over a closed time range can be split in windows
+            partition = None
+            if from_date and to_date and top is None and offset is None and order_by in (None, DEFAULT_ORDER) \
+                    and not typed:
+                partition = lambda: self._query_observations_partitioned(instruments, from_date, to_date,
+                                                                         target_rows, workers, use_cache,
+                                                                         refresh_cache, columns=columns,
+                                                                         conditions=conditions,
+                                                                         order_by=order_by)
+            # __end_if
+            count_query = self._build_observations_query(instruments, from_date, to_date, conditions, count=True)
+
+            # Launch the request to P2SA tap
+            written = False
+            if dry_run:
+                return self._plan_query(link, count_query, execution, top, offset, partition is not None,
+                                        use_cache, refresh_cache)
+            elif mirror is not None:
+                if not isinstance(mirror, ObservationMirror):
+                    mirror = ObservationMirror(mirror)
+                # __end_if
+                result = mirror.query(instruments, from_date, to_date, columns=columns, filters=filters,
+                                      order_by=order_by, top=top, offset=offset)
+            elif incremental:
+                if order_by not in (None, DEFAULT_ORDER):
+                    raise ValueError("Incremental queries are sorted by begin_date")
+                # __end_if
+                result = self._query_observations_incremental(instruments, from_date, to_date, partitioned,
+                                                              target_rows, workers, columns, conditions)
+            elif execution == "partitioned":
+                result = self._query_observations_partitioned(instruments, from_date, to_date, target_rows,
+                                                              workers, use_cache, refresh_cache,
+                                                              columns=columns, conditions=conditions,
+                                                              order_by=order_by)
+            elif typed:
+                result = self._execute_planned(link, count_query, execution, output_format=output_format, top=top,
+                                               offset=offset, parser=parse_observations, filename=filename)
+                written = True
+            else:
+                result = self.execute_query(link, filename, use_cache, refresh_cache, execution, count_query,
+                                            top=top, offset=offset, partition=partition)
+                written = True
+            # __end_if
+            if not written and result is not None and filename:
+                # Same format as the response saved by execute_query
+                result.write(filename, format='votable', overwrite=True)
+            # __end_if
+
+            if result is not None:
+                # if filename is None:
+                #    filename = "p2sa_observations"
+                # __end_if
+                if verbose:
+                    log.info("[get_p2sa_observation()] Wrote {0} to {1}".format(link, filename))
+                # __end_if
+                # return self.get_table(filename, response=result, output_format=output_format)
+                return result
+            else:
+                log.error("Error occurred when downloading the requested observation")
+            # __end_if
+        except IOError as e:
+            log.error('An error occurred trying to read the file.')
+            log.error(e)
+        except ValueError as e:
+            log.error('Error found in Value')
+            log.error(e)
+        except ImportError as e:
+            log.error("NO module found")
+            log.error(e)
+        except EOFError as e:
+            log.error('EOF found!!')
+            log.error(e)
+        except KeyboardInterrupt as e:
+            log.error('Operation cancelled by User')
+            log.error(e)
+        # except:
+        # log.error("Error. Please review your request", str(sys.exc_info()[0]), "occurred.")
+
+    # _end_of_query_p2sa_observations
+
+    def iter_p2sa_observations(self, **kwargs):
+        """
+        Runs a query over P2SA observations and yields its result in tables of
+        batch_size rows, each one decoded while the rest of the response is still
+        being downloaded. Memory holds about one batch whatever the number of rows.
+
+        The query is the one of query_p2sa_observations. The result is requested as
+        CSV and decoded with parse_observations, into int64 oids and sizes,
+        datetime64 dates and bool calibrated flags.
+
+        Parameters
+        ----------
+        instruments, from_date, to_date, columns, order_by, top, offset :
+            optional, see query_p2sa_observations
+        processing_level, observation_type, wavelength_range, file_format, calibrated,
+        min_file_size, max_file_size :
+            optional, default None, see query_p2sa_observations
+        batch_size : int
+            optional, default conf.ITER_BATCH_SIZE
+            number of rows of each table. The last one may have fewer
+        categorical : bool
+            optional, default 'False'
+            return text columns with a few distinct values as codes, see parse_observations.
+            A value has the same code in every batch, see recode_categories
+        execution : str
+            optional, default conf.QUERY_EXECUTION
+            'sync' reads the response of a synchronous TAP query, without the limit of
+            2000 rows of query_p2sa_observations, and 'async' the result of an
+            asynchronous job, deleted once it is read or the generator is closed.
+            'auto' chooses from a COUNT(*) query, 'partitioned' is the same as 'auto'
+
+        Returns
+        -------
+        A generator of table objects. Errors are raised
+        """
+        instruments = ""
+        from_date = ""
+        to_date = ""
+        columns = None
+        filters = {}
+        order_by = DEFAULT_ORDER
+        top = None
+        offset = None
+        execution = conf.QUERY_EXECUTION
+        batch_size = None
+        categorical = False
+
+        for kwarg in kwargs:
+            if kwarg == "instruments":
+                instruments = kwargs[kwarg]
+            elif kwarg == "from_date":
+                from_date = kwargs[kwarg]
+            elif kwarg == "to_date":
+                to_date = kwargs[kwarg]
+            elif kwarg == "columns":
+                columns = kwargs[kwarg]
+            elif kwarg in OBSERVATION_FILTERS:
+                filters[kwarg] = kwargs[kwarg]
+            elif kwarg == "order_by":
+                order_by = kwargs[kwarg] or None
+            elif kwarg == "top":
+                top = kwargs[kwarg]
+            elif kwarg == "offset":
+                offset = kwargs[kwarg]
+            elif kwarg == "execution":
+                execution = kwargs[kwarg]
+            elif kwarg == "batch_size":
+                batch_size = kwargs[kwarg]
+            elif kwarg == "categorical":
+                categorical = kwargs[kwarg]
+            # log current value
+            log.debug("{0} => {1}".format(kwarg, kwargs[kwarg]))
+        # __end_for
+
+        conditions = self._build_filter_conditions(filters)
+        query = self._build_observations_query(instruments, from_date, to_date, conditions, columns=columns,
+                                               order_by=order_by, top=top, offset=offset)
+        count_query = self._build_observations_query(instruments, from_date, to_date, conditions, count=True)
+        log.info("Metadata Query: %s" % query)
+
+        # Codes of the categorical columns are shared by all the batches
+        categories = {}
+
+        def parser(body, output_format):
+            table = parse_observations(body, output_format, categorical)
+            return recode_categories(table, categories) if categorical else table
+
+        return self._iter_query(query, count_query, batch_size, execution, parser, top=top, offset=offset)
+
+    # _end_of_iter_p2sa_observations
+
+    def sync_observations(self, path, batch_rows=None, full=False, verbose=False):
+        """
+        Builds or updates a local mirror of p2sa.v_observation in a SQLite file.
+
+        The first synchronization copies the whole table. Later ones only fetch
+        the observations with an observation_oid higher than the highest one
+        already mirrored. The mirror is queried with ObservationMirror.query or
+        with query_p2sa_observations(mirror=path).
+
+        Parameters
+        ----------
+        path : str, mandatory
+            SQLite file of the mirror
+        batch_rows : int, optional, default conf.MIRROR_BATCH_ROWS
+            number of observations fetched per TAP query
+        full : bool, optional, default False
+            discard the mirror and copy the whole table again, to pick up
+            observations changed in the archive
+        verbose : bool, optional, default False
+            flag to display information about the process
+
+        Returns
+        -------
+        The ObservationMirror. Errors are raised to the caller
+        """
+        if batch_rows is None:
+            batch_rows = conf.MIRROR_BATCH_ROWS
+        if int(batch_rows) < 1:
+            raise ValueError("Value for parameter 'batch_rows' must be positive")
+        # __end_if
+
+        mirror = ObservationMirror(path)
+        if full:
+            mirror.clear()
+        # __end_if
+        watermark = mirror.watermark()
+        synchronized = 0
+        while True:
+            # Keyset pagination on the primary key: every batch is one indexed range scan
+            query = "SELECT TOP {0} ".format(int(batch_rows)) + \
+                    ", ".join("obs." + column for column in OBSERVATION_COLUMNS) + \
+                    " FROM p2sa.v_observation as obs"
+            if watermark is not None:
+                query = query + " WHERE obs.observation_oid > {0}".format(int(watermark))
+            # __end_if
+            table = self._launch_query(query + " ORDER BY obs.observation_oid ASC", use_cache=False)
+            if len(table) > 0 or not mirror.exists():
+                synchronized = synchronized + mirror.insert(table)
+            # __end_if
+            if verbose:
+                log.info("[sync_observations()] {0} observations synchronized".format(synchronized))
+            # __end_if
+            if len(table) < int(batch_rows):
+                break
+            # __end_if
+            watermark = int(np.max(table["observation_oid"]))
+        # __end_while
+        log.info("Mirror {0}: {1} new observations, {2} in total".format(mirror.path, synchronized, len(mirror)))
+        return mirror
+
+    # _end_of_sync_observations
+
+    def _query_observations_partitioned(self, instruments, from_date, to_date, target_rows=None, workers=None,
+                                        use_cache=True, refresh_cache=False, closed=False, columns=None,
+                                        conditions=None, order_by=DEFAULT_ORDER):
+        """
+        Runs query_p2sa_observations as several queries over consecutive begin_date
+        windows of [from_date, to_date), executed concurrently.
+
+        The first window also holds the observations that started before from_date.
+        The windows do not overlap and each one is sorted by begin_date, so merging
+        them in window order gives the order of the single query. order_by can only
+        be begin_date or None, which leaves the rows of each window unsorted. Each
+        window query has an explicit TOP above the total row count, so that no
+        window is truncated by the default row limit of synchronous queries. Errors
+        are raised to the caller.
+
+        The windows are merged with one vstack once all of them have been read,
+        instead of one by one as they finish: a single vstack copies the rows once,
+        where merging each finished window would copy the merged rows again for
+        each of up to conf.PARTITION_MAX_WINDOWS windows.
+
+        Returns
+        -------
+        A table object
+        """
+        if not from_date or not to_date:
+            raise ValueError("Partitioned queries need both 'from_date' and 'to_date'")
+        if target_rows is None:
+            target_rows = conf.PARTITION_TARGET_ROWS
+        if workers is None:
+            workers = conf.PARTITION_WORKERS
+        if int(target_rows) < 1 or int(workers) < 1:
+            raise ValueError("Values for parameters 'target_rows' and 'workers' must be positive")
+        if order_by not in (None, DEFAULT_ORDER):
+            raise ValueError("Partitioned queries are sorted by begin_date")
+        # __end_if
+
+        count_query = self._build_observations_query(instruments, from_date, to_date, conditions, count=True,
+                                                     closed=closed)
+        row_count = int(self._launch_query(count_query, use_cache, refresh_cache)["row_count"][0])
+        windows = max(1, min(-(-row_count // int(target_rows)), conf.PARTITION_MAX_WINDOWS))
+        bounds = self._partition_bounds(from_date, to_date, windows)
+        log.info("Partitioned query: {0} rows in {1} windows".format(row_count, len(bounds) - 1))
+
+        queries = []
+        for index in range(len(bounds) - 1):
+            window_conditions = list(conditions or [])
+            if index > 0:
+                window_conditions.append("(obs.begin_date >= '" + bounds[index] + "')")
+            if index < len(bounds) - 2:
+                window_conditions.append("(obs.begin_date < '" + bounds[index + 1] + "')")
+            # __end_if
+            # Rows inserted after the COUNT query still fit in the window
+            queries.append(self._build_observations_query(instruments, from_date, to_date, window_conditions,
+                                                          closed=closed, columns=columns, order_by=order_by,
+                                                          top=row_count + int(target_rows)))
+        # __end_for
+
+        with ThreadPoolExecutor(max_workers=min(int(workers), len(queries))) as executor:
+            # Windows run concurrently and are collected in begin_date order
+            tables = [future.result() for future in [executor.submit(self._launch_query, query, use_cache,
+                                                                     refresh_cache)
+                                                     for query in queries]]
+        # __end_with
+        non_empty = [table for table in tables if len(table) > 0]
+        if len(non_empty) == 0:
+            return tables[0]
+        return vstack(non_empty, join_type='exact', metadata_conflicts='silent')
+
+    # _end_of_query_observations_partitioned
+
+    def _query_observations_incremental(self, instruments, from_date, to_date, partitioned=False,
+                                        target_rows=None, workers=None, columns=None, conditions=None):
+        """
+        Answers query_p2sa_observations from the time-range cache, fetching only
+        the parts of [from_date, to_date) that are not cached yet. Observations are
+        cached per set of instruments, columns and filter conditions. Gaps are fetched
+        in pages of target_rows observations, or as partitioned queries. Errors are
+        raised
+
+        Returns
+        -------
+        A table object sorted by begin_date
+        """
+        if target_rows is None:
+            target_rows = conf.PARTITION_TARGET_ROWS
+        # __end_if
+        columns = self._check_columns(columns)
+        # The cache needs the oid and the dates of the observations
+        fetched = columns + [name for name in ('observation_oid', 'begin_date', 'end_date') if name not in columns]
+        cache = self._get_range_cache()
+        key = cache.key(instruments, fetched, conditions)
+        start = cache.to_datetime(from_date, start=True)
+        end = cache.to_datetime(to_date, start=False)
+        if end <= start:
+            raise ValueError("The end of the range must be after its start")
+        # __end_if
+
+        for gap_start, gap_end in cache.missing(key, start, end):
+            gap_from = cache.to_text(gap_start)
+            gap_to = cache.to_text(gap_end)
+            log.info("Fetching observations from '{0}' to '{1}'".format(gap_from, gap_to))
+            # Observations ending exactly at the start of the gap are fetched as well:
+            # they belong to any range starting earlier
+            if partitioned:
+                table = self._query_observations_partitioned(instruments, gap_from, gap_to, target_rows, workers,
+                                                             use_cache=False, closed=True, columns=fetched,
+                                                             conditions=conditions)
+            else:
+                table = self._query_observations_paged(instruments, gap_from, gap_to, target_rows, closed=True,
+                                                       columns=fetched, conditions=conditions)
+            # __end_if
+            cache.add(key, gap_start, gap_end, table)
+        # __end_for
+        result = cache.select(key, start, end)
+        return result if fetched == columns else result[columns]
+
+    # _end_of_query_observations_incremental
+
+    def _query_observations_paged(self, instruments, from_date, to_date, page_rows, closed=False, columns=None,
+                                  conditions=None):
+        """
+        Runs query_p2sa_observations as consecutive TOP page_rows ... OFFSET queries
+        sorted by begin_date and observation_oid, until a page is not full. Errors are
+        raised
+
+        Returns
+        -------
+        A table object sorted by begin_date
+        """
+        if int(page_rows) < 1:
+            raise ValueError("Value for parameter 'page_rows' must be positive")
+        # __end_if
+        tables = []
+        while True:
+            query = self._build_observations_query(instruments, from_date, to_date, conditions, closed=closed,
+                                                   columns=columns, top=int(page_rows),
+                                                   offset=len(tables) * int(page_rows))
+            tables.append(self._launch_query(query, use_cache=False))
+            if len(tables[-1]) < int(page_rows):
+                break
+            # __end_if
+        # __end_while
+        non_empty = [table for table in tables if len(table) > 0]
+        if len(non_empty) <= 1:
+            return non_empty[0] if non_empty else tables[0]
+        return vstack(non_empty, join_type='exact', metadata_conflicts='silent')
+
+    # _end_of_query_observations_paged
+
+    @staticmethod
+    def _partition_bounds(from_date, to_date, windows):
+        """
+        Splits [from_date, to_date) in at most windows intervals of the same length
+
+        Returns
+        -------
+        Sorted list of distinct dates, formatted as 'yyyy-mm-dd hh:mm:ss', from from_date to to_date
+        """
+        start, end = np.array([from_date, to_date], dtype='datetime64[s]')
+        if end <= start:
+            raise ValueError("The end of the range must be after its start")
+        # __end_if
+        offsets = np.round(np.linspace(0, (end - start).astype(np.int64), int(windows) + 1)).astype(np.int64)
+        dates = start + np.unique(offsets).astype('timedelta64[s]')
+        return [str(date).replace("T", " ") for date in dates]
+
+    # _end_of_partition_bounds
+
+    def _launch_query(self, query, use_cache=True, refresh_cache=False):
+        """
+        Runs a synchronous ADQL query. Unlike query_p2sa_tap, errors are raised
+        """
+        return self._cached_query(query, 'votable', use_cache, refresh_cache,
+                                  lambda: self.launch_job(query=query).get_results(),
+                                  self._get_row_limit(query, "sync"))
+
+    # _end_of_launch_query
+
+    def _plan_query(self, query, count_query, execution="auto", top=None, offset=None, partitionable=False,
+                    use_cache=True, refresh_cache=False):
+        """
+        Runs count_query, the COUNT(*) query of query, and chooses the execution of
+        query in 'auto' mode. top and offset limit the rows returned by query.
+        Errors are raised
+
+        Returns
+        -------
+        A QueryPlan
+        """
+        row_count = int(self._launch_query(count_query, use_cache, refresh_cache)["row_count"][0])
+        row_count = max(0, row_count - int(offset or 0))
+        if top is not None:
+            row_count = min(row_count, int(top))
+        # __end_if
+
+        if execution in ("sync", "async", "partitioned"):
+            pass
+        elif execution != "auto":
+            raise ValueError("Unknown execution '{0}'".format(execution))
+        elif row_count <= conf.SYNC_MAX_ROWS:
+            execution = "sync"
+        elif row_count > conf.ASYNC_MAX_ROWS and partitionable:
+            execution = "partitioned"
+        else:
+            execution = "async"
+        # __end_if
+        log.info("Query plan: {0} rows, {1} execution".format(row_count, execution))
+        return QueryPlan(query, count_query, row_count, execution)
+
+    # _end_of_plan_query
+
+    def _execute_planned(self, query, count_query, execution, output_format='votable', top=None, offset=None,
+                         partition=None, use_cache=True, refresh_cache=False, parser=None, filename=None,
+                         **job_arguments):
+        """
+        Runs query as a synchronous job, an asynchronous job or, with partition, the
+        function running the partitioned version of query, as a partitioned query.
+        'auto' execution is planned with count_query, unless top (or the TOP of
+        query) is small enough for a synchronous job, and falls back to a synchronous
+        job if the COUNT(*) query fails. Errors are raised
+
+        Responses are decoded in memory by parser(body, output_format), or by the
+        astropy reader of output_format without parser. With filename, the response
+        is saved to that file while it is read. job_arguments, such as uploads, are
+        passed to launch_job, which decodes the response itself
+
+        Returns
+        -------
+        A table object
+        """
+        execution = self._choose_execution(query, count_query, execution, top, offset, partition is not None,
+                                           use_cache, refresh_cache)
+        if execution == "partitioned":
+            table = partition()
+            if filename and table is not None:
+                # Windows are read apart, the file is written from the merged table
+                table.write(filename, format='votable', overwrite=True)
+            # __end_if
+            return table
+        elif job_arguments and execution == "async":
+            return self.launch_job_async(query=query, output_format=output_format, **job_arguments).get_results()
+        elif job_arguments and execution == "sync":
+            return self.launch_job(query=query, output_format=output_format, **job_arguments).get_results()
+        elif execution == "async":
+            with TapJobManager(self) as manager:
+                return manager.fetch(manager.submit(query, output_format), output_format, parser, filename)
+            # __end_with
+        elif execution == "sync":
+            if parser is None:
+                # Same rows as launch_job
+                query = taputils.set_top_in_query(query, SYNC_TOP)
+                parser = parse_table
+            # __end_if
+            return parser(self._launch_query_response(query, output_format, filename), output_format)
+        # __end_if
+        raise ValueError("Unknown execution '{0}'".format(execution))
+
+    # _end_of_execute_planned
+
+    def _choose_execution(self, query, count_query, execution, top=None, offset=None, partitionable=False,
+                          use_cache=True, refresh_cache=False):
+        """
+        Resolves the 'auto' execution of query. It is planned with count_query, unless
+        top (or the TOP of query) is small enough for a synchronous job, and falls back
+        to a synchronous job if the COUNT(*) query fails. Without partitionable,
+        'partitioned' is planned as 'auto'
+
+        Returns
+        -------
+        'sync', 'async' or 'partitioned'
+        """
+        if execution == "partitioned" and not partitionable:
+            execution = "auto"
+        # __end_if
+        if top is None:
+            top = self._get_query_top(query)
+        # __end_if
+        if execution == "auto" and top is not None and top <= conf.SYNC_MAX_ROWS:
+            execution = "sync"
+        elif execution == "auto":
+            try:
+                execution = self._plan_query(query, count_query, "auto", top, offset, partitionable,
+                                             use_cache, refresh_cache).execution
+            except (IOError, KeyError, IndexError, ValueError) as e:
+                log.warning("Rows of the query cannot be counted, it runs synchronously: {0}".format(e))
+                execution = "sync"
+            # __end_try
+        # __end_if
+        return execution
+
+    # _end_of_choose_execution
+
+    def _launch_query_response(self, query, output_format='votable', filename=None):
+        """
+        Runs a synchronous ADQL query and returns the body of the response, without
+        decoding it. With filename, the body is saved to that file while it is read.
+        Unlike launch_job, no TOP is added to the query. Errors are raised
+        """
+        response = self._open_query_response(query, output_format)
+        try:
+            if not filename:
+                return response.read()
+            # __end_if
+            with open(filename, 'wb') as fh:
+                return read_response(response, fh)
+            # __end_with
+        finally:
+            response.close()
+        # __end_try
+
+    # _end_of_launch_query_response
+
+    def _open_query_response(self, query, output_format='votable'):
+        """
+        Runs a synchronous ADQL query and returns its response before reading the
+        body, so that it can be decoded while it is downloaded. No TOP is added to
+        the query. Errors are raised
+        """
+        connection = self._Tap__connHandler
+        data = urlencode({"REQUEST": "doQuery", "LANG": "ADQL", "FORMAT": str(output_format),
+                          "tapclient": str(TAP_CLIENT_ID), "PHASE": "RUN", "QUERY": str(query)})
+        response = connection.execute_tappost("sync", data)
+        redirects = 0
+        while response.status in (302, 303) and redirects < 20:
+            location = connection.find_header(response.getheaders(), "location")
+            response.read()
+            response = connection.execute_tapget(location)
+            redirects = redirects + 1
+        # __end_while
+        if response.status != 200:
+            response.read()
+            raise IOError("Error running the query: HTTP {0} {1}".format(response.status, response.reason))
+        # __end_if
+        return response
+
+    # _end_of_open_query_response
 
-        input_toDate: String
-            TBD
-        filename : string
-            file name to be used to store the metadata, optional, default None
-        output_format : array of string
-            optional, default 'votable'
-            output format of the query
-        verbose : bool
-            optional, default 'False'
-            Flag to display information about the process
+    @staticmethod
+    def _get_query_top(query):
+        """
+        Returns the TOP of the outermost SELECT of an ADQL query, None if it has none
+        """
+        match = re.match(r"\s*SELECT\s+(?:(?:ALL|DISTINCT)\s+)?TOP\s+(\d+)\s", query, re.I)
+        return None if match is None else int(match.group(1))
 
-        Returns
-        -------
-        Table with the result of the query. It downloads metadata as a file.
+    # _end_of_get_query_top
 
+    def _get_row_limit(self, query, execution):
+        """
+        Returns the rows query is capped at when run with a resolved execution: the
+        TOP added to synchronous jobs, None if query has a TOP of its own or is not
+        run synchronously
+        """
+        if execution == "sync" and self._get_query_top(query) is None:
+            return SYNC_TOP
+        # __end_if
+        return None
 
-        Examples
-        --------
-        REQUEST=doQuery&LANG=ADQL&FORMAT=json&QUERY=SELECT+*+FROM+v_observation+ WHERE+((instrument_name='SWAP')+OR+(instrument_name='LYRA'))+AND+begin_date>'2017-01-07'&PAGE=1&PAGE_SIZE=1000
+    # _end_of_get_row_limit
 
+    @staticmethod
+    def _build_count_query(query):
         """
+        Builds the query counting the rows returned by an ADQL query
+        """
+        return "SELECT COUNT(*) AS row_count FROM (" + query.strip().rstrip(";") + ") AS counted"
 
-        # Default values for variables
-        # -----------------------------------
+    # _end_of_build_count_query
 
+    @staticmethod
+    def _build_observations_query(instruments, from_date, to_date, conditions=None, count=False, closed=False,
+                                  columns=None, order_by=DEFAULT_ORDER, top=None, offset=None):
+        """
+        Builds the ADQL query over p2sa.v_observation used by query_p2sa_observations.
+        The optional conditions are added to the WHERE clause. With count, the query
+        returns the number of matching rows in a column named row_count. With closed,
+        observations ending exactly at from_date are selected too. columns, order_by,
+        top and offset are the ones of query_p2sa_observations
+        """
         where_condition = " WHERE "
         where_instrument_condition = ""
         where_date_condition = ""
 
         instruments_query_pattern = "(instrument_name='@instrument@')"
         instrument_pattern = "@instrument@"
-        from_date_query_pattern = "(obs.end_date > '@date@')"
+        from_date_query_pattern = "(obs.end_date >= '@date@')" if closed else "(obs.end_date > '@date@')"
         date_pattern = "@date@"
         to_date_query_pattern = "(obs.begin_date < '@date@')"
         instruments_query_string = ""
         from_date_query_string = ""
         to_date_query_string = ""
-        verbose = False
-        filename = ""
-        from_date = ""
-        to_date = ""
-        instruments = ""
-        output_format = "csv"
-
-        # Load variables values from the call
-        # -----------------------------------
-        for kwarg in kwargs:
-            if kwarg == "instruments":
-                instruments = kwargs[kwarg]
-            elif kwarg == "from_date":
-                from_date = kwargs[kwarg]
-            elif kwarg == "to_date":
-                to_date = kwargs[kwarg]
-            elif kwarg == "output_format":
-                output_format = kwargs[kwarg]
-            elif kwarg == "filename":
-                filename = kwargs[kwarg]
-            elif kwarg == "verbose":
-                verbose = kwargs[kwarg]
-            # print current value
-            print(kwarg, "=>", kwargs[kwarg])
 
         # Query Pattern
         # -----------------------------------
-        initial = "REQUEST=doQuery&LANG=ADQL&FORMAT=" + str(output_format) + "&PHASE=RUN"
-        query = "SELECT obs.observation_oid, obs.instrument_name, obs.observation_type, obs.begin_date, " \
-                "obs.end_date, obs.processing_level, obs.science_objective, obs.wavelength_range, " \
-                "obs.science_object_name, obs.file_name, obs.file_format, obs.file_size, obs.observatory_name, " \
-                "obs.calibrated FROM p2sa.v_observation as obs "
-        final = " ORDER BY obs.begin_date ASC"
+        select = "SELECT " if top is None else "SELECT TOP {0} ".format(int(top))
+        query = select + ", ".join("obs." + column for column in ESAP2SAClass._check_columns(columns)) + \
+                " FROM p2sa.v_observation as obs "
+        final = ESAP2SAClass._build_order_clause(order_by, offset)
+        if count:
+            query = "SELECT COUNT(*) AS row_count FROM p2sa.v_observation as obs "
+            final = ""
+        # __end_if
 
         #  Check parameter values
         # -----------------------------------
@@ -846,65 +2075,121 @@ class ESAP2SAClass(TapPlus):
             where_date_condition = where_date_condition + from_date_query_string
 
         # Add final where date condition
-        if instruments_query_string:
+        if instruments_query_string and where_date_condition:
             query = query + " AND " + where_date_condition
         else:
             query = query + where_date_condition
 
-        # # build metadata search query
-        # metadata_query = initial + "&QUERY=" + query + final
-        #
-        # # Encode metadata query
-        # encoded_metadata_query = self.encode_string_if_needed(metadata_query)
-        #
-        # # Build final query
-        # link = self.metadata_url + encoded_metadata_query
+        # Add the extra conditions
+        has_where = bool(instruments or from_date or to_date)
+        for condition in conditions or []:
+            query = query + (" AND " if has_where else where_condition) + condition
+            has_where = True
+        # __end_for
 
-        link = query + final
+        return query + final
 
-        ########################################################
-        # The following lines are only for debug purposes
-        ########################################################
-        log.info("Metadata Query: %s" % link)
-        ########################################################
+    # _end_of_build_observations_query
 
-        try:
-            # Launch the request to P2SA tap
-            result = self.execute_query(link, filename)
+    @staticmethod
+    def _check_columns(columns):
+        """
+        Returns the column names to select, OBSERVATION_COLUMNS if columns is None.
+        Names must be plain ADQL identifiers
+        """
+        if columns is None:
+            return list(OBSERVATION_COLUMNS)
+        if isinstance(columns, str):
+            columns = [column.strip() for column in columns.split(",")]
+        # __end_if
+        columns = list(columns)
+        if len(columns) == 0:
+            raise ValueError("At least one column must be selected")
+        for column in columns:
+            if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", str(column)):
+                raise ValueError("Invalid column name '{0}'".format(column))
+        # __end_for
+        return columns
+
+    # _end_of_check_columns
+
+    @staticmethod
+    def _build_order_clause(order_by, offset=None):
+        """
+        Builds the ORDER BY and OFFSET clauses. order_by is a column name or a list of
+        them, each one optionally followed by ASC or DESC. None does not sort. When
+        paging with offset, observation_oid is added to the sort to make pages stable
+        """
+        if not order_by:
+            order_by = []
+        elif isinstance(order_by, str):
+            order_by = [order_by]
+        # __end_if
 
-            if result is not None:
-                # if filename is None:
-                #    filename = "p2sa_observations"
-                # __end_if
-                if verbose:
-                    log.info("[get_p2sa_observation()] Wrote {0} to {1}".format(link, filename))
-                # __end_if
-                # return self.get_table(filename, response=result, output_format=output_format)
-                return result
+        terms = []
+        names = []
+        for term in order_by:
+            match = re.match(r"^\s*([A-Za-z_][A-Za-z0-9_]*)(?:\s+(ASC|DESC))?\s*$", str(term), re.I)
+            if match is None:
+                raise ValueError("Invalid sort term '{0}'".format(term))
+            # __end_if
+            names.append(match.group(1))
+            terms.append("obs." + match.group(1) + " " + (match.group(2) or "ASC").upper())
+        # __end_for
+
+        if offset is None:
+            return " ORDER BY " + ", ".join(terms) if terms else ""
+        if int(offset) < 0:
+            raise ValueError("Value for parameter 'offset' must not be negative")
+        if "observation_oid" not in names:
+            terms.append("obs.observation_oid ASC")
+        # __end_if
+        return " ORDER BY " + ", ".join(terms) + " OFFSET {0}".format(int(offset))
+
+    # _end_of_build_order_clause
+
+    @staticmethod
+    def _build_filter_conditions(filters):
+        """
+        Builds the WHERE conditions of the filters of query_p2sa_observations.
+        Text filters take a value or a list of values, calibrated a bool and
+        min_file_size / max_file_size a number of bytes
+        """
+        unknown = set(filters or {}) - set(OBSERVATION_FILTERS)
+        if unknown:
+            raise ValueError("Unknown filters {0}".format(sorted(unknown)))
+        # __end_if
+
+        conditions = []
+        for name in OBSERVATION_FILTERS:
+            value = (filters or {}).get(name)
+            if value is None:
+                continue
+            elif name == "calibrated":
+                conditions.append("(obs.calibrated = '{0}')".format("true" if value else "false"))
+            elif name == "min_file_size":
+                conditions.append("(obs.file_size >= {0})".format(int(value)))
+            elif name == "max_file_size":
+                conditions.append("(obs.file_size <= {0})".format(int(value)))
+            elif isinstance(value, str):
+                conditions.append("(obs.{0} = {1})".format(name, ESAP2SAClass._quote_literal(value)))
             else:
-                log.error("Error occurred when downloading the requested observation")
+                values = ", ".join(ESAP2SAClass._quote_literal(item) for item in value)
+                if not values:
+                    raise ValueError("Empty list of values for filter '{0}'".format(name))
+                conditions.append("(obs.{0} IN ({1}))".format(name, values))
             # __end_if
-        except IOError as e:
-            log.error('An error occurred trying to read the file.')
-            log.error(e)
-        except ValueError as e:
-            log.error('Error found in Value')
-            log.error(e)
-        except ImportError as e:
-            log.error("NO module found")
-            log.error(e)
-        except EOFError as e:
-            log.error('EOF found!!')
-            log.error(e)
-        except KeyboardInterrupt as e:
-            log.error('Operation cancelled by User')
-            log.error(e)
-        # except:
-        # log.error("Error. Please review your request", str(sys.exc_info()[0]), "occurred.")
+        # __end_for
+        return conditions
 
-    # _end_of_query_p2sa_observations
+    # _end_of_build_filter_conditions
 
-    def query_p2sa_tap(self, query, output_file=None, output_format='votable', verbose=False, dump_to_file=False):
+    @staticmethod
+    def _quote_literal(value):
+        return "'" + str(value).replace("'", "''") + "'"
+
+    def query_p2sa_tap(self, query, output_file=None, output_format='votable', verbose=False, dump_to_file=False,
+                       use_cache=True, refresh_cache=False, execution=None, dry_run=False):
 
         """Launches a synchronous job to query the P2SA tap
 
@@ -920,19 +2205,54 @@ class ESAP2SAClass(TapPlus):
         verbose : bool, optional, default 'False'
             flag to display information about the process
         dump_to_file: boolean, optional.
+        use_cache : bool, optional, default True
+            serve the result from the query cache, if the client has one, and store
+            it there. Queries dumped to a file always go to the server
+        refresh_cache : bool, optional, default False
+            run the query on the server even if its result is cached, and cache
+            the new result
+        execution : str, optional, default conf.QUERY_EXECUTION
+            'sync' runs a synchronous job and 'async' an asynchronous one. 'auto' (and
+            'partitioned') first counts the rows of the query with
+            SELECT COUNT(*) FROM (query) and runs it asynchronously when more than
+            conf.SYNC_MAX_ROWS rows are expected. Cached results are returned without
+            COUNT(*) query
+        dry_run : bool, optional, default False
+            only run the COUNT(*) query and return the QueryPlan (query, count_query,
+            row_count, execution) of the query instead of its result
 
         Returns
         -------
         A table object
         """
         try:
-            job = self.launch_job(query=query,
-                                  output_file=output_file,
-                                  output_format=output_format,
-                                  verbose=verbose,
-                                  dump_to_file=dump_to_file)
-            table = job.get_results()
-            return table
+            if execution is None:
+                execution = conf.QUERY_EXECUTION
+            if dump_to_file:
+                use_cache = False
+            # __end_if
+            count_query = self._build_count_query(query)
+            if dry_run:
+                return self._plan_query(query, count_query, execution, use_cache=use_cache,
+                                        refresh_cache=refresh_cache)
+            # __end_if
+            job_arguments = {}
+            if dump_to_file and not output_file:
+                # The file is named after the job by launch_job
+                job_arguments = dict(output_file=output_file, verbose=verbose, dump_to_file=dump_to_file)
+            # __end_if
+            filename = output_file if dump_to_file else None
+            # Resolved first, synchronous results are cached apart from complete ones
+            execution = self._choose_execution(query, count_query, execution, use_cache=use_cache,
+                                               refresh_cache=refresh_cache)
+            return self._cached_query(query, output_format, use_cache, refresh_cache,
+                                      lambda: self._execute_planned(query, count_query, execution,
+                                                                    output_format=output_format,
+                                                                    use_cache=use_cache,
+                                                                    refresh_cache=refresh_cache,
+                                                                    filename=filename,
+                                                                    **job_arguments),
+                                      self._get_row_limit(query, execution))
         except IOError as e:
             log.error('An error occurred trying to read the file.')
             log.error(e)
@@ -953,7 +2273,192 @@ class ESAP2SAClass(TapPlus):
 
     # __end_queryP2SATap
 
-    def get_p2sa_tables(self, only_names=True, verbose=False):
+    def iter_query(self, query, batch_size=None, execution=None, parser=None):
+        """
+        Runs an ADQL query and yields its result in tables of batch_size rows, each
+        one decoded while the rest of the response is still being downloaded.
+        Memory holds about one batch whatever the number of rows.
+
+        Parameters
+        ----------
+        query : str, mandatory
+            query (adql) to be executed
+        batch_size : int, optional, default conf.ITER_BATCH_SIZE
+            number of rows of each table. The last one may have fewer
+        execution : str, optional, default conf.QUERY_EXECUTION
+            'sync' reads the response of a synchronous query, to which no TOP is added,
+            and 'async' the result of an asynchronous job, deleted once it is read or
+            the generator is closed. 'auto' chooses from the COUNT(*) query of query,
+            'partitioned' is the same as 'auto'
+        parser : function, optional, default None
+            decoder of the CSV body of each batch, called as parser(body, 'csv').
+            The astropy CSV reader is used if not provided, which guesses the type of
+            each column from the values of each batch
+
+        Returns
+        -------
+        A generator of table objects. Errors are raised
+        """
+        if query is None:
+            raise ValueError("Value for mandatory parameter 'query' is missed")
+        # __end_if
+        if execution is None:
+            execution = conf.QUERY_EXECUTION
+        # __end_if
+        return self._iter_query(query, self._build_count_query(query), batch_size, execution, parser)
+
+    # __end_of_iter_query
+
+    def _iter_query(self, query, count_query, batch_size=None, execution="auto", parser=None, top=None,
+                    offset=None):
+        """
+        Generator of iter_query and iter_p2sa_observations. The result is requested
+        as CSV and split into batches by iter_csv_batches
+        """
+        if batch_size is None:
+            batch_size = conf.ITER_BATCH_SIZE
+        # __end_if
+        if parser is None:
+            parser = parse_table
+        # __end_if
+        execution = self._choose_execution(query, count_query, execution, top, offset)
+        if execution == "sync":
+            response = self._open_query_response(query, 'csv')
+            try:
+                for table in iter_csv_batches(response, batch_size, parser):
+                    yield table
+                # __end_for
+            finally:
+                response.close()
+            # __end_try
+        elif execution == "async":
+            with TapJobManager(self) as manager:
+                response = manager.open_result(manager.submit(query, 'csv'))
+                try:
+                    for table in iter_csv_batches(response, batch_size, parser):
+                        yield table
+                    # __end_for
+                finally:
+                    response.close()
+                # __end_try
+            # __end_with
+        else:
+            raise ValueError("Unknown execution '{0}'".format(execution))
+        # __end_if
+
+    # _end_of_iter_query
+
+    def query_p2sa_tap_jobs(self, queries, output_format='votable', workers=None, delete=True):
+        """Runs many queries as asynchronous jobs of the P2SA tap, concurrently
+
+        Every query is submitted at once and the results are fetched as the jobs
+        end, see TapJobManager.
+
+        Parameters
+        ----------
+        queries : list of str, mandatory
+            queries (adql) to be executed
+        output_format : str, optional, default 'votable'
+            results format
+        workers : int, optional, default conf.TAP_JOB_WORKERS
+            number of jobs followed and fetched at the same time
+        delete : bool, optional, default True
+            delete the jobs from the server once their results are read
+
+        Returns
+        -------
+        List of JobResult(query, jobid, table, duration, error) in the order of queries
+        """
+        return TapJobManager(self, workers=workers).run(queries, output_format=output_format, delete=delete)
+
+    # __end_of_query_p2sa_tap_jobs
+
+    def query_p2sa_oids(self, oids, table='p2sa.v_observation', columns=None, key='observation_oid',
+                        output_format='votable', execution='auto'):
+        """Selects the rows of a P2SA table matching a list of oids, in one query
+
+        The oids are uploaded with the query as a temporary table and joined with
+        table on the server, so that thousands of oids take one request instead
+        of one query each.
+
+        Parameters
+        ----------
+        oids : list of int, mandatory
+            oids to select, repetitions are ignored
+        table : str, optional, default 'p2sa.v_observation'
+            table joined with the oids, 'p2sa.v_observation' or 'p2sa.file'
+        columns : str or list of str, optional, default all the columns
+            columns of table to return
+        key : str, optional, default 'observation_oid'
+            column of table matched with the oids, e.g. 'file_oid' for p2sa.file
+        output_format : str, optional, default 'votable'
+            results format
+        execution : str, optional, default 'auto'
+            'sync' runs a synchronous job and 'async' an asynchronous one. 'auto'
+            runs a synchronous job when key is the primary key of table and there
+            are no more than conf.SYNC_MAX_ROWS oids, an asynchronous one otherwise.
+            Synchronous jobs may be truncated when key is not the primary key
+
+        Returns
+        -------
+        A table object sorted by key. Errors are raised
+        """
+        if oids is None:
+            raise ValueError("Value for mandatory parameter 'oids' is missed")
+        # __end_if
+        if not table.startswith("p2sa."):
+            table = "p2sa." + table
+        # __end_if
+        if table not in UPLOAD_JOIN_TABLES:
+            raise ValueError("Table '{0}' cannot be joined with a list of oids".format(table))
+        # __end_if
+        key = self._check_columns([key])[0]
+        oids = np.unique(np.asarray(list(oids), dtype=np.int64))
+        if len(oids) == 0:
+            raise ValueError("Value for mandatory parameter 'oids' is missed")
+        # __end_if
+
+        unique = key == UPLOAD_JOIN_TABLES[table]
+        if execution == "auto":
+            execution = "sync" if unique and len(oids) <= conf.SYNC_MAX_ROWS else "async"
+        # __end_if
+        upload = Table([oids], names=(key,))
+        log.debug("Joining {0} oids with {1} in a {2} job".format(len(oids), table, execution))
+
+        if execution == "sync":
+            # With one row per oid, an explicit TOP keeps launch_job from truncating the result
+            query = self._build_upload_join_query(table, key, columns, len(oids) if unique else None)
+            return self.launch_job(query=query, output_format=output_format, upload_resource=upload,
+                                   upload_table_name=UPLOAD_TABLE_NAME).get_results()
+        elif execution == "async":
+            query = self._build_upload_join_query(table, key, columns)
+            with TapJobManager(self) as manager:
+                job = manager.submit(query, output_format, upload_resource=upload,
+                                     upload_table_name=UPLOAD_TABLE_NAME)
+                return manager.fetch(job, output_format)
+            # __end_with
+        # __end_if
+        raise ValueError("Unknown execution '{0}'".format(execution))
+
+    # __end_of_query_p2sa_oids
+
+    @staticmethod
+    def _build_upload_join_query(table, key, columns=None, top=None):
+        """
+        Builds the ADQL query joining table with the uploaded table of oids on key
+        """
+        if columns is None:
+            selection = "obs.*"
+        else:
+            selection = ", ".join("obs." + column for column in ESAP2SAClass._check_columns(columns))
+        # __end_if
+        return ("SELECT " + ("" if top is None else "TOP {0} ".format(int(top))) + selection +
+                " FROM " + table + " AS obs JOIN tap_upload." + UPLOAD_TABLE_NAME + " AS up ON up." + key +
+                " = obs." + key + " ORDER BY obs." + key)
+
+    # _end_of_build_upload_join_query
+
+    def get_p2sa_tables(self, only_names=True, verbose=False, refresh=False):
         """Get the available table in P2SA TAP service
         Parameters
         ----------
@@ -961,14 +2466,15 @@ class ESAP2SAClass(TapPlus):
             True to load table names only
         verbose : bool, optional, default 'False'
             flag to display information about the process
+        refresh : bool, optional, default 'False'
+            reload the tables from the service instead of the schema catalog
         Returns
         -------
         A list of tables
         """
 
-        tables = self.load_tables(only_names=only_names,
-                                  include_shared_tables=False,
-                                  verbose=verbose)
+        tables = self.schema_catalog.tables(self._get_tap_url(), self._schema_loader(verbose),
+                                            only_names=only_names, refresh=refresh)
         if only_names is True:
             table_names = []
             for t in tables:
@@ -979,7 +2485,7 @@ class ESAP2SAClass(TapPlus):
 
     # __end_getTables
 
-    def get_p2sa_columns(self, table_name, only_names=True, verbose=False):
+    def get_p2sa_columns(self, table_name, only_names=True, verbose=False, refresh=False):
         """Get the available columns for a table in P2SA TAP service
         Parameters
         ----------
@@ -989,19 +2495,16 @@ class ESAP2SAClass(TapPlus):
             True to load table names only
         verbose : bool, optional, default 'False'
             flag to display information about the process
+        refresh : bool, optional, default 'False'
+            reload the tables from the service instead of the schema catalog
         Returns
         -------
         A list of columns
         """
 
-        tables = self.load_tables(only_names=False,
-                                  include_shared_tables=False,
-                                  verbose=verbose)
-        columns = None
-        for t in tables:
-            if str(t.name) == str(table_name):
-                columns = t.columns
-                break
+        table = self.schema_catalog.table(self._get_tap_url(), table_name, self._schema_loader(verbose),
+                                          refresh=refresh)
+        columns = None if table is None else table.columns
 
         if columns is None:
             raise ValueError("table name specified is not found in "
@@ -1017,10 +2520,31 @@ class ESAP2SAClass(TapPlus):
 
     # __end_getColumns
 
-    def get_file(self, filename, response):
+    def _get_tap_url(self):
+        """
+        Returns the url of the TAP service, the key of its schema catalog
+        """
+        return "{0}/{1}/tap".format(self.p2sa_url.rstrip("/"), self.server_context)
+
+    # __end_of_get_tap_url
+
+    def _schema_loader(self, verbose=False):
+        """
+        Returns the function loading the tables of the TAP service for the schema catalog
+        """
+        return lambda only_names: self.load_tables(only_names=only_names, include_shared_tables=False,
+                                                   verbose=verbose)
+
+    # __end_of_schema_loader
+
+    def get_file(self, filename, response, chunk_size=None):
 
         """
-        This method parses the request response into a file.
+        This method streams the request response into a file.
+
+        The body is copied in chunks of ``chunk_size`` bytes through a single
+        reusable buffer, so memory usage stays flat whatever the size of the
+        downloaded product.
 
         Parameters
         ----------
@@ -1029,12 +2553,18 @@ class ESAP2SAClass(TapPlus):
 
         response: String
             output response from P2SA Tap server
+
+        chunk_size: int, optional, default conf.DOWNLOAD_CHUNK_SIZE
+            size in bytes of the buffer used to stream the response
+
+        Returns
+        -------
+        Number of bytes written to the file
         """
 
         try:
             with open(filename, 'wb') as fh:
-                response_content = response.read()
-                fh.write(response_content)
+                written_bytes = stream_response(response, fh, chunk_size)
 
             if os.pathsep not in filename:
                 log.info("File {0} downloaded to current "
@@ -1042,6 +2572,8 @@ class ESAP2SAClass(TapPlus):
             else:
                 log.info("File {0} downloaded".format(filename))
 
+            return written_bytes
+
         except IOError as e:
             log.error('An error occurred trying to read the file.')
             log.error(e)
@@ -1058,7 +2590,7 @@ class ESAP2SAClass(TapPlus):
             log.error('Operation cancelled by User')
             log.error(e)
         except:
-            log.error("Error. Please review your request", str(sys.exc_info()[0]), "occurred.")
+            log.error("Error. Please review your request. {0} occurred.".format(str(sys.exc_info()[0])))
 
     # end_of_get_file
 
@@ -1067,11 +2599,14 @@ class ESAP2SAClass(TapPlus):
         """
         This method parses the response into a formatted table.
 
+        The response is decoded in memory. When a filename is given, the response
+        is also saved to that file while it is read, never read back from disk.
+
         Parameters
         ----------
 
         filename: String
-            name for the output file
+            name for the output file, None to keep the response in memory only
 
         response: String
             output response from P2SA Tap server
@@ -1084,43 +2619,67 @@ class ESAP2SAClass(TapPlus):
         table in the desired format
         """
         try:
-            with open(filename, 'wb') as fh:
-                response_content = response.read()
-                fh.write(response_content)
+            if filename:
+                with open(filename, 'wb') as fh:
+                    body = read_response(response, fh)
+                # __end_with
+            else:
+                body = read_response(response)
+            # __end_if
 
-            table = modelutils.read_results_table_from_file(filename,
-                                                            str(output_format))
+            table = parse_table(body, str(output_format))
             return table
-        except IOError:
+        except IOError as e:
             log.error('An error occurred trying to read the file.')
-            log.error(IOError.get('message'))
-        except ValueError:
+            log.error(e)
+        except ValueError as e:
             log.error('Error found in Value')
-            log.error(ValueError.get('message'))
-        except ImportError:
+            log.error(e)
+        except ImportError as e:
             log.error("NO module found")
-            log.error(ImportError.get('message'))
-        except EOFError:
+            log.error(e)
+        except EOFError as e:
             log.error('EOF found!!')
-            log.error(EOFError.get('message'))
-        except KeyboardInterrupt:
+            log.error(e)
+        except KeyboardInterrupt as e:
             log.error('Operation cancelled by User')
-            log.error(KeyboardInterrupt.get('message'))
+            log.error(e)
         except:
-            log.error("Error. Please review your request", str(sys.exc_info()[0]), "occurred.")
+            log.error("Error. Please review your request. {0} occurred.".format(str(sys.exc_info()[0])))
 
     # end_of_get_table
 
     # execute_query
-    def execute_query(self, link, filename=None):
+    def execute_query(self, link, filename=None, use_cache=True, refresh_cache=False, execution="sync",
+                      count_query=None, top=None, offset=None, partition=None):
         # Check if the user is already logged. If not the prompt for the login will be shown.
+        # Executions other than 'sync' are run by _execute_planned, see query_p2sa_observations
 
         try:
             # self.check_user_access()
             # result = self._Tap__connHandler._TapConn__execute_get(link)
-            job = self.launch_job(query=link, output_file=filename)
-            result = job.results
-            return result
+            # The response is decoded in memory and, with filename, saved while it is read
+            if count_query is None and execution != "sync":
+                count_query = self._build_count_query(link)
+            # __end_if
+            executed = []
+            # Resolved first, synchronous results are cached apart from complete ones
+            execution = self._choose_execution(link, count_query, execution, top, offset, partition is not None,
+                                               use_cache, refresh_cache)
+
+            def run():
+                executed.append(link)
+                return self._execute_planned(link, count_query, execution, top=top, offset=offset,
+                                             partition=partition, use_cache=use_cache, refresh_cache=refresh_cache,
+                                             filename=filename)
+
+            table = self._cached_query(link, 'votable', use_cache, refresh_cache, run,
+                                       self._get_row_limit(link, execution))
+            if filename and table is not None and not executed:
+                # Served from the query cache
+                table.write(filename, format='votable', overwrite=True)
+            # __end_if
+            return table
         except IOError as e:
             log.error('An error occurred trying to read the file.')
             log.error(e)
@@ -1137,9 +2696,7 @@ class ESAP2SAClass(TapPlus):
             log.error('Operation cancelled by User')
             log.error(e)
         except:
-            a = str(sys.exc_info()[0])
-            print(a)
-            log.error("Error. Please review your request", str(sys.exc_info()[0]), "occurred.")
+            log.error("Error. Please review your request, {0} occurred.".format(sys.exc_info()[0]))
 
     # __end_of_execute_query
 
@@ -1148,7 +2705,7 @@ class ESAP2SAClass(TapPlus):
 
         try:
             # self.check_user_access()
-            result = self._Tap__connHandler._TapConn__execute_get(link)
+            result = self._execute_get(link)
             return result
         except IOError as e:
             log.error('An error occurred trying to read the file.')
@@ -1170,6 +2727,151 @@ class ESAP2SAClass(TapPlus):
 
     # __end_of_execute_query
 
+    def _cached_query(self, query, output_format, use_cache, refresh_cache, run, row_limit=None):
+        """
+        Returns the result of query from the query cache or, on a miss, from run()
+        and stores it in the cache. row_limit is the number of rows run() is capped
+        at, see _get_row_limit, and is part of the cache key. Without a cache, or
+        with use_cache False, run() is called directly.
+        """
+        cache = self.query_cache
+        if cache is None or not use_cache:
+            return run()
+        # __end_if
+        if not refresh_cache:
+            table = cache.get(query, output_format, row_limit)
+            if table is not None:
+                log.info("Query result served from the query cache")
+                return table
+            # __end_if
+        # __end_if
+        table = run()
+        if table is not None:
+            cache.put(query, output_format, table, row_limit)
+        # __end_if
+        return table
+
+    # __end_of_cached_query
+
+    def _execute_get(self, link):
+        """
+        Sends a GET request for link through the transport. Unlike execute_download_query,
+        errors are raised instead of logged, and responses with an HTTP error status are rejected.
+        """
+        return self._open_url(link)
+
+    # __end_of_execute_get
+
+    @staticmethod
+    def _check_response(response, link):
+        """
+        Rejects missing responses and responses with an HTTP error status
+        """
+        if response is None:
+            raise IOError("No response received for {0}".format(link))
+        status = getattr(response, 'status', 200)
+        if status >= 400:
+            response.close()
+            raise HTTPStatusError(status, getattr(response, 'reason', ''), link)
+        return response
+
+    # __end_of_check_response
+
+    def _download_to_file(self, link, filename, chunk_size=None, resume=False, segments=None, cache_key=None,
+                          cache=None):
+        """
+        Streams the product behind link into filename. Errors are raised to the caller.
+
+        With resume, an interrupted previous attempt is continued with HTTP Range
+        requests (see p2sa_download.download_resumable). With segments, the product
+        is fetched over several parallel connections (see p2sa_download.download_segmented).
+        With cache_key, the product cache (or cache, when given) is looked up first
+        and filled afterwards.
+
+        Returns
+        -------
+        Number of bytes written to filename
+        """
+        if resume and segments:
+            raise ValueError("Parameters 'resume' and 'segments' cannot be combined")
+        # __end_if
+
+        if cache is None:
+            cache = self.product_cache
+        # __end_if
+
+        if cache is not None and cache_key is not None:
+            if cache.get(cache_key, filename):
+                return os.path.getsize(filename)
+        # __end_if
+
+        if segments:
+            written_bytes = download_segmented(link, filename, segments, chunk_size, opener=self._open_url)
+        elif resume:
+            written_bytes = download_resumable(link, filename, chunk_size, opener=self._open_url)
+        else:
+            response = self._execute_get(link)
+            try:
+                with open(filename, 'wb') as fh:
+                    written_bytes = stream_response(response, fh, chunk_size)
+                # __end_with
+            finally:
+                response.close()
+            # __end_try
+        # __end_if
+        log.info("File {0} downloaded".format(filename))
+
+        if cache is not None and cache_key is not None:
+            cache.put(cache_key, filename)
+        # __end_if
+        return written_bytes
+
+    # __end_of_download_to_file
+
+    def _extract_to_dir(self, link, target_dir, members=None, chunk_size=None, cache_key=None):
+        """
+        Unpacks the tar archive behind link into target_dir while it is downloaded
+        (see p2sa_download.extract_tar_stream). An archive already in the product
+        cache is unpacked from there without any request. Errors are raised to the caller.
+
+        Returns
+        -------
+        List with the paths of the extracted files
+        """
+        if self.product_cache is not None and cache_key is not None:
+            cached_path = self.product_cache.path(cache_key)
+            try:
+                os.utime(cached_path, None)
+                cached_file = open(cached_path, 'rb')
+            except (IOError, OSError):
+                cached_file = None
+            if cached_file is not None:
+                with cached_file:
+                    return extract_tar_stream(cached_file, target_dir, members, chunk_size)
+            # __end_if
+        # __end_if
+
+        response = self._execute_get(link)
+        try:
+            extracted = extract_tar_stream(response, target_dir, members, chunk_size)
+        finally:
+            response.close()
+        # __end_try
+        log.info("{0} files extracted to {1}".format(len(extracted), target_dir))
+        return extracted
+
+    # __end_of_extract_to_dir
+
+    def _open_url(self, link, headers=None, method="GET"):
+        """
+        Sends a request with custom headers (e.g. Range) to link through the transport.
+        Responses with an HTTP error status raise IOError
+        """
+        response = self.transport.request(method, link, headers=headers)
+        return self._check_response(response, link)
+
+    # __end_of_open_url
+
     def encode_string_if_needed(self, string_to_replace):
         """
         This method detects if there it is a search by prefix. In that case it will be necessary to encode the character
@@ -1228,4 +2930,18 @@ class ESAP2SAClass(TapPlus):
 # ------ End of Class -----------
 # -------------------------------
 
+
+def _restore_client(cls, configuration, tap_plus_conn_handler, product_cache, movie_cache, transport,
+                    query_cache=None, range_cache=None, schema_catalog=None):
+    """
+    Rebuilds a pickled ESAP2SAClass (or subclass) instance from its configuration
+    """
+    client = cls.__new__(cls)
+    # Set before __init__ so that the connection handler uses the same urls
+    client.__dict__.update(configuration)
+    client.__init__(tap_plus_conn_handler, product_cache, movie_cache, transport, query_cache, range_cache,
+                    schema_catalog)
+    return client
+
+
 ESAP2SA = ESAP2SAClass()
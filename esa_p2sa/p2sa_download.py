@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento Carrión
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+
+Helpers used by ESAP2SAClass to move HTTP response bodies to memory and to disk.
+"""
+
+import fnmatch
+import io
+import json
+import os
+import re
+import tarfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from . import conf
+from .p2sa_transport import HTTPStatusError, P2SATransport
+
+__all__ = ['DownloadResult', 'stream_response', 'read_response', 'open_url', 'download_resumable', 'download_segmented',
+           'split_oid_list', 'extract_tar_stream']
+
+PART_SUFFIX = ".part"
+SIDECAR_SUFFIX = ".part.json"
+# Segments are never made smaller than this, so small products use fewer connections
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+# Transport of open_url, created on first use
+_transport = None
+_transport_lock = threading.Lock()
+
+# Outcome of one download in a bulk request: error is None when it succeeded
+DownloadResult = namedtuple('DownloadResult', ['oid', 'path', 'bytes', 'duration', 'error'])
+
+
+def stream_response(response, fh, chunk_size=None):
+    """
+    Copies the body of an HTTP response into an open binary file, chunk by chunk.
+
+    A single buffer of ``chunk_size`` bytes is allocated up front and reused for
+    every read, so memory usage does not depend on the size of the payload.
+
+    Parameters
+    ----------
+    response: file-like object
+        response from P2SA Tap server. ``readinto`` is used when available,
+        otherwise the body is consumed with ``read(chunk_size)``
+    fh: file-like object
+        destination opened in binary write mode
+    chunk_size: int, optional
+        size in bytes of the read buffer, default ``conf.DOWNLOAD_CHUNK_SIZE``
+
+    Returns
+    -------
+    Number of bytes written
+    """
+    if chunk_size is None:
+        chunk_size = conf.DOWNLOAD_CHUNK_SIZE
+    chunk_size = int(chunk_size)
+    if chunk_size <= 0:
+        raise ValueError("Value for parameter 'chunk_size' must be a positive integer")
+
+    readinto = getattr(response, 'readinto', None)
+    view = memoryview(bytearray(chunk_size)) if readinto is not None else None
+    total = 0
+
+    while True:
+        if readinto is not None:
+            read_bytes = readinto(view)
+            if not read_bytes:
+                break
+            fh.write(view[:read_bytes])
+        else:
+            data = response.read(chunk_size)
+            if not data:
+                break
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            read_bytes = len(data)
+            fh.write(data)
+        # __end_if
+        total = total + read_bytes
+    # __end_while
+
+    return total
+
+# _end_of_stream_response
+
+
+class _TeeWriter(object):
+    """
+    Binary writer copying every chunk to two files
+    """
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def write(self, data):
+        self.first.write(data)
+        return self.second.write(data)
+
+
+def read_response(response, fh=None, chunk_size=None):
+    """
+    Reads the body of an HTTP response into memory, chunk by chunk.
+
+    When ``fh`` is given, every chunk is also written to it as it arrives, so the
+    body is saved to a file in the same pass and never read back from disk.
+
+    Parameters
+    ----------
+    response: file-like object
+        response from P2SA Tap server
+    fh: file-like object, optional
+        destination opened in binary write mode
+    chunk_size: int, optional
+        size in bytes of the read buffer, default ``conf.DOWNLOAD_CHUNK_SIZE``
+
+    Returns
+    -------
+    The body as bytes
+    """
+    body = io.BytesIO()
+    stream_response(response, body if fh is None else _TeeWriter(body, fh), chunk_size)
+    return body.getvalue()
+
+# _end_of_read_response
+
+
+def open_url(link, headers=None, method="GET", transport=None):
+    """
+    Sends an HTTP request for link and returns the response object.
+
+    Parameters
+    ----------
+    link: String
+        absolute url of the request
+    headers: dict, optional
+        extra request headers, e.g. ``Range``
+    method: String, optional, default 'GET'
+        HTTP method
+    transport: P2SATransport, optional, default None
+        transport used to send the request. If not provided, a pooled transport
+        shared by the module is created from the conf.HTTP_* settings
+
+    Returns
+    -------
+    The HTTP response. Error statuses raise HTTPStatusError, an IOError
+    """
+    global _transport
+    if transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = P2SATransport()
+            # __end_if
+            transport = _transport
+        # __end_with
+    # __end_if
+    response = transport.request(method, link, headers=headers)
+    if response.status >= 400:
+        response.close()
+        raise HTTPStatusError(response.status, response.reason, link)
+    # __end_if
+    return response
+
+# _end_of_open_url
+
+
+def _read_sidecar(sidecar_file, link):
+    try:
+        with open(sidecar_file) as fh:
+            state = json.load(fh)
+    except (IOError, ValueError):
+        return None
+    if state.get('url') != link:
+        return None
+    return state
+
+
+def _write_sidecar(sidecar_file, state):
+    tmp_file = sidecar_file + ".tmp"
+    with open(tmp_file, 'w') as fh:
+        json.dump(state, fh)
+    os.replace(tmp_file, sidecar_file)
+
+
+def _content_range(response):
+    """Returns (start, total) from the Content-Range header, None if missing or unparsable."""
+    match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", response.headers.get("Content-Range") or "")
+    if match is None:
+        return None
+    total = None if match.group(2) == "*" else int(match.group(2))
+    return int(match.group(1)), total
+
+
+def download_resumable(link, filename, chunk_size=None, opener=None):
+    """
+    Downloads link into filename, resuming a previous interrupted attempt if possible.
+
+    While the transfer is running the data is written to ``<filename>.part`` next to
+    a ``<filename>.part.json`` sidecar that records the url, the expected size and
+    the validator (ETag or Last-Modified) of the product. If both files are found,
+    only the missing bytes are requested with ``Range`` and ``If-Range`` headers.
+    When the sidecar has no validator, the server ignores the range or answers
+    416 (Range Not Satisfiable), or the product changed in between, the full body
+    is downloaded again. Both files are kept if the transfer fails, including
+    network errors of the range request, and replaced by filename once it completes.
+
+    Parameters
+    ----------
+    link: String
+        absolute url of the product
+    filename: String
+        name for the output file
+    chunk_size: int, optional, default conf.DOWNLOAD_CHUNK_SIZE
+        size in bytes of the buffer used to stream the response
+    opener: callable, optional, default open_url
+        ``opener(link, headers)`` returning the HTTP response. Error statuses
+        raise an IOError whose status attribute holds the HTTP status
+
+    Returns
+    -------
+    Number of bytes transferred by this call
+    """
+    if opener is None:
+        opener = open_url
+    part_file = filename + PART_SUFFIX
+    sidecar_file = filename + SIDECAR_SUFFIX
+
+    offset = 0
+    state = _read_sidecar(sidecar_file, link) if os.path.exists(part_file) else None
+    if state is not None:
+        if state.get('expected_size') is not None and os.path.getsize(part_file) == state['expected_size']:
+            # Previous attempt got every byte but did not get to rename the file
+            os.replace(part_file, filename)
+            os.remove(sidecar_file)
+            return 0
+        # __end_if
+        # Without a validator the server cannot tell whether the product changed,
+        # so the part file is only reused when If-Range can be sent
+        if state.get('etag') or state.get('last_modified'):
+            offset = os.path.getsize(part_file)
+        # __end_if
+    # __end_if
+
+    headers = {}
+    if offset > 0:
+        headers["Range"] = "bytes=%d-" % offset
+        headers["If-Range"] = state.get('etag') or state.get('last_modified')
+    # __end_if
+
+    try:
+        response = opener(link, headers)
+    except IOError as e:
+        # 416 Range Not Satisfiable: the part file already holds the whole product
+        # but its size was unknown. Other errors keep the part file for a next attempt
+        if not headers or getattr(e, 'status', None) != 416:
+            raise
+        # __end_if
+        response = None
+    # __end_try
+    if response is not None and getattr(response, 'status', 200) == 416:
+        response.close()
+        response = None
+    # __end_if
+    if response is None:
+        offset = 0
+        response = opener(link, {})
+    # __end_if
+    # The connection goes back to the pool whatever happens to the transfer
+    try:
+        status = getattr(response, 'status', 200)
+        content_range = _content_range(response) if status == 206 else None
+        if content_range is None or content_range[0] != offset:
+            # The server ignored the range request: start again from the first byte
+            offset = 0
+            content_range = None
+        # __end_if
+
+        if content_range is not None:
+            expected_size = content_range[1]
+        elif response.headers.get("Content-Length") is not None:
+            expected_size = int(response.headers.get("Content-Length"))
+        else:
+            expected_size = None
+        # __end_if
+
+        _write_sidecar(sidecar_file, {'url': link,
+                                      'expected_size': expected_size,
+                                      'etag': response.headers.get("ETag"),
+                                      'last_modified': response.headers.get("Last-Modified")})
+
+        with open(part_file, 'ab' if offset > 0 else 'wb') as fh:
+            fh.seek(offset)
+            fh.truncate()
+            transferred = stream_response(response, fh, chunk_size)
+    finally:
+        response.close()
+    # __end_try
+
+    if expected_size is not None and os.path.getsize(part_file) != expected_size:
+        raise IOError("Incomplete download of {0}: {1} of {2} bytes received".format(
+            link, os.path.getsize(part_file), expected_size))
+    # __end_if
+
+    os.replace(part_file, filename)
+    os.remove(sidecar_file)
+    return transferred
+
+# _end_of_download_resumable
+
+
+def _download_segment(link, part_file, start, end, chunk_size, opener):
+    response = opener(link, {"Range": "bytes=%d-%d" % (start, end)})
+    try:
+        content_range = _content_range(response) if getattr(response, 'status', 200) == 206 else None
+        if content_range is None or content_range[0] != start:
+            raise IOError("Range request bytes={0}-{1} not honoured for {2}".format(start, end, link))
+        with open(part_file, 'r+b') as fh:
+            fh.seek(start)
+            written_bytes = stream_response(response, fh, chunk_size)
+    finally:
+        response.close()
+    if written_bytes != end - start + 1:
+        raise IOError("Incomplete segment bytes={0}-{1} of {2}: {3} bytes received".format(
+            start, end, link, written_bytes))
+    return written_bytes
+
+
+def download_segmented(link, filename, segments, chunk_size=None, opener=None):
+    """
+    Downloads link into filename using several parallel connections.
+
+    The content length is probed with a one byte range request. The file is then
+    preallocated and every connection fetches one byte range and writes it at its
+    offset. When the server does not support ranges the probe response already
+    carries the full body, which is streamed to disk over that single connection.
+
+    Parameters
+    ----------
+    link: String
+        absolute url of the product
+    filename: String
+        name for the output file
+    segments: int
+        maximum number of parallel connections. Segments are at least
+        MIN_SEGMENT_SIZE bytes long
+    chunk_size: int, optional, default conf.DOWNLOAD_CHUNK_SIZE
+        size in bytes of the buffer used by every connection
+    opener: callable, optional, default open_url
+        ``opener(link, headers)`` returning the HTTP response. It is called from
+        several threads at once
+
+    Returns
+    -------
+    Number of bytes written
+    """
+    if opener is None:
+        opener = open_url
+    if int(segments) <= 0:
+        raise ValueError("Value for parameter 'segments' must be a positive integer")
+    part_file = filename + PART_SUFFIX
+
+    probe = opener(link, {"Range": "bytes=0-0"})
+    try:
+        content_range = _content_range(probe) if getattr(probe, 'status', 200) == 206 else None
+        if content_range is None or content_range[0] != 0 or content_range[1] is None:
+            # No range support: the probe is a full response, keep streaming it
+            with open(part_file, 'wb') as fh:
+                written_bytes = stream_response(probe, fh, chunk_size)
+            # __end_with
+        else:
+            probe.read()
+            probe.close()
+            total = content_range[1]
+            with open(part_file, 'wb') as fh:
+                fh.truncate(total)
+            # __end_with
+            written_bytes = 0
+            if total > 0:
+                segments = max(1, min(int(segments), total // MIN_SEGMENT_SIZE))
+                segment_size = -(-total // segments)
+                ranges = [(start, min(start + segment_size, total) - 1) for start in range(0, total, segment_size)]
+                with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                    futures = [executor.submit(_download_segment, link, part_file, start, end, chunk_size, opener)
+                               for start, end in ranges]
+                    written_bytes = sum(future.result() for future in futures)
+                # __end_with
+            # __end_if
+        # __end_if
+        os.replace(part_file, filename)
+    except BaseException:
+        # The part file of a failed or cancelled download is never reused
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        # __end_if
+        raise
+    finally:
+        probe.close()
+    # __end_try
+    return written_bytes
+
+# _end_of_download_segmented
+
+
+def split_oid_list(oids, max_count, max_length):
+    """
+    Splits a list of oids into consecutive chunks for comma separated lists.
+
+    Parameters
+    ----------
+    oids: list of strings
+        oids to split
+    max_count: int
+        maximum number of oids per chunk
+    max_length: int
+        maximum length of a chunk once joined with commas
+
+    Returns
+    -------
+    List of lists of oids, in the original order
+    """
+    if int(max_count) <= 0:
+        raise ValueError("Value for parameter 'max_count' must be a positive integer")
+    chunks = []
+    current = []
+    current_length = 0
+    for oid in oids:
+        oid_length = len(oid) + (1 if current else 0)
+        if current and (len(current) >= max_count or current_length + oid_length > max_length):
+            chunks.append(current)
+            current = []
+            current_length = 0
+            oid_length = len(oid)
+        # __end_if
+        if oid_length > max_length:
+            raise ValueError("oid {0} does not fit in a request".format(oid))
+        current.append(oid)
+        current_length = current_length + oid_length
+    # __end_for
+    if current:
+        chunks.append(current)
+    return chunks
+
+# _end_of_split_oid_list
+
+
+def _member_filter(members):
+    if members is None:
+        return lambda member: True
+    if callable(members):
+        return members
+    if isinstance(members, str):
+        members = [members]
+    patterns = list(members)
+
+    def match(member):
+        name = member.name
+        return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(os.path.basename(name), pattern)
+                   for pattern in patterns)
+
+    return match
+
+
+def extract_tar_stream(response, target_dir, members=None, chunk_size=None):
+    """
+    Unpacks a tar archive while it is being read from response.
+
+    The archive is read sequentially (tarfile stream mode), so it is never written
+    to disk as a whole: the selected regular files are streamed to target_dir and
+    the data of the other members is read past without being stored.
+
+    Parameters
+    ----------
+    response: file-like object
+        response from P2SA Tap server, or any readable binary stream
+    target_dir: String
+        directory where the files are written. It is created if needed
+    members: String, list of strings or callable, optional, default None (all files)
+        glob patterns matched against the member path and its base name, or a
+        callable that receives the tarfile.TarInfo and returns True for the members
+        to extract
+    chunk_size: int, optional, default conf.DOWNLOAD_CHUNK_SIZE
+        size in bytes of the buffer used to write every file
+
+    Returns
+    -------
+    List with the paths of the extracted files
+    """
+    include = _member_filter(members)
+    target_dir = os.path.abspath(target_dir)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir, exist_ok=True)
+
+    extracted = []
+    with tarfile.open(fileobj=response, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile() or not include(member):
+                continue
+            path = os.path.abspath(os.path.join(target_dir, member.name))
+            if os.path.commonpath([target_dir, path]) != target_dir:
+                raise ValueError("Member {0} would be extracted outside {1}".format(member.name, target_dir))
+            # __end_if
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+            with open(path, 'wb') as fh:
+                stream_response(tar.extractfile(member), fh, chunk_size)
+            extracted.append(path)
+        # __end_for
+    return extracted
+
+# _end_of_extract_tar_stream
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento Carrión
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+
+Manager of asynchronous TAP jobs, used to run many ADQL queries at the same time.
+"""
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy import log
+
+from . import conf
+from .p2sa_download import read_response
+from .p2sa_parser import parse_table
+
+__all__ = ['TapJobManager', 'JobResult']
+
+# Phases of a UWS job that has ended
+FINAL_PHASES = ('COMPLETED', 'ERROR', 'ABORTED')
+# Phases in which the service can hold a WAIT request until the phase changes
+ACTIVE_PHASES = ('PENDING', 'QUEUED', 'EXECUTING')
+PHASE_PATTERN = re.compile(r"<(?:\w+:)?phase>\s*(\w+)\s*</(?:\w+:)?phase>", re.I)
+
+# Outcome of one query of TapJobManager.run: error is None when it succeeded
+JobResult = namedtuple('JobResult', ['query', 'jobid', 'table', 'duration', 'error'])
+
+
+class TapJobManager(object):
+    """
+    Runs many ADQL queries as asynchronous jobs of the P2SA TAP service.
+
+    Queries are submitted with launch_job_async without waiting for them, so
+    that the service runs them side by side. Up to ``workers`` jobs are then
+    followed at the same time: each one is polled with UWS WAIT requests, which
+    the service holds until the job changes phase, and its result is fetched as
+    soon as it ends. When the service answers a WAIT request at once, the next
+    poll comes after a pause that doubles from conf.TAP_JOB_POLL_INTERVAL up to
+    conf.TAP_JOB_MAX_POLL_INTERVAL. The time taken by ``run`` is close to the
+    one of the slowest query instead of the sum of all of them.
+
+    Jobs stay on the server until they are deleted. ``run`` deletes its jobs
+    once their results are read, and leaving a ``with`` block deletes every job
+    submitted in it that is still there::
+
+        with TapJobManager(ESAP2SA) as manager:
+            results = manager.run(queries)
+
+    Parameters
+    ----------
+    client : ESAP2SAClass, mandatory
+        client whose TAP connection is used
+    workers : int, optional, default conf.TAP_JOB_WORKERS
+        number of jobs followed and fetched at the same time
+    wait : int, optional, default conf.TAP_JOB_WAIT
+        seconds the service may hold a WAIT request
+    timeout : float, optional, default conf.TAP_JOB_TIMEOUT
+        seconds to wait for a job to end, 0 waits forever
+    """
+
+    def __init__(self, client, workers=None, wait=None, timeout=None):
+        if client is None:
+            raise ValueError("Value for mandatory parameter 'client' is missed")
+        if workers is None:
+            workers = conf.TAP_JOB_WORKERS
+        if wait is None:
+            wait = conf.TAP_JOB_WAIT
+        if timeout is None:
+            timeout = conf.TAP_JOB_TIMEOUT
+        if int(workers) < 1:
+            raise ValueError("Value for parameter 'workers' must be positive")
+
+        self.client = client
+        self.workers = int(workers)
+        self.wait = int(wait)
+        self.timeout = float(timeout)
+        # Jobs submitted and not deleted yet
+        self._jobs = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.delete()
+
+    @property
+    def connection(self):
+        """
+        Connection handler of the client, used for the UWS requests
+        """
+        return self.client._Tap__connHandler
+
+    def submit(self, query, output_format='votable', name=None, upload_resource=None, upload_table_name=None):
+        """
+        Submits query as an asynchronous job and returns without waiting for it.
+        upload_resource, a table or a VOTable file, is uploaded with the query as
+        the table tap_upload.<upload_table_name>
+
+        Returns
+        -------
+        The astroquery Job of the query. Errors are raised to the caller
+        """
+        job = self.client.launch_job_async(query=query, output_format=output_format, name=name, background=True,
+                                           upload_resource=upload_resource, upload_table_name=upload_table_name)
+        with self._lock:
+            self._jobs.append(job)
+        # __end_with
+        log.debug("Job {0} submitted: {1}".format(job.jobid, query))
+        return job
+
+    def wait_for(self, job):
+        """
+        Waits until job ends
+
+        Returns
+        -------
+        The final phase of the job: COMPLETED, ERROR or ABORTED. Errors, and jobs
+        not ended within the timeout, raise IOError
+        """
+        start = time.time()
+        pause = float(conf.TAP_JOB_POLL_INTERVAL)
+        phase = job.get_phase()
+        while True:
+            polled = time.time()
+            phase = self._poll(job, phase)
+            if phase in FINAL_PHASES:
+                break
+            if self.timeout > 0 and time.time() - start > self.timeout:
+                raise IOError("Job {0} did not end in {1} seconds".format(job.jobid, self.timeout))
+            # __end_if
+            if self.wait <= 0 or time.time() - polled < self.wait / 2.0:
+                # The service did not hold the request: back off before the next poll
+                time.sleep(pause)
+                pause = min(pause * 2, float(conf.TAP_JOB_MAX_POLL_INTERVAL))
+            # __end_if
+        # __end_while
+        job.set_phase(phase)
+        return phase
+
+    # __end_of_wait_for
+
+    def fetch(self, job, output_format='votable', parser=None, filename=None):
+        """
+        Waits until job ends and reads its result, decoded by
+        parser(body, output_format) when one is given. With filename, the
+        response is also saved to that file while it is read
+
+        Returns
+        -------
+        A table object. Failed jobs raise IOError
+        """
+        response = self.open_result(job)
+        try:
+            if filename:
+                with open(filename, 'wb') as fh:
+                    body = read_response(response, fh)
+                # __end_with
+            else:
+                body = response.read()
+            # __end_if
+            if parser is None:
+                parser = parse_table
+            # __end_if
+            table = parser(body, output_format)
+        finally:
+            response.close()
+        # __end_try
+        job.set_results(table)
+        return table
+
+    # __end_of_fetch
+
+    def open_result(self, job):
+        """
+        Waits until job ends and opens its result, so that it can be read while
+        it is downloaded
+
+        Returns
+        -------
+        The HTTP response, to be read and closed by the caller. Failed jobs raise IOError
+        """
+        phase = self.wait_for(job)
+        if phase != 'COMPLETED':
+            raise IOError("Job {0} ended in phase {1}: {2}".format(job.jobid, phase, self._get_error(job)))
+        # __end_if
+
+        response = self.connection.execute_tapget("async/{0}/results/result".format(job.jobid))
+        redirects = 0
+        while response.status in (302, 303) and redirects < 20:
+            location = self.connection.find_header(response.getheaders(), "location")
+            response.read()
+            response.close()
+            response = self.connection.execute_tapget(location)
+            redirects = redirects + 1
+        # __end_while
+        if response.status != 200:
+            response.read()
+            response.close()
+            raise IOError("Error reading the result of job {0}: HTTP {1} {2}".format(job.jobid, response.status,
+                                                                                    response.reason))
+        # __end_if
+        return response
+
+    # __end_of_open_result
+
+    def run(self, queries, output_format='votable', delete=True):
+        """
+        Runs every query as an asynchronous job, concurrently
+
+        Parameters
+        ----------
+        queries : list of str, mandatory
+            ADQL queries
+        output_format : str, optional, default 'votable'
+            results format
+        delete : bool, optional, default True
+            delete the jobs from the server once their results are read
+
+        Returns
+        -------
+        List of JobResult(query, jobid, table, duration, error) in the order of queries
+        """
+        if queries is None:
+            raise ValueError("Value for mandatory parameter 'queries' is missed")
+        # __end_if
+        queries = list(queries)
+        if len(queries) == 0:
+            return []
+        # __end_if
+
+        def submit(index):
+            start = time.time()
+            try:
+                return index, self.submit(queries[index], output_format), start, None
+            except Exception as e:
+                log.error("[run()] Query {0} could not be submitted: {1}".format(index, e))
+                return index, None, start, e
+            # __end_try
+
+        def follow(item):
+            index, job, start, error = item
+            if error is not None:
+                return JobResult(queries[index], None, None, time.time() - start, error)
+            # __end_if
+            try:
+                table = self.fetch(job, output_format)
+            except Exception as e:
+                log.error("[run()] Job {0} failed: {1}".format(job.jobid, e))
+                return JobResult(queries[index], job.jobid, None, time.time() - start, e)
+            # __end_try
+            return JobResult(queries[index], job.jobid, table, time.time() - start, None)
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(queries))) as executor:
+            # Every job is running on the server before the first one is followed
+            submitted = list(executor.map(submit, range(len(queries))))
+            results = list(executor.map(follow, submitted))
+        # __end_with
+
+        if delete:
+            self.delete([job for index, job, start, error in submitted if job is not None])
+        # __end_if
+        return results
+
+    # __end_of_run
+
+    def delete(self, jobs=None):
+        """
+        Deletes jobs from the server with one request, or with one UWS DELETE per
+        job when the service has no bulk removal. Failures are logged
+
+        Parameters
+        ----------
+        jobs : list of Job or of job identifiers, optional, default None
+            jobs to delete, every job submitted and not deleted yet if not provided
+
+        Returns
+        -------
+        Number of jobs deleted
+        """
+        with self._lock:
+            if jobs is None:
+                jobs = list(self._jobs)
+            # __end_if
+            jobids = [str(job if isinstance(job, str) else job.jobid) for job in jobs]
+            self._jobs = [job for job in self._jobs if str(job.jobid) not in jobids]
+        # __end_with
+        if len(jobids) == 0:
+            return 0
+        # __end_if
+
+        try:
+            response = self.connection.execute_tappost("deletejobs", "JOB_IDS=" + ",".join(jobids))
+            response.read()
+            response.close()
+            if response.status == 200:
+                log.info("Deleted {0} jobs".format(len(jobids)))
+                return len(jobids)
+            # __end_if
+        except IOError as e:
+            log.debug("Bulk removal of jobs failed: {0}".format(e))
+        # __end_try
+
+        def delete_job(jobid):
+            try:
+                response = self.connection.execute_tappost("async/" + jobid, "ACTION=DELETE")
+                response.read()
+                response.close()
+                return response.status in (200, 204, 303)
+            except IOError as e:
+                log.debug("Job {0} could not be deleted: {1}".format(jobid, e))
+                return False
+            # __end_try
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(jobids))) as executor:
+            deleted = sum(executor.map(delete_job, jobids))
+        # __end_with
+        if deleted < len(jobids):
+            log.warning("{0} of {1} jobs could not be deleted".format(len(jobids) - deleted, len(jobids)))
+        # __end_if
+        return deleted
+
+    # __end_of_delete
+
+    def _poll(self, job, phase):
+        """
+        Reads the phase of job with a UWS WAIT request, held by the service while
+        the job stays in its current active phase
+        """
+        context = "async/{0}?WAIT={1}".format(job.jobid, max(self.wait, 0))
+        if phase in ACTIVE_PHASES:
+            context = context + "&PHASE=" + phase
+        # __end_if
+        response = self.connection.execute_tapget(context)
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        # __end_try
+        if response.status != 200:
+            raise IOError("Error polling job {0}: HTTP {1} {2}".format(job.jobid, response.status, response.reason))
+        # __end_if
+        match = PHASE_PATTERN.search(body.decode('utf-8', 'replace'))
+        if match is None:
+            raise IOError("The description of job {0} has no phase".format(job.jobid))
+        # __end_if
+        return match.group(1).upper()
+
+    def _get_error(self, job):
+        try:
+            response = self.connection.execute_tapget("async/{0}/error".format(job.jobid))
+            try:
+                return response.read().decode('utf-8', 'replace').strip()[:1000]
+            finally:
+                response.close()
+            # __end_try
+        except IOError:
+            return ""
+        # __end_try
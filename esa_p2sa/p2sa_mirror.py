@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento Carrión
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+
+Local SQLite mirror of p2sa.v_observation.
+"""
+import contextlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+import numpy as np
+from astropy.table import MaskedColumn, Table
+
+from .p2sa_cache import ObservationRangeCache
+
+__all__ = ['ObservationMirror']
+
+OBSERVATION_TABLE = "observation"
+META_TABLE = "mirror_meta"
+# Dates as milliseconds since 1970, used to filter and sort by time
+BEGIN_KEY = "begin_ms"
+END_KEY = "end_ms"
+# Columns needed to index the observations
+KEY_COLUMNS = ('observation_oid', 'instrument_name', 'begin_date', 'end_date')
+
+
+class ObservationMirror(object):
+    """
+    Local copy of p2sa.v_observation stored in a SQLite file.
+
+    The mirror is filled by ESAP2SAClass.sync_observations. Observations are
+    stored once per observation_oid, and the highest observation_oid stored is
+    the watermark from which the next synchronization starts. Observations
+    changed in the archive after they were mirrored are only refreshed by a
+    full synchronization.
+
+    ``query`` selects observations by instrument, time range and the filters of
+    ESAP2SAClass.query_p2sa_observations with its semantics, using the indexes of the
+    mirror instead of the TAP service. The mirror can be read from several
+    threads and processes at the same time.
+
+    Parameters
+    ----------
+    path : str, mandatory
+        SQLite file of the mirror. It is created by the first synchronization
+    """
+
+    def __init__(self, path):
+        if path is None or path == "":
+            raise ValueError("Value for mandatory parameter 'path' is missed")
+        self.path = os.path.abspath(os.path.expanduser(path))
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # Commits on success, rolls back on error and always closes the connection
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def exists(self):
+        """
+        Returns True if the mirror holds a synchronized table
+        """
+        if not os.path.exists(self.path):
+            return False
+        with self._connect() as connection:
+            return self._columns(connection) is not None
+
+    def columns(self):
+        """
+        Returns the list of (name, numpy dtype) of the mirrored columns
+        """
+        with self._connect() as connection:
+            columns = self._columns(connection)
+        if columns is None:
+            raise IOError("Mirror {0} has not been synchronized".format(self.path))
+        return columns
+
+    def watermark(self):
+        """
+        Returns the highest observation_oid stored, None for an empty mirror
+        """
+        if not self.exists():
+            return None
+        with self._connect() as connection:
+            return connection.execute("SELECT MAX(observation_oid) FROM " + OBSERVATION_TABLE).fetchone()[0]
+
+    def synchronized_at(self):
+        """
+        Returns the time (seconds since the epoch) of the last synchronization, None if never synchronized
+        """
+        if not self.exists():
+            return None
+        with self._connect() as connection:
+            value = self._get_meta(connection, "synchronized_at")
+        return None if value is None else float(value)
+
+    def __len__(self):
+        if not self.exists():
+            return 0
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM " + OBSERVATION_TABLE).fetchone()[0]
+
+    def insert(self, table):
+        """
+        Stores the observations of table, replacing the ones with the same
+        observation_oid. The first table inserted defines the mirrored columns
+
+        Returns
+        -------
+        Number of observations stored
+        """
+        with self._connect() as connection:
+            columns = self._columns(connection)
+            names = KEY_COLUMNS if columns is None else [name for name, dtype in columns]
+            if set(names) - set(table.colnames):
+                raise ValueError("Columns {0} are missing".format(sorted(set(names) - set(table.colnames))))
+            # __end_if
+            if columns is None:
+                columns = [(name, table[name].dtype.str) for name in table.colnames]
+                self._create(connection, columns)
+                names = [name for name, dtype in columns]
+            # __end_if
+            values = [self._to_sql(table[name]) for name in names]
+            values.append(ObservationRangeCache.to_datetimes(table["begin_date"]).astype(np.int64).tolist())
+            values.append(ObservationRangeCache.to_datetimes(table["end_date"]).astype(np.int64).tolist())
+            statement = "INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})".format(
+                OBSERVATION_TABLE, ", ".join(self._quote(name) for name in names + [BEGIN_KEY, END_KEY]),
+                ", ".join("?" * (len(names) + 2)))
+            connection.executemany(statement, zip(*values))
+            self._set_meta(connection, "synchronized_at", repr(time.time()))
+        # __end_with
+        return len(table)
+
+    def clear(self):
+        """
+        Removes the mirror file
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def query(self, instruments=None, from_date=None, to_date=None, columns=None, filters=None,
+              order_by="begin_date", top=None, offset=None):
+        """
+        Selects the mirrored observations of instruments ending after from_date
+        and beginning before to_date, sorted by begin_date
+
+        Parameters
+        ----------
+        instruments : list of str, optional, default None
+            instrument names, all the instruments if not provided
+        from_date : str, optional, default None
+            start of the time range, open if not provided
+        to_date : str, optional, default None
+            end of the time range, open if not provided
+        columns : list of str, optional, default None
+            columns to return, all the mirrored columns if not provided
+        filters : dict, optional, default None
+            filters of ESAP2SAClass.query_p2sa_observations (processing_level,
+            observation_type, wavelength_range, file_format, calibrated,
+            min_file_size, max_file_size)
+        order_by : str or list of str, optional, default 'begin_date'
+            columns to sort by, each one optionally followed by ASC or DESC.
+            None does not sort
+        top : int, optional, default None
+            maximum number of observations to return
+        offset : int, optional, default None
+            number of observations to skip
+
+        Returns
+        -------
+        A table object with the columns of p2sa.v_observation
+        """
+        if not os.path.exists(self.path):
+            raise IOError("Mirror {0} has not been synchronized".format(self.path))
+        # __end_if
+        conditions = []
+        parameters = []
+        if instruments:
+            conditions.append("instrument_name IN ({0})".format(", ".join("?" * len(instruments))))
+            parameters.extend(instruments)
+        if from_date:
+            conditions.append(END_KEY + " > ?")
+            parameters.append(int(ObservationRangeCache.to_datetime(from_date).astype(np.int64)))
+        if to_date:
+            conditions.append(BEGIN_KEY + " < ?")
+            parameters.append(int(ObservationRangeCache.to_datetime(to_date).astype(np.int64)))
+        # __end_if
+
+        with self._connect() as connection:
+            mirrored = self._columns(connection)
+            if mirrored is None:
+                raise IOError("Mirror {0} has not been synchronized".format(self.path))
+            # __end_if
+            dtypes = dict(mirrored)
+            names = [name for name, dtype in mirrored] if columns is None else list(columns)
+            missing = [name for name in names if name not in dtypes]
+            if missing:
+                raise ValueError("Columns {0} are not mirrored".format(missing))
+            # __end_if
+            filter_conditions, filter_parameters = self._filter_conditions(filters, dtypes)
+            conditions.extend(filter_conditions)
+            parameters.extend(filter_parameters)
+
+            statement = "SELECT {0} FROM {1}".format(", ".join(self._quote(name) for name in names),
+                                                     OBSERVATION_TABLE)
+            if conditions:
+                statement = statement + " WHERE " + " AND ".join(conditions)
+            statement = statement + self._order_clause(order_by, dtypes)
+            if top is not None or offset is not None:
+                # SQLite needs a LIMIT before an OFFSET, -1 is no limit
+                statement = statement + " LIMIT {0} OFFSET {1}".format(-1 if top is None else int(top),
+                                                                       int(offset or 0))
+            rows = connection.execute(statement, parameters).fetchall()
+        # __end_with
+
+        values = list(zip(*rows)) if rows else [()] * len(names)
+        return Table([self._from_sql(name, np.dtype(dtypes[name]), column) for name, column in zip(names, values)])
+
+    @classmethod
+    def _order_clause(cls, order_by, dtypes):
+        # Dates are sorted by their time, ties by observation_oid as on the TAP service
+        if not order_by:
+            return ""
+        if isinstance(order_by, str):
+            order_by = [order_by]
+        # __end_if
+        terms = []
+        for term in order_by:
+            match = re.match(r"^\s*(\w+)(?:\s+(ASC|DESC))?\s*$", str(term), re.I)
+            if match is None or match.group(1) not in dtypes:
+                raise ValueError("Invalid sort term '{0}'".format(term))
+            # __end_if
+            name = {"begin_date": BEGIN_KEY, "end_date": END_KEY}.get(match.group(1), cls._quote(match.group(1)))
+            terms.append(name + " " + (match.group(2) or "ASC").upper())
+        # __end_for
+        return " ORDER BY " + ", ".join(terms + ["observation_oid"])
+
+    @classmethod
+    def _filter_conditions(cls, filters, dtypes):
+        conditions = []
+        parameters = []
+        for name, value in (filters or {}).items():
+            column = {"min_file_size": "file_size", "max_file_size": "file_size"}.get(name, name)
+            if value is None:
+                continue
+            elif column not in dtypes:
+                raise ValueError("Filter '{0}' needs the column '{1}', which is not mirrored".format(name, column))
+            elif name == "calibrated":
+                # Stored as text or as 0 / 1 depending on the type returned by the TAP service
+                conditions.append("calibrated IN (?, ?)")
+                parameters.extend(["true", 1] if value else ["false", 0])
+            elif name == "min_file_size":
+                conditions.append("file_size >= ?")
+                parameters.append(int(value))
+            elif name == "max_file_size":
+                conditions.append("file_size <= ?")
+                parameters.append(int(value))
+            else:
+                values = [value] if isinstance(value, str) else list(value)
+                conditions.append("{0} IN ({1})".format(cls._quote(column), ", ".join("?" * len(values))))
+                parameters.extend(values)
+            # __end_if
+        # __end_for
+        return conditions, parameters
+
+    @staticmethod
+    def _quote(name):
+        return '"' + name.replace('"', '""') + '"'
+
+    def _create(self, connection, columns):
+        definitions = []
+        for name, dtype in columns:
+            kind = np.dtype(dtype).kind
+            sql_type = "INTEGER" if kind in "iub" else "REAL" if kind == "f" else "TEXT"
+            definitions.append(self._quote(name) + " " + sql_type +
+                               (" PRIMARY KEY" if name == "observation_oid" else ""))
+        definitions.extend([BEGIN_KEY + " INTEGER", END_KEY + " INTEGER"])
+        connection.execute("CREATE TABLE {0} ({1})".format(OBSERVATION_TABLE, ", ".join(definitions)))
+        connection.execute("CREATE INDEX observation_begin ON {0} ({1})".format(OBSERVATION_TABLE, BEGIN_KEY))
+        connection.execute("CREATE INDEX observation_instrument ON {0} (instrument_name, {1})".format(
+            OBSERVATION_TABLE, BEGIN_KEY))
+        connection.execute("CREATE TABLE IF NOT EXISTS {0} (key TEXT PRIMARY KEY, value TEXT)".format(META_TABLE))
+        self._set_meta(connection, "columns", json.dumps(columns))
+
+    def _columns(self, connection):
+        exists = connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                                    (META_TABLE,)).fetchone()
+        if exists is None:
+            return None
+        value = self._get_meta(connection, "columns")
+        return None if value is None else [tuple(column) for column in json.loads(value)]
+
+    @staticmethod
+    def _get_meta(connection, key):
+        row = connection.execute("SELECT value FROM {0} WHERE key=?".format(META_TABLE), (key,)).fetchone()
+        return None if row is None else row[0]
+
+    @staticmethod
+    def _set_meta(connection, key, value):
+        connection.execute("INSERT OR REPLACE INTO {0} (key, value) VALUES (?, ?)".format(META_TABLE), (key, value))
+
+    @staticmethod
+    def _to_sql(column):
+        values = np.ma.asarray(column)
+        if values.dtype.kind == "b":
+            values = values.astype(np.int64)
+        elif values.dtype.kind == "S":
+            values = np.ma.masked_array(np.char.decode(values.data, "utf-8"), mask=np.ma.getmaskarray(values))
+        # Masked values become None (NULL)
+        return values.tolist()
+
+    @staticmethod
+    def _from_sql(name, dtype, values):
+        mask = np.array([value is None for value in values], dtype=bool)
+        if dtype.kind in "US":
+            data = np.array(["" if value is None else value for value in values], dtype=str)
+            if dtype.kind == "S":
+                data = np.char.encode(data, "utf-8") if len(data) else data.astype(bytes)
+        else:
+            data = np.array([0 if value is None else value for value in values]).astype(dtype.newbyteorder("="))
+        return MaskedColumn(data, name=name, mask=mask)
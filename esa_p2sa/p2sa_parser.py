@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento Carrión
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+
+Fast decoding of CSV and JSON responses of p2sa.v_observation into typed columns,
+in-memory decoding of the responses of any other query and incremental decoding
+of CSV responses in batches of rows.
+"""
+import csv
+import gzip
+import io
+import json
+import zlib
+
+import numpy as np
+from astropy.table import Column, MaskedColumn, Table
+from astroquery.utils.tap.xmlparser import utils
+
+from . import conf
+
+__all__ = ['parse_observations', 'recode_categories', 'parse_table', 'iter_csv_batches', 'PARSER_FORMATS']
+
+# Output formats the parser can decode
+PARSER_FORMATS = ('csv', 'json')
+# Types of the columns of p2sa.v_observation that are not text
+OBSERVATION_TYPES = {'observation_oid': np.int64, 'file_size': np.int64, 'begin_date': 'datetime64[ms]',
+                     'end_date': 'datetime64[ms]', 'calibrated': bool}
+# Text columns with a few distinct values, returned as codes in categorical mode
+CATEGORICAL_COLUMNS = ('instrument_name', 'observation_type', 'processing_level', 'science_objective',
+                       'wavelength_range', 'science_object_name', 'file_format', 'observatory_name')
+TRUE_VALUES = ('true', 't', '1')
+# Rows of a CSV column gathered at once
+BLOCK_ROWS = 65536
+# Bytes of the CSV layout and of the dates
+NEWLINE, COMMA, ZERO, DASH, SPACE, COLON, DOT, QUOTE, ZULU = (ord(char) for char in '\n,0- :."Z')
+
+
+def parse_observations(data, output_format='csv', categorical=False):
+    """
+    Decodes a CSV or JSON response of a query over p2sa.v_observation without the
+    generic astropy readers. Columns of the view get their own type: int64 oids
+    and sizes, datetime64[ms] dates and bool calibrated flags. The other columns
+    are read as text. Empty and null values are masked.
+
+    CSV responses in ASCII without quoted values, the usual case, are decoded with
+    vectorized operations on their bytes. Other responses are split into Python
+    strings first.
+
+    Parameters
+    ----------
+    data : bytes or str, mandatory
+        body of the response, optionally gzip-compressed
+    output_format : str, optional, default 'csv'
+        format of the response, 'csv' or 'json'
+    categorical : bool, optional, default False
+        return the columns of CATEGORICAL_COLUMNS, such as instrument_name, as
+        int32 codes. The value of each code is in meta['categories'] of the column
+
+    Returns
+    -------
+    A table object
+    """
+    if isinstance(data, bytes) and data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    # __end_if
+    output_format = str(output_format).lower()
+    if output_format == 'csv' and isinstance(data, bytes):
+        columns = _read_csv_bytes(data, categorical)
+        if columns is not None:
+            return Table(columns, copy=False)
+        # __end_if
+    # __end_if
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    # __end_if
+    if output_format == 'csv':
+        names, columns = _split_csv(data)
+        nulls = False
+    elif output_format == 'json':
+        names, columns = _split_json(data)
+        nulls = True
+    else:
+        raise ValueError("Format '{0}' cannot be parsed, use one of {1}".format(output_format, PARSER_FORMATS))
+    # __end_if
+    return Table([_to_column(name, values, categorical, nulls) for name, values in zip(names, columns)],
+                 copy=False)
+
+
+def recode_categories(table, categories):
+    """
+    Gives the categorical columns of table, as returned by parse_observations,
+    codes that stay the same over several tables, e.g. the batches of a query.
+    A value keeps the code it got in the first table it appeared in, and new
+    values get the next codes.
+
+    Parameters
+    ----------
+    table : table object, mandatory
+        result of parse_observations with categorical=True, changed in place
+    categories : dict, mandatory
+        {column name: {value: code}} of the values seen in the previous tables,
+        updated with the new values. Start with an empty dict
+
+    Returns
+    -------
+    The table. meta['categories'] of each column lists every value seen so far
+    """
+    for column in table.itercols():
+        if 'categories' not in column.meta:
+            continue
+        # __end_if
+        codes = categories.setdefault(column.name, {})
+        mapping = np.array([codes.setdefault(value, len(codes)) for value in column.meta['categories']],
+                           dtype=np.int32)
+        values = np.ma.getdata(column)
+        values[:] = mapping[values]
+        column.meta['categories'] = list(codes)
+    # __end_for
+    return table
+
+
+def parse_table(data, output_format='votable'):
+    """
+    Decodes a response held in memory with the astropy reader astroquery uses for
+    output_format, so that it never goes through a file
+
+    Parameters
+    ----------
+    data : bytes, mandatory
+        body of the response, optionally gzip-compressed
+    output_format : str, optional, default 'votable'
+        format of the response: votable, votable_plain, csv, ecsv...
+
+    Returns
+    -------
+    A table object
+    """
+    return utils.read_http_response(io.BytesIO(data), str(output_format))
+
+
+def iter_csv_batches(response, batch_size, parser=parse_observations, chunk_size=None):
+    """
+    Decodes a CSV response while it is read, in tables of batch_size rows.
+
+    The body is read in chunks. Complete records are kept until batch_size of
+    them are available, then decoded with the header of the response by
+    parser(body, 'csv'), so memory holds about one batch whatever the size of
+    the response. Newlines within quoted values do not end a record.
+
+    Parameters
+    ----------
+    response : file-like object, mandatory
+        response of the TAP service, optionally gzip-compressed
+    batch_size : int, mandatory
+        rows of each table. The last one may have fewer
+    parser : function, optional, default parse_observations
+        decoder of the CSV body of one batch
+    chunk_size : int, optional, default conf.DOWNLOAD_CHUNK_SIZE
+        size in bytes of each read
+
+    Returns
+    -------
+    A generator of table objects
+    """
+    batch_size = int(batch_size)
+    if batch_size <= 0:
+        raise ValueError("Value for parameter 'batch_size' must be a positive integer")
+    # __end_if
+    header = None
+    pending = bytearray()
+    # Offsets in pending just after the end of each complete record
+    ends = np.empty(0, dtype=np.int64)
+    quoted = False
+    for chunk in _read_chunks(response, chunk_size):
+        chunk_ends, quoted = _record_ends(chunk, quoted)
+        ends = np.append(ends, chunk_ends + len(pending))
+        pending += chunk
+        if header is None and len(ends) > 0:
+            header = bytes(pending[:ends[0]])
+            del pending[:ends[0]]
+            ends = ends[1:] - len(header)
+        # __end_if
+        while header is not None and len(ends) >= batch_size:
+            cut = int(ends[batch_size - 1])
+            yield parser(header + bytes(pending[:cut]), 'csv')
+            del pending[:cut]
+            ends = ends[batch_size:] - cut
+        # __end_while
+    # __end_for
+    if header is not None and pending.strip():
+        yield parser(header + bytes(pending), 'csv')
+    # __end_if
+
+
+def _read_chunks(response, chunk_size=None):
+    """
+    Reads the body of a response in chunks, decompressed on the fly when it is gzipped
+    """
+    if chunk_size is None:
+        chunk_size = conf.DOWNLOAD_CHUNK_SIZE
+    # __end_if
+    decompressor = None
+    first = True
+    while True:
+        chunk = response.read(int(chunk_size))
+        if not chunk:
+            break
+        # __end_if
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        # __end_if
+        if first and chunk[:2] == b"\x1f\x8b":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # __end_if
+        first = False
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        # __end_if
+        if chunk:
+            yield chunk
+        # __end_if
+    # __end_while
+    if decompressor is not None:
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+        # __end_if
+    # __end_if
+
+
+def _record_ends(chunk, quoted=False):
+    """
+    Finds the newlines of a chunk of a CSV body that end a record, skipping the ones
+    within quoted values. quoted tells whether the chunk starts within quotes
+
+    Returns
+    -------
+    The offsets just after those newlines, and whether the chunk ends within quotes
+    """
+    body = np.frombuffer(chunk, dtype=np.uint8)
+    newlines = np.flatnonzero(body == NEWLINE)
+    if not quoted and b'"' not in chunk:
+        return newlines + 1, False
+    # __end_if
+    # Parity of the quotes read before each byte, escaped quotes ("") count twice
+    parity = (np.cumsum(body == QUOTE) + int(quoted)) % 2
+    return newlines[parity[newlines] == 0] + 1, bool(parity[-1])
+
+
+def _read_csv_bytes(data, categorical=False):
+    """
+    Decodes a CSV response in ASCII without quotes with numpy operations over its
+    bytes, without creating a Python object per value
+
+    Returns
+    -------
+    The list of columns, None when the response needs the general reader
+    """
+    header_end = data.find(b"\n")
+    if header_end < 0 or b'"' in data or b"\r" in data:
+        return None
+    # __end_if
+    body = np.frombuffer(data, dtype=np.uint8, offset=header_end + 1)
+    size = len(body)
+    while size > 0 and body[size - 1] == NEWLINE:
+        size = size - 1
+    # __end_while
+    body = body[:size]
+    if size == 0 or body.max() >= 128:
+        return None
+    # __end_if
+
+    names = data[:header_end].decode('ascii').split(",")
+    width = len(names)
+    newlines = body == NEWLINE
+    separators = np.flatnonzero(newlines | (body == COMMA))
+    count = len(separators) + 1
+    if count % width != 0:
+        return None
+    # __end_if
+    ends = np.append(separators, size)
+    # Every line ends after its last value, and nowhere else
+    if np.count_nonzero(newlines) != count // width - 1 or not newlines[ends[width - 1:-1:width]].all():
+        return None
+    # __end_if
+    starts = np.empty(count, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = separators + 1
+    return [_read_field_column(name, body, starts[index::width], ends[index::width], categorical)
+            for index, name in enumerate(names)]
+
+
+def _read_field_column(name, body, starts, ends, categorical=False):
+    """
+    Converts the values found between starts and ends in body to a Column
+    """
+    lengths = ends - starts
+    missing = lengths == 0
+    chars = _field_chars(body, starts, lengths)
+    kind = OBSERVATION_TYPES.get(name)
+    if kind is np.int64:
+        values = _parse_integers(chars, lengths)
+        if values is not None:
+            return _masked(name, values, missing)
+        # __end_if
+    elif kind is not None and kind is not bool:
+        values = _parse_dates(chars, lengths)
+        if values is not None:
+            return _masked(name, values, missing)
+        # __end_if
+    # __end_if
+
+    # ASCII bytes are their own code points
+    text = chars.astype(np.uint32).view('U{0}'.format(chars.shape[1])).ravel()
+    if kind is bool or (categorical and name in CATEGORICAL_COLUMNS):
+        categories, codes = np.unique(text, return_inverse=True)
+        codes = codes.ravel().astype(np.int32)
+        categories = categories.tolist()
+        if kind is bool:
+            flags = np.array([value.lower() in TRUE_VALUES for value in categories], dtype=bool)
+            return _masked(name, flags[codes], missing)
+        # __end_if
+        column = _masked(name, codes, missing)
+        column.meta['categories'] = categories
+        return column
+    elif kind is not None:
+        # Numbers and dates in another layout are read one by one
+        return _to_column(name, text.tolist())
+    # __end_if
+    return _masked(name, text, missing)
+
+
+def _field_chars(body, starts, lengths):
+    """
+    Returns the bytes of every value as a row of a 2-D array, padded with zeros
+    """
+    width = max(int(lengths.max()), 1)
+    offsets = np.arange(width, dtype=np.int32 if len(body) + width < 2 ** 31 else np.int64)
+    starts = starts.astype(offsets.dtype)
+    chars = np.empty((len(starts), width), dtype=np.uint8)
+    # Blocks of rows bound the memory taken by the indices
+    for first in range(0, len(starts), BLOCK_ROWS):
+        block = slice(first, first + BLOCK_ROWS)
+        index = starts[block, None] + offsets
+        if starts[block][-1] + width > len(body):
+            np.minimum(index, len(body) - 1, out=index)
+        # __end_if
+        values = body.take(index)
+        if (lengths[block] != width).any():
+            values[offsets >= lengths[block, None]] = 0
+        # __end_if
+        chars[block] = values
+    # __end_for
+    return chars
+
+
+def _parse_integers(chars, lengths):
+    """
+    Returns the int64 values of unsigned integers, None if a value is not one.
+    Empty values are read as 0
+    """
+    if chars.shape[1] > 18:
+        return None
+    # __end_if
+    values = np.zeros(len(lengths), dtype=np.int64)
+    for offset in range(chars.shape[1]):
+        digits = chars[:, offset].astype(np.int64) - ZERO
+        inside = lengths > offset
+        if ((digits < 0) | (digits > 9))[inside].any():
+            return None
+        # __end_if
+        values = np.where(inside, values * 10 + digits, values)
+    # __end_for
+    return values
+
+
+def _parse_digits(chars, first, last):
+    """
+    Returns the numbers written in columns [first, last) of chars, None if one is not a number
+    """
+    digits = chars[:, first:last].astype(np.int64) - ZERO
+    if ((digits < 0) | (digits > 9)).any():
+        return None
+    # __end_if
+    return digits @ (10 ** np.arange(last - first - 1, -1, -1, dtype=np.int64))
+
+
+def _parse_dates(chars, lengths):
+    """
+    Returns the datetime64[ms] values of dates written as YYYY-MM-DD, optionally
+    followed by HH:MM:SS, a fraction of second and a 'Z' (UTC), all in the same
+    layout. Empty values are NaT. None if a value is written otherwise or is not
+    a valid date
+    """
+    present = lengths > 0
+    dates = np.full(len(lengths), np.datetime64('NaT'), dtype='datetime64[ms]')
+    if not present.any():
+        return dates
+    # __end_if
+    length = int(lengths[present][0])
+    if (lengths[present] != length).any():
+        return None
+    # __end_if
+    rows = chars[present]
+    if length > 19 and (rows[:, length - 1] == ZULU).all():
+        # Dates are already UTC: the designator is dropped
+        length = length - 1
+    # __end_if
+    if not (length == 10 or length == 19 or 21 <= length <= 29):
+        return None
+    # __end_if
+    if (rows[:, 4] != DASH).any() or (rows[:, 7] != DASH).any():
+        return None
+    # __end_if
+    parts = [_parse_digits(rows, 0, 4), _parse_digits(rows, 5, 7), _parse_digits(rows, 8, 10)]
+    if length > 10:
+        if (~np.isin(rows[:, 10], (SPACE, ord('T')))).any() or (rows[:, 13] != COLON).any() or \
+                (rows[:, 16] != COLON).any():
+            return None
+        # __end_if
+        parts.extend([_parse_digits(rows, 11, 13), _parse_digits(rows, 14, 16), _parse_digits(rows, 17, 19)])
+    # __end_if
+    if length > 19:
+        if (rows[:, 19] != DOT).any() or _parse_digits(rows, 20, length) is None:
+            return None
+        # __end_if
+        # Milliseconds are the first three digits of the fraction
+        digits = min(length, 23) - 20
+        parts.append(_parse_digits(rows, 20, 20 + digits) * 10 ** (3 - digits))
+    # __end_if
+    if any(part is None for part in parts):
+        return None
+    # __end_if
+    parts.extend([np.zeros(len(rows), dtype=np.int64)] * (7 - len(parts)))
+    year, month, day, hour, minute, second, millisecond = parts
+
+    months = (year - 1970) * 12 + month - 1
+    first_days = months.astype('datetime64[M]').astype('datetime64[D]')
+    month_days = ((months + 1).astype('datetime64[M]').astype('datetime64[D]') - first_days).astype(np.int64)
+    if ((month < 1) | (month > 12) | (day < 1) | (day > month_days) | (hour > 23) | (minute > 59) |
+            (second > 59)).any():
+        return None
+    # __end_if
+    offsets = (((day - 1) * 24 + hour) * 60 + minute) * 60000 + second * 1000 + millisecond
+    dates[present] = first_days.astype('datetime64[ms]') + offsets.astype('timedelta64[ms]')
+    return dates
+
+
+def _split_csv(text):
+    """
+    Returns the column names and the values of every column of a CSV text. Lines
+    without quotes are split as they are. Otherwise the C reader of numpy.loadtxt
+    splits them, and converts numbers and dates
+    """
+    header, _, body = text.partition("\n")
+    names = next(csv.reader([header.rstrip("\r")]))
+    if "\r" in body:
+        body = body.replace("\r\n", "\n")
+    # __end_if
+    body = body.rstrip("\n")
+    if body == "":
+        return names, [[] for name in names]
+    # __end_if
+    if '"' not in body:
+        cells = body.replace("\n", ",").split(",")
+        # Every line has one value per column, unless a line is malformed or blank
+        if len(cells) == len(names) * (body.count("\n") + 1):
+            return names, [cells[index::len(names)] for index in range(len(names))]
+        # __end_if
+    # __end_if
+    kinds = [OBSERVATION_TYPES.get(name) for name in names]
+    try:
+        data = _load_csv(body, [object if kind in (None, bool) else kind for kind in kinds])
+    except ValueError:
+        # Empty values cannot be read as numbers: every column is read as text
+        data = _load_csv(body, [object] * len(names))
+    # __end_try
+    return names, [data['f{0}'.format(index)] for index in range(len(names))]
+
+
+def _load_csv(body, kinds):
+    dtype = [('f{0}'.format(index), kind) for index, kind in enumerate(kinds)]
+    return np.loadtxt(io.StringIO(body), delimiter=",", quotechar='"', comments=None, dtype=dtype, ndmin=1)
+
+
+def _split_json(text):
+    """
+    Returns the column names and the values of every column of a TAP JSON
+    response, {"metadata": [{"name": ...}, ...], "data": [[...], ...]}
+    """
+    document = json.loads(text)
+    names = [column["name"] for column in document["metadata"]]
+    rows = document["data"]
+    if any(len(row) != len(names) for row in rows):
+        raise ValueError("The rows of the response do not have {0} values".format(len(names)))
+    # __end_if
+    if len(rows) == 0:
+        return names, [[] for name in names]
+    # __end_if
+    return names, list(zip(*rows))
+
+
+def _to_column(name, values, categorical=False, nulls=False):
+    """
+    Converts the values of one column to a Column. The values are strings read
+    from CSV or, with nulls, values decoded from JSON that may be None
+    """
+    if isinstance(values, np.ndarray):
+        if values.dtype != object:
+            # Already converted by the CSV reader
+            return _masked(name, values, np.isnat(values) if values.dtype.kind == 'M' else None)
+        # __end_if
+        values = values.tolist()
+    # __end_if
+    kind = OBSERVATION_TYPES.get(name)
+
+    if kind is bool or (categorical and name in CATEGORICAL_COLUMNS):
+        # A few distinct values: each one is converted once
+        codes, categories = _encode(values)
+        blanks = [code for code, value in enumerate(categories) if value is None or value == ""]
+        missing = np.isin(codes, blanks) if blanks else None
+        if kind is bool:
+            flags = np.array([str(value).lower() in TRUE_VALUES for value in categories], dtype=bool)
+            return _masked(name, flags[codes], missing)
+        # __end_if
+        column = _masked(name, codes, missing)
+        column.meta['categories'] = ["" if value is None else str(value) for value in categories]
+        return column
+    elif kind is not None and np.dtype(kind).kind == 'M':
+        # Empty and null dates are read as NaT. A 'Z' (UTC) is dropped, as numpy
+        # warns about timezones although the dates are already UTC
+        values = [value[:-1] if isinstance(value, str) and value.endswith('Z') else value for value in values]
+        dates = np.array(values, dtype=kind)
+        return _masked(name, dates, np.isnat(dates))
+    elif kind is not None:
+        try:
+            return _masked(name, np.array(values, dtype=kind), None)
+        except (TypeError, ValueError):
+            missing = np.array([value is None or value == "" for value in values], dtype=bool)
+            values = [0 if value is None or value == "" else value for value in values]
+            return _masked(name, np.array(values, dtype=kind), missing)
+        # __end_try
+    # __end_if
+
+    if nulls and None in values:
+        first = next((value for value in values if value is not None), "")
+        blank = "" if isinstance(first, str) else 0
+        missing = np.array([value is None for value in values], dtype=bool)
+        values = [blank if value is None else value for value in values]
+    else:
+        first = values[0] if len(values) else ""
+        missing = None
+    # __end_if
+    if not isinstance(first, str):
+        # JSON numbers of columns unknown to the parser keep their type
+        return _masked(name, np.array(values), missing)
+    # __end_if
+    text = np.array(values, dtype=str)
+    empty = text == ""
+    return _masked(name, text, empty if missing is None else missing | empty)
+
+
+def _encode(values):
+    """
+    Returns the int32 code of every value, and the list of the distinct values in
+    the order of their codes
+    """
+    lookup = {value: code for code, value in enumerate(dict.fromkeys(values))}
+    return np.fromiter(map(lookup.__getitem__, values), dtype=np.int32, count=len(values)), list(lookup)
+
+
+def _masked(name, values, missing):
+    if missing is None or not missing.any():
+        return Column(values, name=name, copy=False)
+    # __end_if
+    return MaskedColumn(values, name=name, mask=missing, copy=False)
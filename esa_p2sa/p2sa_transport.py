@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento Carrión
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+
+Pooled keep-alive HTTP transport used by ESAP2SAClass for TAP queries and downloads.
+"""
+import threading
+from urllib.parse import urlsplit
+
+import urllib3
+from astroquery.utils.tap.conn.tapconn import CONTENT_TYPE_POST_DEFAULT, TapConn
+
+from . import conf
+
+__all__ = ['HTTPStatusError', 'P2SATransport', 'TransportResponse', 'TransportTapConn']
+
+
+class HTTPStatusError(IOError):
+    """
+    IOError raised for a response with an HTTP error status, which is kept in status
+    """
+
+    def __init__(self, status, reason, link):
+        super(HTTPStatusError, self).__init__("HTTP error {0} {1} for {2}".format(status, reason, link))
+        self.status = status
+        self.reason = reason
+        self.link = link
+
+
+class TransportResponse(object):
+    """
+    File-like view of a streamed HTTP response with the interface of
+    ``http.client.HTTPResponse`` used across esa_p2sa and astroquery
+    (status, reason, headers, getheader, getheaders, read, readinto, close).
+
+    The connection goes back to the pool as soon as the body has been read to
+    the end. Closing a response before that discards its connection. Network
+    errors and timeouts while reading raise IOError.
+    """
+
+    def __init__(self, response, url):
+        self._raw = response
+        self._released = False
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.url = url
+
+    def read(self, amt=None):
+        try:
+            data = self._raw.read(amt)
+        except urllib3.exceptions.HTTPError as e:
+            raise IOError("Error reading {0}: {1}".format(self.url, e)) from e
+        if amt is None or not data:
+            self._release()
+        return data
+
+    def readinto(self, buffer):
+        try:
+            read_bytes = self._raw.readinto(buffer)
+        except urllib3.exceptions.HTTPError as e:
+            raise IOError("Error reading {0}: {1}".format(self.url, e)) from e
+        if read_bytes == 0 and len(buffer) > 0:
+            self._release()
+        return read_bytes
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def getheaders(self):
+        return list(self.headers.items())
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            # The unread body is dropped with the connection, the pool opens a new one
+            self._raw.close()
+            self._raw.release_conn()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self._raw.release_conn()
+
+
+class P2SATransport(object):
+    """
+    HTTP transport with connection pooling and keep-alive.
+
+    Connections are kept open between requests and reused, so series of small
+    requests (metadata, postcards) pay the TCP setup once per connection instead
+    of once per request. At most ``max_connections_per_host`` connections are
+    open to each host: further concurrent requests wait for a free connection,
+    for ``pool_timeout`` seconds at most. Every response must be read to the end
+    or closed to give its connection back.
+
+    Any object with the same ``request`` method can be given to ESAP2SAClass
+    as its transport.
+
+    Parameters
+    ----------
+    max_connections_per_host : int, optional, default conf.HTTP_MAX_CONNECTIONS_PER_HOST
+        maximum number of open connections to a single host
+    max_hosts : int, optional, default conf.HTTP_MAX_HOSTS
+        number of hosts whose connection pools are kept
+    connect_timeout : float, optional, default conf.HTTP_CONNECT_TIMEOUT
+        seconds to wait for a connection to be established
+    read_timeout : float, optional, default conf.HTTP_READ_TIMEOUT
+        seconds to wait for data from the server
+    pool_timeout : float, optional, default conf.HTTP_POOL_TIMEOUT
+        seconds to wait for a free connection of the pool
+    """
+
+    def __init__(self, max_connections_per_host=None, max_hosts=None, connect_timeout=None, read_timeout=None,
+                 pool_timeout=None):
+        if max_connections_per_host is None:
+            max_connections_per_host = conf.HTTP_MAX_CONNECTIONS_PER_HOST
+        if max_hosts is None:
+            max_hosts = conf.HTTP_MAX_HOSTS
+        if connect_timeout is None:
+            connect_timeout = conf.HTTP_CONNECT_TIMEOUT
+        if read_timeout is None:
+            read_timeout = conf.HTTP_READ_TIMEOUT
+        if pool_timeout is None:
+            pool_timeout = conf.HTTP_POOL_TIMEOUT
+        if int(max_connections_per_host) < 1:
+            raise ValueError("Value for parameter 'max_connections_per_host' must be positive")
+        if int(max_hosts) < 1:
+            raise ValueError("Value for parameter 'max_hosts' must be positive")
+
+        self.max_connections_per_host = int(max_connections_per_host)
+        self.max_hosts = int(max_hosts)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_timeout = pool_timeout
+        self._pool_manager = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Only the settings are pickled, the pool is created again on first use
+        state = self.__dict__.copy()
+        state['_pool_manager'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def pool_manager(self):
+        """
+        urllib3.PoolManager holding one connection pool per host, created on first use
+        """
+        if self._pool_manager is None:
+            with self._lock:
+                if self._pool_manager is None:
+                    self._pool_manager = urllib3.PoolManager(num_pools=self.max_hosts,
+                                                             maxsize=self.max_connections_per_host,
+                                                             block=True)
+        return self._pool_manager
+
+    def request(self, method, link, headers=None, data=None, allow_redirects=True):
+        """
+        Sends an HTTP request and returns the response without reading its body
+
+        Parameters
+        ----------
+        method : str, mandatory
+            HTTP method
+        link : str, mandatory
+            absolute url of the request
+        headers : dict, optional
+            extra request headers, e.g. ``Range``
+        data : str or bytes, optional
+            request body
+        allow_redirects : bool, optional, default True
+            follow redirections
+
+        Returns
+        -------
+        A TransportResponse. Error statuses are returned, not raised. Network
+        errors, timeouts and a pool without free connection raise IOError
+        """
+        # Pooled connections closed by the server are reopened once, redirects are
+        # followed on demand and error statuses are left to the caller
+        retries = urllib3.Retry(total=None, connect=1, read=1, status=0, other=0,
+                                redirect=10 if allow_redirects else False)
+        # Bodies are stored as sent: sizes and ranges refer to the raw bytes
+        request_headers = {"Accept-Encoding": "identity"}
+        if headers:
+            request_headers.update(headers)
+        try:
+            response = self.pool_manager.request(method, link, body=data, headers=request_headers,
+                                                 timeout=urllib3.Timeout(connect=self.connect_timeout,
+                                                                         read=self.read_timeout),
+                                                 retries=retries,
+                                                 pool_timeout=self.pool_timeout,
+                                                 preload_content=False,
+                                                 decode_content=False)
+        except urllib3.exceptions.HTTPError as e:
+            raise IOError("Error requesting {0}: {1}".format(link, e)) from e
+        return TransportResponse(response, link)
+
+    def get(self, link, headers=None):
+        return self.request("GET", link, headers=headers)
+
+    def close(self):
+        """
+        Closes every pooled connection
+        """
+        with self._lock:
+            if self._pool_manager is not None:
+                self._pool_manager.clear()
+                self._pool_manager = None
+
+
+class TransportTapConn(TapConn):
+    """
+    TapConn sending the TAP requests of TapPlus through a P2SATransport instead
+    of one new connection per request. It overrides the public execute_* methods
+    of TapConn and keeps its own contexts and headers, so that it does not rely
+    on the private members of astroquery. It is pickled as its constructor arguments.
+    """
+
+    def __init__(self, transport, url, server_context=None, tap_context=None, data_context=None,
+                 upload_context=None, table_edit_context=None, datalink_context=None):
+        self._arguments = (transport, url, server_context, tap_context, data_context, upload_context,
+                           table_edit_context, datalink_context)
+        parts = urlsplit(url)
+        is_https = parts.scheme == "https"
+        port = parts.port or (443 if is_https else 80)
+        super(TransportTapConn, self).__init__(is_https, parts.hostname,
+                                               server_context=server_context,
+                                               port=port,
+                                               sslport=port,
+                                               tap_context=tap_context,
+                                               upload_context=upload_context,
+                                               table_edit_context=table_edit_context,
+                                               data_context=data_context,
+                                               datalink_context=datalink_context)
+        self.transport = transport
+        self._base_url = "{0}://{1}".format(parts.scheme, parts.netloc)
+        self._secure_url = "https://{0}".format(parts.netloc)
+        if server_context is None:
+            self._server_context = ""
+        elif server_context.startswith("/"):
+            self._server_context = server_context
+        else:
+            self._server_context = "/" + server_context
+        # __end_if
+        self._tap_context = self._create_context(tap_context)
+        self._data_context = self._create_context(data_context)
+        self._upload_context = self._create_context(upload_context)
+        self._table_edit_context = self._create_context(table_edit_context)
+        self._datalink_context = self._create_context(datalink_context)
+        self._cookie = None
+        # Status of the last response, kept per thread so that threads sharing
+        # the connection handler do not read each other's status
+        self._state = threading.local()
+
+    def __reduce__(self):
+        return TransportTapConn, self._arguments
+
+    def _create_context(self, context):
+        if not context:
+            return None
+        # __end_if
+        return self._server_context + (context if str(context).startswith("/") else "/" + str(context))
+
+    @staticmethod
+    def _required(context, name):
+        if context is None:
+            raise ValueError("{0} must be specified at TAP object creation for this action to be "
+                             "performed".format(name))
+        return context
+
+    def set_cookie(self, cookie):
+        super(TransportTapConn, self).set_cookie(cookie)
+        self._cookie = cookie
+
+    def unset_cookie(self):
+        super(TransportTapConn, self).unset_cookie()
+        self._cookie = None
+
+    def execute_tapget(self, subcontext, verbose=False):
+        if subcontext.startswith("http"):
+            return self._get(subcontext, verbose)
+        # __end_if
+        return self._get("{0}/{1}".format(self._required(self._tap_context, "tap_context"), subcontext), verbose)
+
+    def execute_dataget(self, query, verbose=False):
+        return self._get("{0}?{1}".format(self._required(self._data_context, "data_context"), query), verbose)
+
+    def execute_datalinkget(self, subcontext, query, verbose=False):
+        context = "{0}/{1}".format(self._required(self._datalink_context, "datalink_context"), subcontext)
+        if query is not None:
+            context = "{0}?{1}".format(context, query)
+        # __end_if
+        return self._get(context, verbose)
+
+    def execute_tappost(self, subcontext, data, content_type=CONTENT_TYPE_POST_DEFAULT, verbose=False):
+        return self._post("{0}/{1}".format(self._required(self._tap_context, "tap_context"), subcontext), data,
+                          content_type, verbose)
+
+    def execute_datapost(self, data, content_type=CONTENT_TYPE_POST_DEFAULT, verbose=False):
+        return self._post(self._required(self._data_context, "data_context"), data, content_type, verbose)
+
+    def execute_datalinkpost(self, subcontext, data, content_type=CONTENT_TYPE_POST_DEFAULT, verbose=False):
+        context = "{0}/{1}".format(self._required(self._datalink_context, "datalink_context"), subcontext)
+        return self._post(context, data, content_type, verbose)
+
+    def execute_upload(self, data, content_type=CONTENT_TYPE_POST_DEFAULT, verbose=False):
+        return self._post(self._required(self._upload_context, "upload_context"), data, content_type, verbose)
+
+    def execute_share(self, data, verbose=False):
+        return self._post("{0}/share".format(self._required(self._tap_context, "tap_context")), data,
+                          CONTENT_TYPE_POST_DEFAULT, verbose)
+
+    def execute_table_edit(self, data, content_type=CONTENT_TYPE_POST_DEFAULT, verbose=False):
+        return self._post(self._required(self._table_edit_context, "table_edit_context"), data, content_type,
+                          verbose)
+
+    def execute_table_tool(self, data, content_type=CONTENT_TYPE_POST_DEFAULT, verbose=False):
+        return self._post(self._required(self._table_edit_context, "table_edit_context"), data, content_type,
+                          verbose)
+
+    def execute_secure(self, subcontext, data, verbose=False):
+        link = "{0}{1}/{2}".format(self._secure_url, self._server_context, subcontext)
+        return self._post(link, data, CONTENT_TYPE_POST_DEFAULT, verbose)
+
+    def _get(self, context, verbose):
+        headers = {}
+        if self._cookie is not None:
+            headers["Cookie"] = self._cookie
+        # __end_if
+        return self._send("GET", context, None, headers, verbose)
+
+    def _post(self, context, data, content_type, verbose):
+        headers = {"Content-type": content_type, "Accept": "text/plain"}
+        if self._cookie is not None:
+            headers["Cookie"] = self._cookie
+        # __end_if
+        return self._send("POST", context, data, headers, verbose)
+
+    def _send(self, method, context, data, headers, verbose):
+        # Contexts are server paths, but absolute links are accepted as well
+        if context.startswith("http://") or context.startswith("https://"):
+            link = context
+        else:
+            link = self._base_url + context
+        if verbose:
+            print("{0} {1}".format(method, link))
+        # Asynchronous TAP jobs are followed by reading the Location header of a 303
+        response = self.transport.request(method, link, headers=headers, data=data, allow_redirects=False)
+        if response.status in (302, 303):
+            # Only the header is used, astroquery never reads the body: the
+            # connection goes back to the pool once the body has been read
+            response.read()
+        # __end_if
+        self._state.status = response.status
+        self._state.reason = response.reason
+        return response
+
+    def get_response_status(self):
+        return getattr(self._state, "status", 0)
+
+    def get_response_reason(self):
+        return getattr(self._state, "reason", "")
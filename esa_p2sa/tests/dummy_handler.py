@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import io
 import os
 from astroquery.utils.tap.model import modelutils, taptable
 from requests.models import Response
 
-__all__ = ['DummyP2SAHandler']
+from esa_p2sa.tests.dummy_tap_handler import DummyTapHandler
+
+__all__ = ['DummyP2SAHandler', 'DummyDataTransport']
 
 
 class DummyResponse(object):
@@ -111,3 +114,33 @@ class DummyP2SAHandler(object):
                     raise ValueError("Parameter '%s' not found in method '%s'" %
                                      (str(key), method_name))
         return False
+
+
+class DummyDataResponse(io.BytesIO):
+
+    def __init__(self, body, status=200, reason="OK", headers=None):
+        super(DummyDataResponse, self).__init__(body)
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+
+
+class DummyDataTransport(object):
+    """
+    Transport serving one payload per observation_oid, or per comma separated
+    file_oid list of a product request. Unknown oids get a 404.
+    """
+
+    def __init__(self, payloads):
+        self.payloads = payloads
+        self.links = []
+
+    def request(self, method, link, headers=None, data=None, allow_redirects=True):
+        self.links.append(link)
+        if "observation_oid=" in link:
+            oid = link.split("observation_oid=")[1].split("&")[0]
+        else:
+            oid = link.split("file_oid+in+%28")[1].split("%29")[0]
+        if oid in self.payloads:
+            return DummyDataResponse(self.payloads[oid])
+        return DummyDataResponse(b"Not found", status=404, reason="Not Found")
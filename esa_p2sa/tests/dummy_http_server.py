@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+
+Local stand-in for the P2SA data server, used to test the HTTP download paths.
+"""
+import hashlib
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+
+__all__ = ['DummyHTTPServer']
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing the connection in the middle of a reply are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super(_ThreadingHTTPServer, self).handle_error(request, client_address)
+
+
+class _DummyRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # As production servers do, otherwise keep-alive replies wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super(_DummyRequestHandler, self).setup()
+        self.server.owner.add_connection()
+
+    def do_HEAD(self):
+        self._reply(send_body=False)
+
+    def do_GET(self):
+        self._reply(send_body=True)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self._reply(send_body=True, request_body=self.rfile.read(length))
+
+    def _reply(self, send_body, request_body=b""):
+        owner = self.server.owner
+        owner.record(self.command, self.path, self.headers)
+        if owner.delay:
+            time.sleep(owner.delay)
+        body = None
+        if owner.responder is not None:
+            body = owner.responder(self.command, self.path, request_body)
+        if isinstance(body, tuple):
+            status, body, headers = body
+            self._send(status, body, headers, send_body)
+            return
+        if body is None:
+            body = owner.lookup(self.path)
+        if body is None:
+            self._send(404, b"Not found", {}, send_body)
+            return
+
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        headers = {"ETag": etag, "Content-Type": "application/x-tar"}
+        if owner.support_ranges:
+            headers["Accept-Ranges"] = "bytes"
+
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        match = re.match(r"bytes=(\d+)-(\d*)$", range_header or "")
+        if owner.support_ranges and match and (if_range is None or if_range == etag):
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(body) - 1
+            end = min(end, len(body) - 1)
+            if start >= len(body):
+                headers["Content-Range"] = "bytes */%d" % len(body)
+                self._send(416, b"", headers, send_body)
+                return
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(body))
+            self._send(206, body[start:end + 1], headers, send_body)
+        else:
+            self._send(200, body, headers, send_body)
+
+    def _send(self, status, body, headers, send_body):
+        owner = self.server.owner
+        self.send_response(status)
+        for key in headers:
+            self.send_header(key, headers[key])
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not send_body:
+            return
+        if owner.fail_after is not None and owner.fail_after < len(body):
+            # Simulate a connection dropped in the middle of the transfer
+            body = body[:owner.fail_after]
+            owner.fail_after = None
+            self.close_connection = True
+        # Counted before writing so that the total is final once the client has the data
+        owner.add_sent(len(body))
+        self.wfile.write(body)
+
+
+class DummyHTTPServer(object):
+    """
+    Serves in-memory payloads on 127.0.0.1 with optional HTTP Range support.
+
+    Payloads are registered by link (scheme and host are ignored). The server
+    records every request and counts the connections it accepted and the body
+    bytes it sent. Every reply can be delayed by ``delay`` seconds. Replies can
+    be computed by ``responder(method, path, request_body)``, which returns the
+    body, a (status, body, headers) tuple, or None to fall back to the
+    registered payloads.
+    """
+
+    def __init__(self, support_ranges=True):
+        self.support_ranges = support_ranges
+        self.fail_after = None
+        self.delay = 0
+        self.responder = None
+        self.payloads = {}
+        self.requests = []
+        self.connections = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _DummyRequestHandler)
+        self._server.owner = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def set_payload(self, link, body):
+        self.payloads[self._key(link)] = body
+
+    def lookup(self, path):
+        return self.payloads.get(self._key(path))
+
+    def record(self, method, path, headers):
+        with self._lock:
+            self.requests.append((method, path, dict(headers)))
+
+    def add_connection(self):
+        with self._lock:
+            self.connections = self.connections + 1
+
+    def add_sent(self, count):
+        with self._lock:
+            self.bytes_sent = self.bytes_sent + count
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = []
+            self.connections = 0
+            self.bytes_sent = 0
+
+    @staticmethod
+    def _key(link):
+        parts = urlsplit(link)
+        return parts.path.lstrip("/") + "?" + parts.query
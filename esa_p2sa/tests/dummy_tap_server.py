@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+
+Local stand-in for the P2SA TAP service. It answers the synchronous ADQL
+queries sent by esa_p2sa over an in-memory p2sa.v_observation table.
+"""
+import io
+import json
+import re
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from astropy.io.votable import from_table
+from astropy.table import Table
+
+from esa_p2sa.tests.dummy_http_server import DummyHTTPServer
+
+__all__ = ['DummyTapServer', 'make_observations']
+
+INSTRUMENTS = ["SWAP", "LYRA"]
+
+
+def make_observations(count, start="2015-08-01", step_minutes=60, duration_minutes=90):
+    """
+    Builds a v_observation-like table with count observations, alternating instruments
+    """
+    begin = np.datetime64(start, 's') + np.arange(count) * np.timedelta64(step_minutes * 60, 's')
+    end = begin + np.timedelta64(duration_minutes * 60, 's')
+    index = np.arange(count)
+    instrument = np.array([INSTRUMENTS[value % 2] for value in index])
+    return Table([index.astype(np.int64) + 1000,
+                  instrument,
+                  np.where(index % 4 == 0, "CALIBRATION", "SCIENCE"),
+                  np.array([str(date).replace("T", " ") for date in begin]),
+                  np.array([str(date).replace("T", " ") for date in end]),
+                  np.where(index % 3 == 0, "LV2", "LV1"),
+                  np.full(count, "Solar monitoring"),
+                  np.where(instrument == "SWAP", "17.4 nm", "1-222 nm"),
+                  np.full(count, "Sun"),
+                  np.array(["obs_%d.fits" % (value + 1000) for value in index]),
+                  np.where(index % 5 == 0, "FITS", "TAR"),
+                  index.astype(np.int64) * 10 + 100,
+                  np.full(count, "PROBA2"),
+                  np.where(index % 2 == 0, "true", "false")],
+                 names=("observation_oid", "instrument_name", "observation_type", "begin_date", "end_date",
+                        "processing_level", "science_objective", "wavelength_range", "science_object_name",
+                        "file_name", "file_format", "file_size", "observatory_name", "calibrated"))
+
+
+class DummyTapServer(DummyHTTPServer):
+    """
+    DummyHTTPServer answering POST /.../tap/sync with the result of the ADQL
+    query over ``observations``. Supported: SELECT [TOP n] columns or COUNT(*),
+    FROM p2sa.v_observation [as obs], WHERE with AND/OR/NOT, comparisons and IN,
+    ORDER BY columns and OFFSET, and SELECT COUNT(*) FROM (query) AS name.
+    Tables uploaded in multipart requests are joined with
+    JOIN tap_upload.<name> AS up ON up.<column> = obs.<column>.
+
+    Asynchronous jobs are created by POST /.../tap/async and stay EXECUTING for
+    ``job_duration`` seconds, a number or a function of the query. The UWS job
+    resource .../async/<jobid> honours WAIT and PHASE when ``support_wait`` is
+    set, and .../phase, .../results/result and .../error are served. Jobs are
+    deleted by POST .../async/<jobid> with ACTION=DELETE, or by the TAP+ bulk
+    POST .../deletejobs when ``support_bulk_delete`` is set.
+
+    Every query received is recorded in ``queries``, every job in ``jobs`` and
+    every poll of a job resource in ``polls``.
+    """
+
+    def __init__(self, observations):
+        super(DummyTapServer, self).__init__()
+        self.observations = observations
+        self.queries = []
+        self.jobs = {}
+        self.polls = 0
+        self.job_duration = 0
+        self.support_wait = True
+        self.support_bulk_delete = True
+        self.responder = self.answer
+
+    def answer(self, method, path, body):
+        parts = urlsplit(path)
+        path = parts.path
+        uploads = {}
+        if body.startswith(b"--"):
+            fields, uploads = self.parse_multipart(body)
+        else:
+            fields = parse_qs(body.decode("utf-8")) if body else parse_qs(parts.query)
+        job = re.search(r"/tap/async/([^/]+)(?:/(phase|results/result|error))?$", path)
+        if job:
+            return self.answer_job(method, job.group(1), job.group(2), fields)
+        if method == "POST" and path.endswith("/tap/deletejobs"):
+            if not self.support_bulk_delete:
+                return None
+            with self._lock:
+                for jobid in fields["JOB_IDS"][0].split(","):
+                    self.jobs[jobid]["deleted"] = True
+            return b"OK"
+        if method != "POST" or not (path.endswith("/tap/sync") or path.endswith("/tap/async")):
+            return None
+        query = fields["QUERY"][0]
+        output_format = fields.get("FORMAT", ["votable"])[0].lower()
+        with self._lock:
+            self.queries.append(query)
+        if path.endswith("/tap/async"):
+            duration = self.job_duration(query) if callable(self.job_duration) else self.job_duration
+            job = {"query": query, "format": output_format, "end": time.time() + duration, "deleted": False,
+                   "result": None, "error": None}
+            try:
+                job["result"] = self.execute(query, uploads)
+            except Exception as e:
+                job["error"] = str(e) or e.__class__.__name__
+            with self._lock:
+                jobid = str(len(self.jobs) + 1)
+                self.jobs[jobid] = job
+            return 303, b"", {"Location": self.url.rstrip("/") + path + "/" + jobid}
+        return self.serialize(self.execute(query, uploads), output_format)
+
+    def answer_job(self, method, jobid, resource, fields):
+        with self._lock:
+            job = self.jobs.get(jobid)
+        if job is None or job["deleted"]:
+            return None
+        if method == "POST" and fields.get("ACTION", [""])[0].upper() == "DELETE":
+            job["deleted"] = True
+            return 303, b"", {"Location": self.url + "p2sa-sl-tap/tap/async"}
+        if resource == "results/result":
+            return self.serialize(job["result"], job["format"])
+        if resource == "error":
+            return (job["error"] or "").encode("utf-8")
+        if resource is None:
+            with self._lock:
+                self.polls = self.polls + 1
+            wait = float(fields.get("WAIT", ["0"])[0])
+            if self.support_wait and self.phase(job) in fields.get("PHASE", ["EXECUTING"]):
+                time.sleep(max(0.0, min(wait, job["end"] - time.time())))
+            return ('<uws:job xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0"><uws:jobId>%s</uws:jobId>'
+                    '<uws:phase>%s</uws:phase></uws:job>' % (jobid, self.phase(job))).encode("utf-8")
+        return self.phase(job).encode("utf-8")
+
+    @staticmethod
+    def phase(job):
+        if time.time() < job["end"]:
+            return "EXECUTING"
+        return "ERROR" if job["error"] is not None else "COMPLETED"
+
+    @staticmethod
+    def parse_multipart(body):
+        """
+        Returns the fields and the uploaded VOTables of a multipart/form-data body
+        """
+        boundary = body.split(b"\r\n", 1)[0]
+        fields = {}
+        uploads = {}
+        for part in body.split(boundary)[1:]:
+            header, _, value = part.partition(b"\r\n\r\n")
+            name = re.search(rb'name="([^"]+)"', header)
+            if name is None:
+                continue
+            value = value[:-2] if value.endswith(b"\r\n") else value
+            if b"filename=" in header:
+                uploads[name.group(1).decode("utf-8")] = Table.read(io.BytesIO(value), format="votable")
+            else:
+                fields[name.group(1).decode("utf-8")] = [value.decode("utf-8")]
+        return fields, uploads
+
+    def execute(self, query, uploads=None):
+        subquery = re.match(r"\s*SELECT\s+(?:TOP\s+\d+\s+)?COUNT\(\*\)\s+AS\s+(\w+)\s+FROM\s+\((.*)\)\s+AS\s+\w+\s*$",
+                            query, re.I | re.S)
+        if subquery:
+            return Table([[len(self.execute(subquery.group(2), uploads))]], names=(subquery.group(1),))
+        match = re.match(r"\s*SELECT\s+(?:TOP\s+(\d+)\s+)?(.*?)\s+FROM\s+p2sa\.v_observation(?:\s+as\s+obs)?"
+                         r"(?:\s+JOIN\s+tap_upload\.(\w+)\s+AS\s+up\s+ON\s+up\.(\w+)\s*=\s*obs\.(\w+))?"
+                         r"(?:\s+WHERE\s+(.*?))?(?:\s+ORDER\s+BY\s+(.*?))?(?:\s+OFFSET\s+(\d+))?\s*$",
+                         query, re.I | re.S)
+        top, columns, upload, upload_column, column, where, order_by, offset = match.groups()
+        table = self.observations
+        if upload:
+            table = table[np.isin(table[column], uploads[upload][upload_column])]
+        if where:
+            expression = self._to_python(where)
+            mask = [bool(eval(expression, {}, dict(zip(table.colnames, row)))) for row in table.as_array()]
+            table = table[np.array(mask, dtype=bool)] if len(table) else table
+        count = re.match(r"COUNT\(\*\)(?:\s+AS\s+(\w+))?$", columns.strip(), re.I)
+        if count:
+            return Table([[len(table)]], names=(count.group(1) or "count_all",))
+        if order_by:
+            # Stable sorts from the last key to the first one
+            for term in reversed(order_by.split(",")):
+                name, _, direction = term.strip().partition(" ")
+                order = np.argsort(table[name.replace("obs.", "")], kind="stable")
+                if direction.strip().upper() == "DESC":
+                    order = order[::-1]
+                table = table[order]
+        if offset:
+            table = table[int(offset):]
+        if top:
+            table = table[:int(top)]
+        if columns.strip() not in ("*", "obs.*"):
+            table = table[[name.strip().replace("obs.", "") for name in columns.split(",")]]
+        return table
+
+    @staticmethod
+    def _to_python(where):
+        expression = where.replace("obs.", "")
+        # Dates are compared as text, a date alone stands for its midnight
+        expression = re.sub(r"'(\d{4}-\d{2}-\d{2})'", r"'\1 00:00:00'", expression)
+        expression = re.sub(r"(?<![<>!=])=(?!=)", "==", expression)
+        expression = expression.replace("<>", "!=")
+        expression = re.sub(r"\bAND\b", "and", expression, flags=re.I)
+        expression = re.sub(r"\bOR\b", "or", expression, flags=re.I)
+        expression = re.sub(r"\bNOT\b", "not", expression, flags=re.I)
+        expression = re.sub(r"\bIN\s*\(([^)]*)\)", r"in (\1,)", expression, flags=re.I)
+        return expression
+
+    @staticmethod
+    def serialize(table, output_format):
+        output = io.BytesIO()
+        if output_format == "csv":
+            text = io.StringIO()
+            table.write(text, format="ascii.csv")
+            output.write(text.getvalue().encode("utf-8"))
+        elif output_format == "json":
+            metadata = [{"name": name} for name in table.colnames]
+            data = [[value.item() if hasattr(value, "item") else value for value in row] for row in table]
+            output.write(json.dumps({"metadata": metadata, "data": data}).encode("utf-8"))
+        else:
+            from_table(table).to_xml(output)
+        return output.getvalue()
@@ -13,7 +13,7 @@ import os
 # from astroquery.utils.tap.conn.tests.DummyConnHandler import DummyConnHandler
 
 from esa_p2sa.p2sa_core import ESAP2SAClass
-from esa_p2sa.tests.dummy_handler import DummyP2SAHandler
+from esa_p2sa.tests.dummy_handler import DummyDataTransport, DummyP2SAHandler
 
 from esa_p2sa.tests.dummy_tap_handler import DummyTapHandler
 from astroquery.utils.tap.xmlparser import utils
@@ -89,7 +89,8 @@ class TestESAP2SA:
                                      filename=parameters['filename'],
                                      verbose=parameters['verbose'])
 
-    def test_download_p2sa_product(self):
+    def test_download_p2sa_product(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
         file_oid_list = ["6605", "6606"]
 
         parameters = {'file_oid_list': file_oid_list,
@@ -99,14 +100,19 @@ class TestESAP2SA:
                       'verbose': False}
 
         connHandler = DummyTapHandler()
-        p2sa = ESAP2SAClass(connHandler)
-        p2sa.get_p2sa_product(file_oid_list=parameters['file_oid_list'],
-                              data_retrieval_origin=parameters['data_retrieval_origin'],
-                              filename=parameters['filename'],
-                              retrieval_type=parameters['retrieval_type'],
-                              verbose=parameters['verbose'])
-
-    def test_get_p2sa_postcard(self):
+        transport = DummyDataTransport({"6605,6606": b"product"})
+        p2sa = ESAP2SAClass(connHandler, transport=transport)
+        manifest = p2sa.get_p2sa_product(file_oid_list=parameters['file_oid_list'],
+                                         data_retrieval_origin=parameters['data_retrieval_origin'],
+                                         filename=parameters['filename'],
+                                         retrieval_type=parameters['retrieval_type'],
+                                         verbose=parameters['verbose'])
+        assert manifest[0].error is None
+        with open(parameters['filename'], 'rb') as fh:
+            assert fh.read() == b"product"
+
+    def test_get_p2sa_postcard(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
         parameters = {'input_observation_oid': "198028195",
                       'input_resolution': "low",
                       'input_data_retrieval_origin': "P2SAPY",
@@ -115,15 +121,19 @@ class TestESAP2SA:
                       'filename': 'output',
                       'verbose': False}
         connHandler = DummyTapHandler()
-        p2sa = ESAP2SAClass(connHandler)
-
-        p2sa.get_p2sa_postcard(observation_oid=parameters['input_observation_oid'],
-                               resolution=parameters['input_resolution'],
-                               data_retrieval_origin=parameters['input_data_retrieval_origin'],
-                               filename=parameters['filename'],
-                               retrival_type=parameters['input_retrieval_type'],
-                               product_type=parameters['input_product_type'],
-                               verbose=parameters['verbose'])
+        transport = DummyDataTransport({"198028195": b"postcard"})
+        p2sa = ESAP2SAClass(connHandler, transport=transport)
+
+        link = p2sa.get_p2sa_postcard(observation_oid=parameters['input_observation_oid'],
+                                      resolution=parameters['input_resolution'],
+                                      data_retrieval_origin=parameters['input_data_retrieval_origin'],
+                                      filename=parameters['filename'],
+                                      retrival_type=parameters['input_retrieval_type'],
+                                      product_type=parameters['input_product_type'],
+                                      verbose=parameters['verbose'])
+        assert transport.links == [link]
+        with open(parameters['filename'], 'rb') as fh:
+            assert fh.read() == b"postcard"
 
     def test_query_p2sa_observations_no_instrument_2dates(self):
         instrument_list = []
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import asyncio
+import os
+import threading
+
+import pytest
+
+from esa_p2sa.p2sa_async import AsyncESAP2SA
+from esa_p2sa.p2sa_cache import ProductCache, QueryCache
+from esa_p2sa.p2sa_core import ESAP2SAClass
+from esa_p2sa.tests.dummy_http_server import DummyHTTPServer
+from esa_p2sa.tests.dummy_tap_handler import DummyTapHandler
+
+aiohttp = pytest.importorskip("aiohttp")
+
+
+class ThreadRecordingCache(ProductCache):
+    """Product cache that records the thread of every get and put."""
+
+    def __init__(self, cache_dir):
+        super(ThreadRecordingCache, self).__init__(cache_dir)
+        self.threads = []
+
+    def get(self, key, filename):
+        self.threads.append(threading.current_thread())
+        return super(ThreadRecordingCache, self).get(key, filename)
+
+    def put(self, key, filename):
+        self.threads.append(threading.current_thread())
+        return super(ThreadRecordingCache, self).put(key, filename)
+
+
+def local_client(server, product_cache=None):
+    p2sa = ESAP2SAClass(DummyTapHandler(), product_cache=product_cache)
+    p2sa.data_url = server.url + "p2sa-sl-tap/data?"
+    p2sa.metadata_url = server.url + "p2sa-sl-tap/tap/sync?"
+    return p2sa
+
+
+def postcard_link(p2sa, oid):
+    return p2sa.data_url + "RETRIEVAL_TYPE=PRODUCT&observation_oid=%s&resolution=low" \
+                           "&PRODUCT_TYPE=POSTCARD&data_retrieval_origin=P2SAPY" % oid
+
+
+def observation_link(p2sa, oid):
+    return p2sa.data_url + "retrieval_type=PRODUCT&observation_oid=%s&product_type=OBSERVATION" \
+                           "&data_retrieval_origin=P2SAPY" % oid
+
+
+class TestAsyncESAP2SA:
+
+    def test_query_p2sa_observations(self):
+        with DummyHTTPServer() as server:
+            server.set_payload(server.url + "p2sa-sl-tap/tap/sync", b"observation_oid,instrument_name\n1,SWAP\n")
+
+            async def run():
+                async with AsyncESAP2SA(local_client(server)) as p2sa:
+                    return await p2sa.query_p2sa_observations(instruments=["SWAP"], from_date="2017-01-07")
+
+            table = asyncio.run(run())
+            assert list(table["instrument_name"]) == ["SWAP"]
+            assert [request[0] for request in server.requests] == ["POST"]
+
+    def test_query_cache(self, tmp_path):
+        with DummyHTTPServer() as server:
+            server.set_payload(server.url + "p2sa-sl-tap/tap/sync", b"observation_oid,instrument_name\n1,SWAP\n")
+            client = local_client(server)
+            client.query_cache = QueryCache(str(tmp_path))
+
+            async def run():
+                async with AsyncESAP2SA(client) as p2sa:
+                    tables = [await p2sa.query_p2sa_tap("SELECT * FROM p2sa.v_observation", output_format='csv')
+                              for attempt in range(3)]
+                    await p2sa.query_p2sa_tap("SELECT * FROM p2sa.v_observation", output_format='csv',
+                                              refresh_cache=True)
+                    return tables
+
+            tables = asyncio.run(run())
+            assert [list(table["instrument_name"]) for table in tables] == [["SWAP"]] * 3
+            assert len(server.requests) == 2
+            assert client.query_cache.hits == 2
+
+    def test_concurrent_postcards(self, tmp_path):
+        with DummyHTTPServer() as server:
+            server.delay = 0.05
+            client = local_client(server)
+            for oid in range(20):
+                server.set_payload(postcard_link(client, oid), b"jpg %d" % oid)
+
+            async def ticker(ticks, done):
+                while not done.is_set():
+                    ticks.append(1)
+                    await asyncio.sleep(0.01)
+
+            async def run():
+                ticks = []
+                done = asyncio.Event()
+                async with AsyncESAP2SA(client, max_concurrency=4) as p2sa:
+                    ticking = asyncio.ensure_future(ticker(ticks, done))
+                    filenames = await asyncio.gather(*[
+                        p2sa.get_p2sa_postcard(oid, filename=str(tmp_path / ("%d.jpg" % oid))) for oid in range(20)])
+                    done.set()
+                    await ticking
+                return filenames, ticks
+
+            filenames, ticks = asyncio.run(run())
+            for oid, filename in enumerate(filenames):
+                with open(filename, 'rb') as fh:
+                    assert fh.read() == b"jpg %d" % oid
+            # The event loop kept running while the postcards were downloaded
+            assert len(ticks) > 10
+            assert len(server.requests) == 20
+            assert server.connections <= 4
+
+    def test_cancel_download(self, tmp_path):
+        with DummyHTTPServer() as server:
+            client = local_client(server)
+            server.set_payload(observation_link(client, "1"), b"x" * 1000)
+            filename = str(tmp_path / "obs")
+
+            async def run():
+                async with AsyncESAP2SA(client) as p2sa:
+                    server.delay = 1
+                    task = asyncio.ensure_future(p2sa.get_p2sa_observation("1", filename=filename))
+                    await asyncio.sleep(0.1)
+                    task.cancel()
+                    with pytest.raises(asyncio.CancelledError):
+                        await task
+                    assert os.listdir(str(tmp_path)) == []
+
+                    # The client is still usable after a cancellation
+                    server.delay = 0
+                    return await p2sa.get_p2sa_observation("1", filename=filename)
+
+            assert asyncio.run(run()) == filename + ".tar"
+            assert os.listdir(str(tmp_path)) == ["obs.tar"]
+
+    def test_cache_off_the_event_loop(self, tmp_path):
+        with DummyHTTPServer() as server:
+            cache = ThreadRecordingCache(str(tmp_path / "cache"))
+            client = local_client(server, product_cache=cache)
+            server.set_payload(observation_link(client, "1"), b"tar 1")
+
+            async def run():
+                async with AsyncESAP2SA(client) as p2sa:
+                    await p2sa.get_p2sa_observation("1", filename=str(tmp_path / "first"))
+                    await p2sa.get_p2sa_observation("1", filename=str(tmp_path / "second"))
+
+            asyncio.run(run())
+            # get, put, then get served from the cache
+            assert len(cache.threads) == 3
+            assert threading.main_thread() not in cache.threads
+            assert len(server.requests) == 1
+            with open(str(tmp_path / "second.tar"), 'rb') as fh:
+                assert fh.read() == b"tar 1"
+
+    def test_observations_and_products(self, tmp_path):
+        with DummyHTTPServer() as server:
+            client = local_client(server, product_cache=ProductCache(str(tmp_path / "cache")))
+            for oid in ("1", "2"):
+                server.set_payload(observation_link(client, oid), b"tar " + oid.encode())
+            selected_oids, link = client._build_product_links(["10", "11"])[0]
+            server.set_payload(link, b"product")
+
+            async def run():
+                async with AsyncESAP2SA(client) as p2sa:
+                    results = await p2sa.get_p2sa_observations(["1", "404", "2"], out_dir=str(tmp_path / "obs"))
+                    manifest = await p2sa.get_p2sa_product(["10", "11"], filename=str(tmp_path / "product.tar"))
+                    # Served from the product cache
+                    await p2sa.get_p2sa_observations(["1", "2"], out_dir=str(tmp_path / "again"))
+                    return results, manifest
+
+            results, manifest = asyncio.run(run())
+            assert [result.oid for result in results] == ["1", "404", "2"]
+            assert results[0].error is None and results[2].error is None
+            assert isinstance(results[1].error, IOError)
+            assert not os.path.exists(str(tmp_path / "obs" / "404.tar"))
+            assert manifest[0].path == str(tmp_path / "product.tar") and manifest[0].bytes == len(b"product")
+            assert len(server.requests) == 4
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from esa_p2sa.p2sa_cache import ProductCache
+from esa_p2sa.p2sa_core import ESAP2SAClass
+from esa_p2sa.tests.dummy_handler import DummyDataTransport
+from esa_p2sa.tests.dummy_tap_handler import DummyTapHandler
+
+
+def write_file(path, content):
+    with open(path, 'wb') as fh:
+        fh.write(content)
+    return path
+
+
+def read_file(path):
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+
+def fill_cache(directory, worker, count):
+    cache = ProductCache(directory, max_bytes=20000)
+    source = os.path.join(directory, "..", "source_%d" % worker)
+    write_file(source, bytes([worker]) * 1000)
+    for index in range(count):
+        cache.put(ProductCache.key("PRODUCT", "%d_%d" % (worker, index), "OBSERVATION"), source)
+
+
+class TestProductCache:
+
+    def test_key(self):
+        key = ProductCache.key("PRODUCT", "197889204", "OBSERVATION")
+        assert key == ProductCache.key("product", "197889204", "observation", None)
+        assert key != ProductCache.key("PRODUCT", "197889204", "POSTCARD")
+        assert ProductCache.key("PRODUCT", "1", "POSTCARD", "low") != \
+            ProductCache.key("PRODUCT", "1", "POSTCARD", "high")
+
+    def test_get_put(self, tmp_path):
+        cache = ProductCache(str(tmp_path / "cache"), max_bytes=1000)
+        key = ProductCache.key("PRODUCT", "1", "OBSERVATION")
+        destination = str(tmp_path / "1.tar")
+        assert not cache.get(key, destination)
+        assert not os.path.exists(destination)
+
+        cache.put(key, write_file(str(tmp_path / "source"), b"content"))
+        assert cache.get(key, destination)
+        assert read_file(destination) == b"content"
+        assert cache.size() == len(b"content")
+
+    def test_lru_eviction(self, tmp_path):
+        cache = ProductCache(str(tmp_path / "cache"), max_bytes=300)
+        source = write_file(str(tmp_path / "source"), b"x" * 100)
+        keys = [ProductCache.key("PRODUCT", str(oid), "OBSERVATION") for oid in range(4)]
+        for key in keys[:3]:
+            cache.put(key, source)
+            time.sleep(0.01)
+        # Reading the oldest entry makes the second one the least recently used
+        assert cache.get(keys[0], str(tmp_path / "hit"))
+        time.sleep(0.01)
+        cache.put(keys[3], source)
+
+        assert cache.size() == 300
+        assert os.path.exists(cache.path(keys[0]))
+        assert not os.path.exists(cache.path(keys[1]))
+        assert os.path.exists(cache.path(keys[2]))
+        assert os.path.exists(cache.path(keys[3]))
+
+        # Products larger than the whole cache are not stored
+        cache.put(ProductCache.key("PRODUCT", "big", "OBSERVATION"),
+                  write_file(str(tmp_path / "big"), b"x" * 301))
+        assert cache.size() == 300
+
+    def test_shared_between_processes(self, tmp_path):
+        directory = str(tmp_path / "cache")
+        ProductCache(directory)
+        processes = [multiprocessing.Process(target=fill_cache, args=(directory, worker, 10))
+                     for worker in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0
+
+        cache = ProductCache(directory, max_bytes=20000)
+        assert cache.size() <= 20000
+        assert not [name for name in os.listdir(directory) if name.startswith(".tmp-")]
+        for name in os.listdir(directory):
+            if not name.startswith("."):
+                content = read_file(os.path.join(directory, name))
+                assert content == content[:1] * 1000
+
+    def test_invalid_parameters(self, tmp_path):
+        with pytest.raises(ValueError):
+            ProductCache("")
+        with pytest.raises(ValueError):
+            ProductCache(str(tmp_path), max_bytes=-1)
+
+    def test_downloads_served_from_cache(self, tmp_path):
+        transport = DummyDataTransport({"197889204": b"tar content", "198026707": b"jpg content"})
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=transport, product_cache=ProductCache(str(tmp_path / "cache")))
+
+        for attempt in range(3):
+            p2sa.get_p2sa_observation(obs_oid="197889204", filename=str(tmp_path / ("obs_%d" % attempt)))
+            p2sa.get_p2sa_postcard(observation_oid="198026707", filename=str(tmp_path / ("postcard_%d" % attempt)))
+            assert read_file(str(tmp_path / ("obs_%d.tar" % attempt))) == b"tar content"
+            assert read_file(str(tmp_path / ("postcard_%d" % attempt))) == b"jpg content"
+
+        # Only the first round reached the server
+        assert len(transport.links) == 2
+        results = p2sa.get_p2sa_observations(["197889204"], out_dir=str(tmp_path / "bulk"))
+        assert results[0].error is None
+        assert len(transport.links) == 2
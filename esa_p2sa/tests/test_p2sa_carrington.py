@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import json
+import os
+import time
+from urllib.parse import unquote_plus
+
+import numpy as np
+import pytest
+
+from esa_p2sa.p2sa_cache import ProductCache
+from esa_p2sa.p2sa_carrington import carrington_rotation_to_date, date_to_carrington_rotation
+from esa_p2sa.p2sa_core import ESAP2SAClass
+from esa_p2sa.tests.dummy_handler import DummyDataResponse
+from esa_p2sa.tests.dummy_http_server import DummyHTTPServer
+from esa_p2sa.tests.dummy_tap_handler import DummyTapHandler
+
+
+class DummyMetadataTransport(object):
+    """Answers every GET with the same JSON TAP response."""
+
+    def __init__(self, rows, names=("file_oid",)):
+        metadata = [{"name": name} for name in names]
+        self.body = json.dumps({"metadata": metadata, "data": rows}).encode()
+        self.links = []
+
+    def request(self, method, link, headers=None, data=None, allow_redirects=True):
+        self.links.append(link)
+        return DummyDataResponse(self.body)
+
+
+class TestP2SACarrington:
+
+    def test_query_carrington_movie_without_downloads(self):
+        transport = DummyMetadataTransport([[oid] for oid in range(13000, 13062)])
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=transport)
+
+        start = time.time()
+        links = p2sa.query_carrington_movie(input_date="2010-10-12")
+
+        # Only the metadata query reaches the server
+        assert len(transport.links) == 1
+        assert time.time() - start < 1
+        assert len(links) == 62
+        assert links[0] == p2sa.video_url + "file_oid=13000&data_retrieval_origin=P2SAPY"
+
+    def test_display_p2sa_movie_file_check(self):
+        with DummyHTTPServer() as server:
+            p2sa = ESAP2SAClass(DummyTapHandler())
+            p2sa.video_url = server.url + "p2sa-sl-tap/video?"
+            link = p2sa.video_url + "file_oid=13785&data_retrieval_origin=P2SAPY"
+            server.set_payload(link, b"movie" * 100000)
+
+            assert p2sa.display_p2sa_movie_file(file_oid="13785") == link
+            assert server.requests == []
+
+            assert p2sa.display_p2sa_movie_file(file_oid="13785", check=True) == link
+            assert p2sa.display_p2sa_movie_file(file_oid="1", check=True) is None
+            assert [request[0] for request in server.requests] == ["HEAD", "HEAD"]
+            assert server.bytes_sent == 0
+
+    def test_rotation_conversion(self):
+        # Carrington rotation 2100 started on 2010-07-13 and 2200 on 2017-12-30
+        dates = carrington_rotation_to_date([2100, 2200])
+        assert [str(date)[:10] for date in dates] == ["2010-07-13", "2017-12-30"]
+        assert int(date_to_carrington_rotation("2010-10-12")) == 2103
+
+        rotations = np.arange(1800, 2300)
+        assert np.allclose(date_to_carrington_rotation(carrington_rotation_to_date(rotations)), rotations)
+
+    def test_query_carrington_movies_by_rotation(self):
+        names = ("file_oid", "file_type", "start_date", "end_date")
+        rows = [[13000 + rotation, "CR", str(start).replace("T", " "), str(end).replace("T", " ")]
+                for rotation, start, end in zip(range(2100, 2104),
+                                                carrington_rotation_to_date(range(2100, 2104)),
+                                                carrington_rotation_to_date(range(2101, 2105)))]
+        transport = DummyMetadataTransport(rows, names)
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=transport)
+
+        table = p2sa.query_carrington_movies(from_rotation=2100, to_rotation=2103, file_type="CR")
+
+        # A single query covers the whole range
+        assert len(transport.links) == 1
+        query = unquote_plus(transport.links[0])
+        assert "(end_date > '2010-07-13 10:30:54')" in query
+        assert "(start_date < '%s')" % str(carrington_rotation_to_date(2104)).replace("T", " ") in query
+        assert "(file_type in ('CR'))" in query
+        assert list(table["carrington_rotation"]) == [2100, 2101, 2102, 2103]
+        assert table["link"][0] == p2sa.video_url + "file_oid=15100&data_retrieval_origin=P2SAPY"
+
+        p2sa.query_carrington_movies(from_date="2010-10-12", to_date="2010-11-12")
+        query = unquote_plus(transport.links[1])
+        assert "(end_date > '2010-10-12 00:00:00') AND (start_date < '2010-11-12 00:00:00')" in query
+        assert "(file_type in ('CR','CR_YELLOW'))" in query
+
+    def test_query_carrington_movies_invalid_range(self):
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=DummyMetadataTransport([]))
+        with pytest.raises(ValueError):
+            p2sa.query_carrington_movies()
+        with pytest.raises(ValueError):
+            p2sa.query_carrington_movies(from_date="2010-10-12", from_rotation=2100)
+        with pytest.raises(ValueError):
+            p2sa.query_carrington_movies(from_date="2010-10-12", to_date="2010-10-01")
+
+    def test_get_p2sa_movie_file_cached(self, tmp_path):
+        transport = DummyMetadataTransport([])
+        transport.body = b"movie" * 1000
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=transport, movie_cache=ProductCache(str(tmp_path / "movies")))
+
+        for attempt in range(3):
+            filename = p2sa.get_p2sa_movie_file(13785, filename=str(tmp_path / ("movie_%d.mp4" % attempt)))
+            assert os.path.getsize(filename) == 5000
+
+        # Only the first display downloaded the movie
+        assert transport.links == [p2sa.video_url + "file_oid=13785&data_retrieval_origin=P2SAPY"]
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tracemalloc
+
+import pytest
+
+from esa_p2sa.p2sa_core import ESAP2SAClass
+from esa_p2sa import conf
+from esa_p2sa.p2sa_download import MIN_SEGMENT_SIZE, download_resumable, download_segmented, extract_tar_stream, \
+    open_url, split_oid_list, stream_response
+from esa_p2sa.tests.dummy_handler import DummyDataResponse, DummyDataTransport
+from esa_p2sa.tests.dummy_http_server import DummyHTTPServer
+from esa_p2sa.tests.dummy_tap_handler import DummyTapHandler
+
+
+class DummyStreamResponse(object):
+    """Response that generates ``size`` bytes on the fly, without holding them in memory."""
+
+    def __init__(self, size):
+        self.size = size
+        self.position = 0
+
+    def readinto(self, buffer):
+        read_bytes = min(len(buffer), self.size - self.position)
+        buffer[:read_bytes] = b'x' * read_bytes
+        self.position = self.position + read_bytes
+        return read_bytes
+
+
+class NullSink(object):
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written = self.written + len(data)
+
+
+class DroppingDataTransport(DummyDataTransport):
+    """Data transport whose responses fail after ``fail_after`` bytes, as a dropped connection."""
+
+    def __init__(self, payloads, fail_after):
+        super(DroppingDataTransport, self).__init__(payloads)
+        self.fail_after = fail_after
+
+    def request(self, method, link, headers=None, data=None, allow_redirects=True):
+        response = super(DroppingDataTransport, self).request(method, link, headers, data, allow_redirects)
+        fail_after = self.fail_after
+
+        def readinto(buffer):
+            if response.tell() >= fail_after:
+                raise IOError("Connection reset by peer")
+            return io.BytesIO.readinto(response, memoryview(buffer)[:fail_after - response.tell()])
+
+        response.readinto = readinto
+        return response
+
+
+def make_tar(files):
+    content = io.BytesIO()
+    with tarfile.open(fileobj=content, mode="w") as tar:
+        for name in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(files[name])
+            tar.addfile(info, io.BytesIO(files[name]))
+    return content.getvalue()
+
+
+def measure_peak(size, chunk_size):
+    sink = NullSink()
+    tracemalloc.start()
+    stream_response(DummyStreamResponse(size), sink, chunk_size)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert sink.written == size
+    return peak
+
+
+class TestP2SADownload:
+
+    def test_stream_response_read_fallback(self):
+        payload = b'0123456789' * 1000
+        fh = io.BytesIO()
+        written = stream_response(io.BufferedReader(io.BytesIO(payload)), fh, chunk_size=64)
+        assert written == len(payload)
+        assert fh.getvalue() == payload
+
+        # Responses without readinto are read in chunk_size pieces
+        class ReadOnly(object):
+            def __init__(self, data):
+                self.data = io.BytesIO(data)
+
+            def read(self, size):
+                return self.data.read(size)
+
+        fh = io.BytesIO()
+        assert stream_response(ReadOnly(payload), fh, chunk_size=7) == len(payload)
+        assert fh.getvalue() == payload
+
+    def test_stream_response_invalid_chunk_size(self):
+        with pytest.raises(ValueError):
+            stream_response(io.BytesIO(b'data'), io.BytesIO(), chunk_size=0)
+
+    def test_stream_response_memory_is_flat(self):
+        chunk_size = 64 * 1024
+        small_peak = measure_peak(1 * 1024 * 1024, chunk_size)
+        large_peak = measure_peak(64 * 1024 * 1024, chunk_size)
+        # Peak usage is bounded by the chunk buffer, not by the payload
+        assert large_peak < 4 * chunk_size
+        assert abs(large_peak - small_peak) < chunk_size
+
+    def test_get_file_streams_to_disk(self, tmp_path):
+        p2sa = ESAP2SAClass(DummyTapHandler())
+        output_file = str(tmp_path / "observation.tar")
+        written = p2sa.get_file(output_file, response=DummyStreamResponse(300000), chunk_size=4096)
+        assert written == 300000
+        with open(output_file, 'rb') as fh:
+            assert fh.read() == b'x' * 300000
+
+    def test_get_p2sa_observation(self, tmp_path):
+        transport = DummyDataTransport({"197889204": b"tar content"})
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=transport)
+        p2sa.get_p2sa_observation(obs_oid="197889204", filename=str(tmp_path / "obs"))
+        assert transport.links == [p2sa.data_url + "retrieval_type=PRODUCT&observation_oid=197889204"
+                                 "&product_type=OBSERVATION&data_retrieval_origin=P2SAPY"]
+        with open(str(tmp_path / "obs.tar"), 'rb') as fh:
+            assert fh.read() == b"tar content"
+
+    def test_get_p2sa_observations(self, tmp_path):
+        payloads = {str(oid): str(oid).encode() * 1000 for oid in range(100, 140)}
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=DummyDataTransport(payloads))
+        obs_oids = sorted(payloads) + ["999"]
+
+        results = p2sa.get_p2sa_observations(obs_oids, workers=8, out_dir=str(tmp_path / "out"))
+
+        assert [result.oid for result in results] == obs_oids
+        for result in results[:-1]:
+            assert result.error is None
+            assert result.bytes == len(payloads[result.oid])
+            assert result.duration >= 0
+            with open(result.path, 'rb') as fh:
+                assert fh.read() == payloads[result.oid]
+        # A failed oid is reported without aborting the batch or leaving a file behind
+        failed = results[-1]
+        assert failed.path is None
+        assert failed.bytes == 0
+        assert isinstance(failed.error, IOError)
+        assert not (tmp_path / "out" / "999.tar").exists()
+
+    def test_get_p2sa_observations_invalid_workers(self):
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=DummyDataTransport({}))
+        with pytest.raises(ValueError):
+            p2sa.get_p2sa_observations(["1"], workers=0)
+
+    def test_resume_interrupted_download(self, tmp_path):
+        payload = os.urandom(2 * 1024 * 1024)
+        filename = str(tmp_path / "197889204.tar")
+        with DummyHTTPServer() as server:
+            p2sa = ESAP2SAClass(DummyTapHandler())
+            p2sa.data_url = server.url + "p2sa-sl-tap/data?"
+            link = p2sa._build_observation_link("197889204", "PRODUCT", "OBSERVATION", "P2SAPY")
+            server.set_payload(link, payload)
+
+            # The connection drops after 1.5 MB: partial file and sidecar are kept
+            dropped_at = 1536 * 1024
+            server.fail_after = dropped_at
+            with pytest.raises(Exception):
+                download_resumable(link, filename, chunk_size=64 * 1024)
+            assert not os.path.exists(filename)
+            assert os.path.exists(filename + ".part")
+            assert os.path.exists(filename + ".part.json")
+            received = os.path.getsize(filename + ".part")
+            assert 0 < received <= dropped_at
+
+            # Restarting transfers only the remaining bytes
+            server.reset_counters()
+            p2sa.get_p2sa_observation(obs_oid="197889204", filename=str(tmp_path / "197889204"),
+                                      resume=True)
+            assert server.bytes_sent == len(payload) - received
+            assert server.requests[0][2]["Range"] == "bytes=%d-" % received
+            with open(filename, 'rb') as fh:
+                assert fh.read() == payload
+            assert not os.path.exists(filename + ".part")
+            assert not os.path.exists(filename + ".part.json")
+
+    def test_resume_without_range_support(self, tmp_path):
+        payload = os.urandom(256 * 1024)
+        filename = str(tmp_path / "product.tar")
+        with DummyHTTPServer(support_ranges=False) as server:
+            link = server.url + "p2sa-sl-tap/data?retrieval_type=PRODUCT&file_oid=6605"
+            server.set_payload(link, payload)
+            with open(filename + ".part", 'wb') as fh:
+                fh.write(payload[:1000])
+            with open(filename + ".part.json", 'w') as fh:
+                fh.write('{"url": "%s", "expected_size": %d}' % (link, len(payload)))
+
+            # The server ignores Range: the full product is downloaded again
+            transferred = download_resumable(link, filename)
+            assert transferred == len(payload)
+            assert server.bytes_sent == len(payload)
+            with open(filename, 'rb') as fh:
+                assert fh.read() == payload
+
+    def test_resume_changed_product(self, tmp_path):
+        payload = os.urandom(64 * 1024)
+        filename = str(tmp_path / "product.tar")
+        with DummyHTTPServer() as server:
+            link = server.url + "p2sa-sl-tap/data?retrieval_type=PRODUCT&file_oid=6605"
+            server.set_payload(link, payload)
+            with open(filename + ".part", 'wb') as fh:
+                fh.write(b"stale content")
+            with open(filename + ".part.json", 'w') as fh:
+                fh.write('{"url": "%s", "expected_size": %d, "etag": "\\"stale\\""}' % (link, len(payload)))
+
+            # If-Range does not match the current ETag, so the server sends the whole body
+            download_resumable(link, filename)
+            with open(filename, 'rb') as fh:
+                assert fh.read() == payload
+
+    @pytest.mark.parametrize("through_transport", [False, True])
+    def test_resume_complete_part_without_size(self, tmp_path, through_transport):
+        payload = os.urandom(64 * 1024)
+        filename = str(tmp_path / "product.tar")
+        with DummyHTTPServer() as server:
+            link = server.url + "p2sa-sl-tap/data?retrieval_type=PRODUCT&file_oid=6605"
+            server.set_payload(link, payload)
+            with open(filename + ".part", 'wb') as fh:
+                fh.write(payload)
+            with open(filename + ".part.json", 'w') as fh:
+                json.dump({"url": link, "expected_size": None,
+                           "etag": '"%s"' % hashlib.md5(payload).hexdigest()}, fh)
+
+            # The range starts past the end (416): the product is requested again
+            opener = ESAP2SAClass(DummyTapHandler())._open_url if through_transport else None
+            assert download_resumable(link, filename, opener=opener) == len(payload)
+            assert [request[2].get("Range") for request in server.requests] == ["bytes=%d-" % len(payload), None]
+            with open(filename, 'rb') as fh:
+                assert fh.read() == payload
+            assert not os.path.exists(filename + ".part")
+            assert not os.path.exists(filename + ".part.json")
+
+    def test_resume_after_network_error(self, tmp_path):
+        payload = os.urandom(64 * 1024)
+        filename = str(tmp_path / "product.tar")
+        with DummyHTTPServer() as server:
+            link = server.url + "p2sa-sl-tap/data?retrieval_type=PRODUCT&file_oid=6605"
+            server.set_payload(link, payload)
+            with open(filename + ".part", 'wb') as fh:
+                fh.write(payload[:1000])
+            with open(filename + ".part.json", 'w') as fh:
+                json.dump({"url": link, "expected_size": len(payload),
+                           "etag": '"%s"' % hashlib.md5(payload).hexdigest()}, fh)
+
+            failures = [IOError("Connection reset by peer")]
+
+            def flaky(link, headers):
+                if failures:
+                    raise failures.pop()
+                return open_url(link, headers)
+
+            # The part file is kept for the next attempt instead of starting again
+            with pytest.raises(IOError):
+                download_resumable(link, filename, opener=flaky)
+            assert len(server.requests) == 0
+            assert os.path.getsize(filename + ".part") == 1000
+            assert os.path.exists(filename + ".part.json")
+
+            assert download_resumable(link, filename, opener=flaky) == len(payload) - 1000
+            assert [request[2].get("Range") for request in server.requests] == ["bytes=1000-"]
+            with open(filename, 'rb') as fh:
+                assert fh.read() == payload
+
+    def test_resume_without_validator(self, tmp_path):
+        payload = os.urandom(64 * 1024)
+        filename = str(tmp_path / "product.tar")
+        with DummyHTTPServer() as server:
+            link = server.url + "p2sa-sl-tap/data?retrieval_type=PRODUCT&file_oid=6605"
+            server.set_payload(link, payload)
+            with open(filename + ".part", 'wb') as fh:
+                fh.write(b"content of a previous version")
+            with open(filename + ".part.json", 'w') as fh:
+                fh.write('{"url": "%s", "expected_size": null}' % link)
+
+            # Nothing tells whether the product changed: no bytes are spliced
+            download_resumable(link, filename)
+            assert "Range" not in server.requests[0][2]
+            with open(filename, 'rb') as fh:
+                assert fh.read() == payload
+
+    def test_segmented_download(self, tmp_path):
+        payload = os.urandom(4 * MIN_SEGMENT_SIZE + 12345)
+        filename = str(tmp_path / "product.tar")
+        with DummyHTTPServer() as server:
+            p2sa = ESAP2SAClass(DummyTapHandler())
+            p2sa.data_url = server.url + "p2sa-sl-tap/data?"
+            server.set_payload(p2sa.data_url + "retrieval_type=PRODUCT&QUERY=SELECT+file_name%2C+file_path+FROM+"
+                                               "p2sa.file+where+file_oid+in+%286605%29&data_retrieval_origin=P2SAPY",
+                               payload)
+
+            p2sa.get_p2sa_product(file_oid_list=["6605"], filename=filename, segments=4)
+
+            # One probe plus four ranges, each byte sent once
+            ranges = [headers["Range"] for method, path, headers in server.requests]
+            assert ranges[0] == "bytes=0-0"
+            assert len(ranges) == 5
+            assert server.bytes_sent == len(payload) + 1
+            with open(filename, 'rb') as fh:
+                assert fh.read() == payload
+            assert not os.path.exists(filename + ".part")
+
+    def test_segmented_download_without_range_support(self, tmp_path):
+        payload = os.urandom(3 * MIN_SEGMENT_SIZE)
+        filename = str(tmp_path / "product.tar")
+        with DummyHTTPServer(support_ranges=False) as server:
+            link = server.url + "p2sa-sl-tap/data?retrieval_type=PRODUCT&file_oid=6605"
+            server.set_payload(link, payload)
+
+            written = download_segmented(link, filename, segments=4)
+
+            # The probe response carries the whole product over a single connection
+            assert written == len(payload)
+            assert len(server.requests) == 1
+            with open(filename, 'rb') as fh:
+                assert fh.read() == payload
+
+    def test_segmented_download_small_product(self, tmp_path):
+        payload = os.urandom(1000)
+        filename = str(tmp_path / "product.tar")
+        with DummyHTTPServer() as server:
+            link = server.url + "p2sa-sl-tap/data?retrieval_type=PRODUCT&file_oid=6605"
+            server.set_payload(link, payload)
+            assert download_segmented(link, filename, segments=8) == len(payload)
+            assert len(server.requests) == 2
+            with open(filename, 'rb') as fh:
+                assert fh.read() == payload
+
+    def test_segmented_download_failures(self, tmp_path):
+        filename = str(tmp_path / "product.tar")
+        with DummyHTTPServer(support_ranges=False) as server:
+            link = server.url + "p2sa-sl-tap/data?retrieval_type=PRODUCT&file_oid=6605"
+            server.set_payload(link, os.urandom(64 * 1024))
+            # The single stream used without range support is dropped
+            server.fail_after = 1000
+            with pytest.raises(Exception):
+                download_segmented(link, filename, segments=4)
+        assert os.listdir(str(tmp_path)) == []
+
+        # Segments answered without their range
+        responses = []
+
+        def opener(link, headers):
+            if headers["Range"] == "bytes=0-0":
+                response = DummyDataResponse(b"x", 206, headers={"Content-Range": "bytes 0-0/%d" % (
+                    3 * MIN_SEGMENT_SIZE)})
+            else:
+                response = DummyDataResponse(b"x" * 3 * MIN_SEGMENT_SIZE)
+            responses.append(response)
+            return response
+
+        with pytest.raises(IOError):
+            download_segmented(link, filename, segments=3, opener=opener)
+        assert len(responses) == 4
+        assert all(response.closed for response in responses)
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_segmented_download_empty_product(self, tmp_path):
+        filename = str(tmp_path / "product.tar")
+
+        def opener(link, headers):
+            return DummyDataResponse(b"", 206, headers={"Content-Range": "bytes 0-0/0"})
+
+        assert download_segmented("http://localhost/empty", filename, segments=4, opener=opener) == 0
+        assert os.path.getsize(filename) == 0
+        assert not os.path.exists(filename + ".part")
+
+    def test_split_oid_list(self):
+        oids = [str(oid) for oid in range(1000, 1100)]
+        chunks = split_oid_list(oids, 30, 1000)
+        assert [len(chunk) for chunk in chunks] == [30, 30, 30, 10]
+        assert sum(chunks, []) == oids
+
+        # 'xxxx,xxxx,xxxx' is 14 characters, a fourth oid would need 19
+        chunks = split_oid_list(oids, 1000, 18)
+        assert all(len(",".join(chunk)) <= 18 for chunk in chunks)
+        assert [len(chunk) for chunk in chunks[:2]] == [3, 3]
+        assert sum(chunks, []) == oids
+
+        with pytest.raises(ValueError):
+            split_oid_list(["123456"], 10, 5)
+
+    def test_get_p2sa_product_large_list(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(conf, "PRODUCT_MAX_OIDS_PER_REQUEST", 1000)
+        monkeypatch.setattr(conf, "PRODUCT_MAX_URL_LENGTH", 10 ** 6)
+        file_oid_list = [str(oid) for oid in range(100000, 150000)]
+        chunks = split_oid_list(file_oid_list, 1000, 10 ** 6)
+        transport = DummyDataTransport({",".join(chunk): chunk[0].encode() for chunk in chunks})
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=transport)
+
+        manifest = p2sa.get_p2sa_product(file_oid_list=file_oid_list, workers=8,
+                                         filename=str(tmp_path / "products.tar"))
+
+        assert len(manifest) == len(transport.links) == 50
+        assert ",".join(result.oid for result in manifest) == ",".join(file_oid_list)
+        for index, result in enumerate(manifest):
+            assert result.error is None
+            assert result.path == str(tmp_path / ("products_%02d.tar" % index))
+            with open(result.path, 'rb') as fh:
+                assert fh.read() == result.oid.split(",")[0].encode()
+
+    def test_get_p2sa_product_url_length(self, tmp_path):
+        file_oid_list = [str(oid) for oid in range(100000, 105000)]
+        transport = DummyDataTransport({})
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=transport)
+
+        manifest = p2sa.get_p2sa_product(file_oid_list=file_oid_list, filename=str(tmp_path / "products.tar"))
+
+        assert len(transport.links) > 1
+        assert all(len(link) <= conf.PRODUCT_MAX_URL_LENGTH for link in transport.links)
+        assert ",".join(result.oid for result in manifest) == ",".join(file_oid_list)
+
+    def test_get_p2sa_product_filenames(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        transport = DummyDataTransport({"6605,6606": b"two files"})
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=transport)
+
+        manifest = p2sa.get_p2sa_product(file_oid_list=["6605", "6606"])
+        # Default names are short and only depend on the requested oids
+        assert manifest[0].path == "p2sa_product_" + hashlib.sha1(b"6605,6606").hexdigest()[:16] + ".tar"
+        assert manifest[0].path == p2sa.get_p2sa_product(file_oid_list=["6605", "6606"])[0].path
+        with open(manifest[0].path, 'rb') as fh:
+            assert fh.read() == b"two files"
+
+        # Failed archives are reported in the manifest
+        manifest = p2sa.get_p2sa_product(file_oid_list=["1"], filename="missing.tar")
+        assert manifest[0].path is None
+        assert isinstance(manifest[0].error, IOError)
+
+    def test_get_p2sa_product_interrupted(self, tmp_path):
+        transport = DroppingDataTransport({"6605,6606": b"x" * 65536}, 1000)
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=transport)
+        filename = str(tmp_path / "products.tar")
+
+        # The connection drops in the middle of the archive: no truncated file is left
+        manifest = p2sa.get_p2sa_product(file_oid_list=["6605", "6606"], filename=filename)
+        assert manifest[0].path is None
+        assert isinstance(manifest[0].error, IOError)
+        assert not os.path.exists(filename)
+
+    def test_extract_tar_stream(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        transport = DummyDataTransport({"197889204": make_tar({"swap/swap_lv1_001.fits": b"fits 1",
+                                                           "swap/swap_lv1_002.fits": b"fits 2",
+                                                           "swap/quicklook.png": b"png",
+                                                           "README": b"readme"})})
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=transport)
+
+        extracted = p2sa.get_p2sa_observation(obs_oid="197889204", extract_to=str(tmp_path / "out"),
+                                              members="*.fits")
+
+        assert sorted(extracted) == [str(tmp_path / "out" / "swap" / "swap_lv1_001.fits"),
+                                     str(tmp_path / "out" / "swap" / "swap_lv1_002.fits")]
+        with open(extracted[0], 'rb') as fh:
+            assert fh.read() in (b"fits 1", b"fits 2")
+        # Neither the archive nor the skipped members reach the disk
+        assert sorted(os.listdir(str(tmp_path / "out" / "swap"))) == ["swap_lv1_001.fits", "swap_lv1_002.fits"]
+        assert not os.path.exists("197889204.tar")
+
+        # Callable filters receive the TarInfo
+        extracted = p2sa.get_p2sa_observation(obs_oid="197889204", extract_to=str(tmp_path / "readme"),
+                                              members=lambda member: member.name == "README")
+        assert extracted == [str(tmp_path / "readme" / "README")]
+
+    def test_extract_tar_stream_unsafe_path(self, tmp_path):
+        with pytest.raises(ValueError):
+            extract_tar_stream(io.BytesIO(make_tar({"../escape.fits": b"data"})), str(tmp_path / "out"))
+        assert not os.path.exists(str(tmp_path / "escape.fits"))
+
+    def test_get_p2sa_observations_extract(self, tmp_path):
+        transport = DummyDataTransport({"1": make_tar({"a.fits": b"a", "b.png": b"bb"}),
+                                    "2": make_tar({"c.fits": b"ccc"})})
+        p2sa = ESAP2SAClass(DummyTapHandler(), transport=transport)
+
+        results = p2sa.get_p2sa_observations(["1", "2"], out_dir=str(tmp_path), extract=True, members=["*.fits"])
+
+        assert [(result.path, result.bytes) for result in results] == [(str(tmp_path / "1"), 1),
+                                                                        (str(tmp_path / "2"), 3)]
+        assert os.listdir(str(tmp_path / "1")) == ["a.fits"]
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import io
+import os
+
+import pytest
+from astropy.table import Table
+
+from esa_p2sa.p2sa_cache import QueryCache
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+QUERY = "SELECT TOP 8 * FROM p2sa.v_observation as obs ORDER BY obs.observation_oid"
+
+
+class TestInMemory:
+
+    @pytest.mark.parametrize("execution", ["sync", "async", "auto"])
+    def test_no_file_without_filename(self, execution, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        with DummyTapServer(make_observations(30)) as server:
+            p2sa = local_client(server)
+            observations = p2sa.query_p2sa_observations(instruments=['SWAP'], execution=execution)
+            typed = p2sa.query_p2sa_observations(instruments=['SWAP'], execution=execution, typed=True,
+                                                 output_format='csv')
+            result = p2sa.query_p2sa_tap(QUERY, execution=execution)
+        assert len(observations) == len(typed) > 0
+        assert len(result) == 8
+        assert os.listdir(str(tmp_path)) == []
+
+    @pytest.mark.parametrize("execution", ["sync", "async"])
+    def test_file_is_the_response(self, execution, tmp_path):
+        with DummyTapServer(make_observations(30)) as server:
+            p2sa = local_client(server)
+            filename = str(tmp_path / "observations.vot")
+            result = p2sa.query_p2sa_observations(instruments=['SWAP'], execution=execution, filename=filename)
+            assert list(Table.read(filename, format='votable')['observation_oid']) == \
+                list(result['observation_oid'])
+
+            filename = str(tmp_path / "observations.csv")
+            typed = p2sa.query_p2sa_observations(instruments=['SWAP'], execution=execution, typed=True,
+                                                 output_format='csv', filename=filename)
+            with open(filename, 'rb') as fh:
+                assert fh.read() == DummyTapServer.serialize(server.execute(server.queries[-1]), 'csv')
+            # __end_with
+            assert list(typed['observation_oid']) == list(result['observation_oid'])
+
+            filename = str(tmp_path / "query.csv")
+            table = p2sa.query_p2sa_tap(QUERY, output_file=filename, output_format='csv', dump_to_file=True,
+                                        execution=execution)
+            with open(filename, 'rb') as fh:
+                assert fh.read() == DummyTapServer.serialize(server.execute(QUERY), 'csv')
+            # __end_with
+            assert len(table) == 8
+
+    def test_cached_result_is_written(self, tmp_path):
+        with DummyTapServer(make_observations(20)) as server:
+            p2sa = local_client(server)
+            p2sa.query_cache = QueryCache(str(tmp_path / "cache"))
+            expected = p2sa.query_p2sa_observations(instruments=['LYRA'], execution="sync")
+            filename = str(tmp_path / "cached.vot")
+            result = p2sa.query_p2sa_observations(instruments=['LYRA'], execution="sync", filename=filename)
+            assert len(server.queries) == 1
+        assert list(Table.read(filename, format='votable')['observation_oid']) == \
+            list(expected['observation_oid']) == list(result['observation_oid'])
+
+    def test_get_table(self, tmp_path):
+        body = DummyTapServer.serialize(make_observations(5), 'csv')
+        with DummyTapServer(make_observations(1)) as server:
+            p2sa = local_client(server)
+            assert len(p2sa.get_table(None, io.BytesIO(body), output_format='csv')) == 5
+            filename = str(tmp_path / "table.csv")
+            assert len(p2sa.get_table(filename, io.BytesIO(body), output_format='csv')) == 5
+        # __end_with
+        with open(filename, 'rb') as fh:
+            assert fh.read() == body
+        # __end_with
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import gzip
+import io
+
+import numpy as np
+import pytest
+from astropy.table import vstack
+
+from esa_p2sa.p2sa_parser import iter_csv_batches, parse_observations
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+QUERY = "SELECT * FROM p2sa.v_observation as obs WHERE obs.observation_oid < 1050 ORDER BY obs.observation_oid"
+
+
+class TrackedResponse(io.BytesIO):
+    """
+    Response body recording the largest read
+    """
+
+    def __init__(self, body):
+        super(TrackedResponse, self).__init__(body)
+        self.largest_read = 0
+
+    def read(self, size=-1):
+        data = super(TrackedResponse, self).read(size)
+        self.largest_read = max(self.largest_read, len(data))
+        return data
+
+
+class TestIterBatches:
+
+    @pytest.mark.parametrize("chunk_size", [7, 100, 1000000])
+    def test_batches_while_reading(self, chunk_size):
+        body = DummyTapServer.serialize(make_observations(230), 'csv')
+        response = TrackedResponse(body)
+        positions = []
+        batches = []
+        for batch in iter_csv_batches(response, 50, chunk_size=chunk_size):
+            positions.append(response.tell())
+            batches.append(batch)
+        assert [len(batch) for batch in batches] == [50, 50, 50, 50, 30]
+        assert response.largest_read <= chunk_size
+        if chunk_size < len(body):
+            # The first batch comes before the end of the response
+            assert positions[0] < len(body) / 2
+        # __end_if
+        expected = parse_observations(body, 'csv')
+        result = vstack(batches)
+        for name in expected.colnames:
+            assert list(result[name]) == list(expected[name])
+
+    def test_quotes_gzip_and_empty_results(self):
+        body = b'observation_oid,file_name\n1,"a,\nb"\n2,"c ""d"""\n3,e'
+        batches = list(iter_csv_batches(io.BytesIO(gzip.compress(body)), 2, chunk_size=3))
+        assert [list(batch['observation_oid']) for batch in batches] == [[1, 2], [3]]
+        assert list(batches[0]['file_name']) == ['a,\nb', 'c "d"']
+        assert list(iter_csv_batches(io.BytesIO(b"observation_oid,file_name\n"), 2)) == []
+        with pytest.raises(ValueError):
+            next(iter_csv_batches(io.BytesIO(body), 0))
+
+    @pytest.mark.parametrize("execution", ["sync", "async", "auto"])
+    def test_iter_observations(self, execution):
+        with DummyTapServer(make_observations(120)) as server:
+            p2sa = local_client(server)
+            expected = p2sa.query_p2sa_observations(instruments=['SWAP', 'LYRA'], typed=True, top=1000,
+                                                    execution="sync")
+            batches = list(p2sa.iter_p2sa_observations(instruments=['SWAP', 'LYRA'], batch_size=25,
+                                                       execution=execution))
+            assert [len(batch) for batch in batches[:-1]] == [25] * (len(batches) - 1)
+            result = vstack(batches)
+            for name in expected.colnames:
+                assert list(result[name]) == list(expected[name])
+            assert all(job["deleted"] for job in server.jobs.values())
+
+            categorical = next(p2sa.iter_p2sa_observations(processing_level='LV1', columns=['instrument_name'],
+                                                           categorical=True, batch_size=5))
+            assert len(categorical) == 5
+            assert categorical['instrument_name'].dtype.kind == 'i'
+
+    @pytest.mark.parametrize("execution", ["sync", "async"])
+    def test_iter_observations_categorical(self, execution):
+        observations = make_observations(30)
+        observations['instrument_name'] = ['LYRA'] * 10 + ['SWAP'] * 10 + ['AAAA', 'SWAP'] * 5
+        with DummyTapServer(observations) as server:
+            p2sa = local_client(server)
+            batches = list(p2sa.iter_p2sa_observations(columns=['observation_oid', 'instrument_name'],
+                                                       categorical=True, batch_size=10, execution=execution))
+        # Every batch keeps the codes of the previous ones
+        assert [list(batch['instrument_name']) for batch in batches] == [[0] * 10, [1] * 10, [2, 1] * 5]
+        assert batches[-1]['instrument_name'].meta['categories'] == ['LYRA', 'SWAP', 'AAAA']
+        for batch, start in zip(batches, range(0, 30, 10)):
+            categories = np.array(batch['instrument_name'].meta['categories'])
+            assert list(categories[batch['instrument_name']]) == list(observations['instrument_name'][start:start + 10])
+
+    def test_iter_query(self):
+        with DummyTapServer(make_observations(120)) as server:
+            p2sa = local_client(server)
+            batches = list(p2sa.iter_query(QUERY, batch_size=20, execution="sync"))
+            assert [len(batch) for batch in batches] == [20, 20, 10]
+            assert list(vstack(batches)['observation_oid']) == list(range(1000, 1050))
+
+            # Closing the generator early deletes the job
+            iterator = p2sa.iter_query(QUERY, batch_size=20, execution="async")
+            assert len(next(iterator)) == 20
+            iterator.close()
+            assert all(job["deleted"] for job in server.jobs.values())
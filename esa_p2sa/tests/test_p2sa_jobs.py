@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import time
+
+import pytest
+
+from esa_p2sa import conf
+from esa_p2sa.p2sa_jobs import TapJobManager
+from esa_p2sa.p2sa_transport import P2SATransport
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+QUERY = "SELECT * FROM p2sa.v_observation as obs WHERE obs.observation_oid < %d"
+
+
+class TestTapJobManager:
+
+    def test_jobs_run_concurrently(self):
+        with DummyTapServer(make_observations(50)) as server:
+            server.job_duration = 0.6
+            p2sa = local_client(server)
+            queries = [QUERY % (1000 + count) for count in (5, 10, 15, 20, 25)]
+            start = time.time()
+            results = p2sa.query_p2sa_tap_jobs(queries)
+            elapsed = time.time() - start
+
+            assert [len(result.table) for result in results] == [5, 10, 15, 20, 25]
+            assert [result.query for result in results] == queries
+            assert all(result.error is None for result in results)
+            # Close to the slowest job, far from the sum of all of them
+            assert elapsed < 1.8
+            # WAIT requests are held until the jobs end
+            assert server.polls <= 2 * len(queries)
+            assert all(job["deleted"] for job in server.jobs.values())
+
+    def test_backoff_without_wait(self):
+        with DummyTapServer(make_observations(20)) as server:
+            server.job_duration = 0.5
+            server.support_wait = False
+            p2sa = local_client(server)
+            with conf.set_temp("TAP_JOB_POLL_INTERVAL", 0.02), conf.set_temp("TAP_JOB_MAX_POLL_INTERVAL", 0.16):
+                results = TapJobManager(p2sa, wait=10).run([QUERY % 1010, QUERY % 1005])
+            assert [len(result.table) for result in results] == [10, 5]
+            # Pauses of 0.02, 0.04, 0.08, 0.16, 0.16 ... seconds
+            assert server.polls <= 2 * 8
+
+    def test_failed_jobs_and_per_job_deletion(self):
+        with DummyTapServer(make_observations(20)) as server:
+            server.support_bulk_delete = False
+            p2sa = local_client(server)
+            results = TapJobManager(p2sa).run([QUERY % 1003, "SELECT * FROM p2sa.unknown"])
+            assert len(results[0].table) == 3
+            assert results[1].table is None
+            assert isinstance(results[1].error, IOError)
+            assert "ERROR" in str(results[1].error)
+            assert all(job["deleted"] for job in server.jobs.values())
+
+    def test_leaving_the_block_deletes_the_jobs(self):
+        with DummyTapServer(make_observations(20)) as server:
+            p2sa = local_client(server)
+            with TapJobManager(p2sa) as manager:
+                jobs = [manager.submit(QUERY % 1002), manager.submit(QUERY % 1004)]
+                assert len(manager.fetch(jobs[1])) == 4
+                assert manager.delete([jobs[0].jobid]) == 1
+                assert server.jobs[jobs[0].jobid]["deleted"]
+                assert not server.jobs[jobs[1].jobid]["deleted"]
+            assert server.jobs[jobs[1].jobid]["deleted"]
+
+    def test_timeout(self):
+        with DummyTapServer(make_observations(20)) as server:
+            server.job_duration = 5
+            p2sa = local_client(server)
+            with TapJobManager(p2sa, wait=0, timeout=0.2) as manager:
+                with conf.set_temp("TAP_JOB_POLL_INTERVAL", 0.05):
+                    results = manager.run([QUERY % 1001])
+            assert isinstance(results[0].error, IOError)
+            assert "did not end" in str(results[0].error)
+
+    def test_responses_are_closed(self, tmp_path):
+        def failing_parser(body, output_format):
+            raise ValueError("Unreadable result")
+
+        with DummyTapServer(make_observations(20)) as server:
+            # More failures than connections: a response left open would hold its connection
+            p2sa = local_client(server, P2SATransport(max_connections_per_host=1, pool_timeout=1))
+            with TapJobManager(p2sa, workers=1) as manager:
+                for count in range(3):
+                    with pytest.raises(ValueError):
+                        manager.fetch(manager.submit(QUERY % 1002), parser=failing_parser)
+                    # The output directory does not exist: the result is not read
+                    with pytest.raises(IOError):
+                        manager.fetch(manager.submit(QUERY % 1002), filename=str(tmp_path / "missing" / "result"))
+                results = manager.run(["SELECT * FROM p2sa.unknown"] * 3 + [QUERY % 1004])
+                assert all(isinstance(result.error, IOError) for result in results[:3])
+                assert len(results[3].table) == 4
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import pytest
+from astropy.table import MaskedColumn, Table
+
+from esa_p2sa.p2sa_mirror import ObservationMirror
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+
+def assert_same_rows(result, expected):
+    assert result.colnames == expected.colnames
+    assert len(result) == len(expected)
+    for name in expected.colnames:
+        assert result[name].dtype.kind == expected[name].dtype.kind
+        assert list(result[name]) == list(expected[name])
+
+
+class TestObservationMirror:
+
+    def test_sync_and_incremental_sync(self, tmp_path):
+        path = str(tmp_path / "observations.sqlite")
+        with DummyTapServer(make_observations(100)) as server:
+            p2sa = local_client(server)
+            mirror = p2sa.sync_observations(path, batch_rows=30)
+            assert len(mirror) == 100
+            assert mirror.watermark() == 1099
+            assert len(server.queries) == 4
+            assert all("ORDER BY obs.observation_oid ASC" in query for query in server.queries)
+
+            # Only the observations added since the last synchronization are fetched
+            server.observations = make_observations(120)
+            server.queries[:] = []
+            mirror = p2sa.sync_observations(path, batch_rows=30)
+            assert len(mirror) == 120
+            assert len(server.queries) == 1
+            assert "obs.observation_oid > 1099" in server.queries[0]
+
+            server.queries[:] = []
+            p2sa.sync_observations(path, batch_rows=30)
+            assert len(server.queries) == 1
+            assert len(ObservationMirror(path)) == 120
+
+    def test_full_sync(self, tmp_path):
+        path = str(tmp_path / "observations.sqlite")
+        with DummyTapServer(make_observations(60)) as server:
+            p2sa = local_client(server)
+            p2sa.sync_observations(path, batch_rows=30)
+            assert len(server.queries) == 3
+
+            server.observations = make_observations(40, start="2016-01-01")
+            assert len(p2sa.sync_observations(path, full=True)) == 40
+            assert ObservationMirror(path).query()["begin_date"][0].startswith("2016")
+
+    def test_query_like_the_tap(self, tmp_path):
+        path = str(tmp_path / "observations.sqlite")
+        with DummyTapServer(make_observations(300, duration_minutes=300)) as server:
+            p2sa = local_client(server)
+            p2sa.sync_observations(path)
+            mirror = ObservationMirror(path)
+            for arguments in (dict(instruments=['SWAP'], from_date='2015-08-02', to_date='2015-08-05'),
+                              dict(instruments=['SWAP', 'LYRA'], from_date='2015-08-03 10:00:00'),
+                              dict(to_date='2015-08-02'),
+                              dict(instruments=['SWAP'], from_date='2016-08-02', to_date='2016-08-05')):
+                expected = p2sa.query_p2sa_observations(**arguments)
+                sent = len(server.queries)
+                assert_same_rows(mirror.query(**arguments), expected)
+                assert_same_rows(p2sa.query_p2sa_observations(mirror=path, **arguments), expected)
+                assert_same_rows(p2sa.query_p2sa_observations(mirror=mirror, **arguments), expected)
+                assert len(server.queries) == sent
+
+    def test_empty_archive(self, tmp_path):
+        path = str(tmp_path / "observations.sqlite")
+        with DummyTapServer(make_observations(0)) as server:
+            mirror = local_client(server).sync_observations(path)
+            assert mirror.exists()
+            assert mirror.watermark() is None
+            result = mirror.query(instruments=['SWAP'])
+            assert len(result) == 0
+            assert result.colnames[0] == "observation_oid"
+
+    def test_null_values(self, tmp_path):
+        table = make_observations(3)
+        table["file_size"] = MaskedColumn(table["file_size"], mask=[False, True, False])
+        table["file_name"] = MaskedColumn(table["file_name"], mask=[True, False, False])
+        mirror = ObservationMirror(str(tmp_path / "observations.sqlite"))
+        mirror.insert(table)
+        result = mirror.query()
+        assert list(result["file_size"].mask) == [False, True, False]
+        assert list(result["file_name"].mask) == [True, False, False]
+        assert result["file_size"][2] == table["file_size"][2]
+        assert result["file_size"].dtype == table["file_size"].dtype
+
+    def test_not_synchronized(self, tmp_path):
+        mirror = ObservationMirror(str(tmp_path / "missing.sqlite"))
+        assert not mirror.exists()
+        assert len(mirror) == 0
+        with pytest.raises(IOError):
+            mirror.query()
+        with pytest.raises(ValueError):
+            ObservationMirror("")
+        with pytest.raises(ValueError):
+            mirror.insert(Table({'observation_oid': [1]}))
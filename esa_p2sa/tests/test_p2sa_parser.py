@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import numpy as np
+import pytest
+
+from esa_p2sa import conf
+from esa_p2sa.p2sa_parser import parse_observations
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+
+def check_typed(result, expected):
+    assert result.colnames == expected.colnames
+    assert result['observation_oid'].dtype == np.int64
+    assert result['begin_date'].dtype == np.dtype('datetime64[ms]')
+    assert list(result['begin_date']) == list(np.array(expected['begin_date'], dtype='datetime64[ms]'))
+    assert list(result['calibrated']) == list(expected['calibrated'] == 'true')
+    for name in ('observation_oid', 'instrument_name', 'file_name', 'file_size'):
+        assert list(result[name]) == list(expected[name])
+
+
+class TestParser:
+
+    @pytest.mark.parametrize("output_format", ['csv', 'json'])
+    def test_parse_response(self, output_format):
+        observations = make_observations(50)
+        body = DummyTapServer.serialize(observations, output_format)
+        check_typed(parse_observations(body, output_format), observations)
+
+        result = parse_observations(body, output_format, categorical=True)
+        assert result['instrument_name'].dtype == np.int32
+        categories = np.array(result['instrument_name'].meta['categories'])
+        assert list(categories[result['instrument_name']]) == list(observations['instrument_name'])
+
+    def test_vectorized_csv(self):
+        body = (b'observation_oid,begin_date,end_date,calibrated,instrument_name,file_size\n'
+                b'1,2015-08-01 10:00:00.5,2016-02-29,true,SWAP,\n'
+                b',,,,,7\n'
+                b'3,2015-08-01T23:59:59.123456,2015-12-31,f,LYRA,8\n\n')
+        # Bytes without quotes are decoded by the vectorized reader, text by the general one
+        fast = parse_observations(body, 'csv')
+        general = parse_observations(body.decode('ascii'), 'csv')
+        for name in fast.colnames:
+            assert fast[name].dtype == general[name].dtype
+            assert fast[name].tolist() == general[name].tolist()
+        assert fast['begin_date'][2] == np.datetime64('2015-08-01T23:59:59.123')
+        assert fast['end_date'][0] == np.datetime64('2016-02-29')
+        assert list(fast['file_size'].mask) == [True, False, False]
+
+        # Values in other layouts are read one by one
+        result = parse_observations(b'file_size,end_date\n-5,2015-08-01 10:30\n')
+        assert list(result['file_size']) == [-5]
+        assert result['end_date'][0] == np.datetime64('2015-08-01T10:30')
+
+    def test_utc_designator(self, recwarn):
+        body = (b'begin_date,end_date\n'
+                b'2015-08-01T10:00:00Z,2015-08-01T10:00:00.250Z\n'
+                b'2015-08-02T23:59:59Z,\n')
+        result = parse_observations(body, 'csv')
+        assert list(result['begin_date']) == [np.datetime64('2015-08-01T10:00:00'),
+                                              np.datetime64('2015-08-02T23:59:59')]
+        assert result['end_date'][0] == np.datetime64('2015-08-01T10:00:00.250')
+        assert list(result['end_date'].mask) == [False, True]
+        for general in (parse_observations(body.decode('ascii'), 'csv'),
+                        parse_observations('{"metadata": [{"name": "begin_date"}, {"name": "end_date"}], "data": '
+                                           '[["2015-08-01T10:00:00Z", "2015-08-01T10:00:00.250Z"], '
+                                           '["2015-08-02T23:59:59Z", null]]}', 'json')):
+            assert general['begin_date'].tolist() == result['begin_date'].tolist()
+            assert general['end_date'].tolist() == result['end_date'].tolist()
+        assert len(recwarn) == 0
+
+    def test_quotes_and_missing_values(self):
+        body = (b'observation_oid,file_name,begin_date,calibrated,file_size\r\n'
+                b'1,"a,b.fits",2015-08-01 10:00:00.5,true,10\r\n'
+                b'2,"say ""hi""",,,\r\n')
+        result = parse_observations(body, 'csv')
+        assert list(result['file_name']) == ['a,b.fits', 'say "hi"']
+        assert result['begin_date'][0] == np.datetime64('2015-08-01T10:00:00.500')
+        assert list(result['begin_date'].mask) == [False, True]
+        assert list(result['calibrated'].mask) == [False, True]
+        assert list(result['file_size'].mask) == [False, True]
+        assert result['file_size'].dtype == np.int64
+
+        result = parse_observations('{"metadata": [{"name": "observation_oid"}, {"name": "end_date"}],'
+                                    ' "data": [[1, null], [null, "2015-08-01 00:00:00"]]}', 'json')
+        assert list(result['observation_oid'].mask) == [False, True]
+        assert list(result['end_date'].mask) == [True, False]
+
+        with pytest.raises(ValueError):
+            parse_observations(b'a,b\n1\n', 'csv')
+        with pytest.raises(ValueError):
+            parse_observations(b'', 'votable')
+
+    def test_typed_queries(self, tmp_path):
+        observations = make_observations(100)
+        with DummyTapServer(observations) as server:
+            p2sa = local_client(server)
+            check_typed(p2sa.query_p2sa_observations(typed=True), observations)
+
+            filename = str(tmp_path / "observations.json")
+            with conf.set_temp("SYNC_MAX_ROWS", 10):
+                result = p2sa.query_p2sa_observations(typed=True, output_format='json', filename=filename)
+            check_typed(result, observations)
+            assert len(server.jobs) == 1
+            with open(filename, 'rb') as fh:
+                assert fh.read() == DummyTapServer.serialize(observations, 'json')
+
+            assert p2sa.query_p2sa_observations(typed=True, output_format='votable') is None
+            assert p2sa.query_p2sa_observations(typed=True, incremental=True) is None
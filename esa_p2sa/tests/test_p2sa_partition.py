@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from esa_p2sa.p2sa_core import ESAP2SAClass
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+
+class TestPartitionedObservations:
+
+    def test_same_result_as_single_query(self):
+        with DummyTapServer(make_observations(500)) as server:
+            p2sa = local_client(server)
+            arguments = dict(instruments=['SWAP', 'LYRA'], from_date='2015-08-02 12:30:00',
+                             to_date='2015-08-20 00:00:00')
+            expected = p2sa.query_p2sa_observations(**arguments)
+            server.queries[:] = []
+            result = p2sa.query_p2sa_observations(partitioned=True, target_rows=50, workers=4, **arguments)
+
+            assert result.colnames == expected.colnames
+            assert len(result) == len(expected) > 0
+            for name in expected.colnames:
+                assert list(result[name]) == list(expected[name])
+            # Observations still running at from_date are kept, once
+            assert result["begin_date"][0] < arguments["from_date"]
+            assert len(set(result["observation_oid"])) == len(result)
+
+            assert "COUNT(*)" in server.queries[0]
+            assert len(server.queries) - 1 == int(np.ceil(len(expected) / 50.0))
+
+    def test_windows_above_the_sync_row_limit(self):
+        # Synchronous jobs without TOP return 2000 rows at most
+        with DummyTapServer(make_observations(6000, step_minutes=5, duration_minutes=4)) as server:
+            p2sa = local_client(server)
+            result = p2sa.query_p2sa_observations(from_date='2015-08-01', to_date='2015-09-01', partitioned=True,
+                                                  target_rows=3000)
+            assert len(result) == 6000
+            assert list(result['observation_oid']) == list(range(1000, 7000))
+            assert all(query.startswith("SELECT TOP ") for query in server.queries[1:])
+
+    def test_window_count_is_bounded(self):
+        with DummyTapServer(make_observations(100)) as server:
+            p2sa = local_client(server)
+            result = p2sa.query_p2sa_observations(instruments=['SWAP'], from_date='2015-08-01',
+                                                  to_date='2015-08-10', partitioned=True, target_rows=1000)
+            assert len(result) == 50
+            assert len(server.queries) == 2
+
+    def test_empty_range(self):
+        with DummyTapServer(make_observations(10)) as server:
+            p2sa = local_client(server)
+            result = p2sa.query_p2sa_observations(from_date='2016-01-01', to_date='2016-02-01',
+                                                  partitioned=True, target_rows=1)
+            assert isinstance(result, Table)
+            assert len(result) == 0
+
+    def test_partition_bounds(self):
+        bounds = ESAP2SAClass._partition_bounds('2015-08-01', '2015-08-01 00:00:02', 8)
+        assert bounds == ['2015-08-01 00:00:00', '2015-08-01 00:00:01', '2015-08-01 00:00:02']
+        assert len(ESAP2SAClass._partition_bounds('2015-08-01', '2015-08-02', 4)) == 5
+        with pytest.raises(ValueError):
+            ESAP2SAClass._partition_bounds('2015-08-02', '2015-08-01', 4)
+
+    def test_dates_are_mandatory(self):
+        with pytest.raises(ValueError):
+            ESAP2SAClass()._query_observations_partitioned(['SWAP'], None, '2015-08-02')
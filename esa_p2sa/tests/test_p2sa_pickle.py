@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from esa_p2sa.p2sa_cache import ProductCache, QueryCache
+from esa_p2sa.p2sa_core import ESAP2SA, ESAP2SAClass
+from esa_p2sa.p2sa_transport import P2SATransport, TransportTapConn
+from esa_p2sa.tests.dummy_http_server import DummyHTTPServer
+
+
+def local_client(server, cache_dir):
+    transport = P2SATransport(max_connections_per_host=3, read_timeout=5)
+    p2sa = ESAP2SAClass(TransportTapConn(transport, server.url, server_context="p2sa-sl-tap",
+                                         tap_context="tap", data_context="data"),
+                        product_cache=ProductCache(cache_dir, max_bytes=10000),
+                        transport=transport,
+                        query_cache=QueryCache(cache_dir + "-queries", ttl=600))
+    p2sa.data_url = server.url + "p2sa-sl-tap/data?"
+    return p2sa
+
+
+def download_postcard(p2sa, oid, out_dir):
+    filename = os.path.join(out_dir, "postcard_%d.jpg" % oid)
+    p2sa.get_p2sa_postcard(observation_oid=str(oid), filename=filename)
+    with open(filename, 'rb') as fh:
+        return os.getpid(), fh.read()
+
+
+class TestPickle:
+
+    def test_round_trip(self, tmp_path):
+        with DummyHTTPServer() as server:
+            p2sa = local_client(server, str(tmp_path / "cache"))
+            server.set_payload(p2sa._build_postcard_link("1"), b"jpg 1")
+            # Connections opened before pickling are not part of the state
+            download_postcard(p2sa, 1, str(tmp_path))
+
+            data = pickle.dumps(p2sa)
+            assert len(data) < 4096
+            restored = pickle.loads(data)
+
+            assert type(restored) is ESAP2SAClass
+            assert restored.data_url == p2sa.data_url
+            assert restored.p2sa_url == p2sa.p2sa_url
+            assert restored.transport.max_connections_per_host == 3
+            assert restored.transport.read_timeout == 5
+            assert restored.transport._pool_manager is None
+            assert restored._Tap__connHandler.transport is restored.transport
+            assert restored.product_cache.directory == p2sa.product_cache.directory
+            assert restored.product_cache.max_bytes == 10000
+            assert restored.query_cache.directory == p2sa.query_cache.directory
+            assert restored.query_cache.ttl == 600
+
+            server.set_payload(restored._build_postcard_link("2"), b"jpg 2")
+            assert download_postcard(restored, 2, str(tmp_path))[1] == b"jpg 2"
+
+    def test_default_client(self):
+        restored = pickle.loads(pickle.dumps(ESAP2SA))
+        assert restored.data_url == ESAP2SA.data_url
+        assert restored.metadata_url == ESAP2SA.metadata_url
+        assert isinstance(restored._Tap__connHandler, TransportTapConn)
+
+    def test_process_pool(self, tmp_path):
+        with DummyHTTPServer() as server:
+            p2sa = local_client(server, str(tmp_path / "cache"))
+            for oid in range(16):
+                server.set_payload(p2sa._build_postcard_link(str(oid)), b"jpg %d" % oid)
+
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=4, mp_context=context) as executor:
+                results = list(executor.map(download_postcard, [p2sa] * 16, range(16), [str(tmp_path)] * 16))
+
+            assert [content for pid, content in results] == [b"jpg %d" % oid for oid in range(16)]
+            assert os.getpid() not in set(pid for pid, content in results)
+            assert len(server.requests) == 16
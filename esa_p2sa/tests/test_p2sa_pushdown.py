@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import os
+
+import pytest
+
+from esa_p2sa.p2sa_core import ESAP2SAClass
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+FILTERS = dict(processing_level='LV1', file_format=['TAR'], calibrated=True, min_file_size=500,
+               max_file_size=3000)
+
+
+def filter_locally(table):
+    mask = (table['processing_level'] == 'LV1') & (table['file_format'] == 'TAR') & \
+           (table['calibrated'] == 'true') & (table['file_size'] >= 500) & (table['file_size'] <= 3000)
+    return table[mask]
+
+
+class TestPushdown:
+
+    def test_build_query(self):
+        query = ESAP2SAClass._build_observations_query(
+            ['SWAP'], '2015-08-01', None, ESAP2SAClass._build_filter_conditions(FILTERS),
+            columns=['observation_oid', 'file_size'], order_by=['file_size DESC'], top=10, offset=20)
+        assert query.startswith("SELECT TOP 10 obs.observation_oid, obs.file_size FROM")
+        assert "(obs.processing_level = 'LV1')" in query
+        assert "(obs.file_format IN ('TAR'))" in query
+        assert "(obs.calibrated = 'true')" in query
+        assert "(obs.file_size >= 500) AND (obs.file_size <= 3000)" in query
+        assert query.endswith(" ORDER BY obs.file_size DESC, obs.observation_oid ASC OFFSET 20")
+
+        unsorted = ESAP2SAClass._build_observations_query(None, None, None, order_by=None)
+        assert "ORDER BY" not in unsorted
+        # Quotes in the values are escaped
+        assert ESAP2SAClass._build_filter_conditions({'observation_type': "A'B"}) == \
+            ["(obs.observation_type = 'A''B')"]
+
+    def test_invalid_arguments(self):
+        with pytest.raises(ValueError):
+            ESAP2SAClass._check_columns(['observation_oid; DROP TABLE'])
+        with pytest.raises(ValueError):
+            ESAP2SAClass._build_order_clause('begin_date SIDEWAYS')
+        with pytest.raises(ValueError):
+            ESAP2SAClass._build_filter_conditions({'colour': 'red'})
+
+    def test_filters_and_columns(self):
+        observations = make_observations(400)
+        with DummyTapServer(observations) as server:
+            p2sa = local_client(server)
+            result = p2sa.query_p2sa_observations(instruments=['SWAP', 'LYRA'],
+                                                  columns=['observation_oid', 'begin_date', 'file_size'],
+                                                  **FILTERS)
+            expected = filter_locally(observations)
+            assert result.colnames == ['observation_oid', 'begin_date', 'file_size']
+            assert list(result['observation_oid']) == list(expected['observation_oid'])
+            assert len(result) > 0
+
+            # The projected and filtered response is an order of magnitude smaller
+            full = DummyTapServer.serialize(observations, 'votable')
+            reduced = DummyTapServer.serialize(server.execute(server.queries[-1]), 'votable')
+            assert len(full) > 10 * len(reduced)
+
+    def test_paging(self):
+        with DummyTapServer(make_observations(95)) as server:
+            p2sa = local_client(server)
+            expected = p2sa.query_p2sa_observations(top=1000, order_by='file_size DESC')
+            pages = [p2sa.query_p2sa_observations(top=20, offset=offset, order_by='file_size DESC')
+                     for offset in range(0, 100, 20)]
+            assert [len(page) for page in pages] == [20, 20, 20, 20, 15]
+            assert [oid for page in pages for oid in page['observation_oid']] == list(expected['observation_oid'])
+            assert list(expected['file_size']) == sorted(list(expected['file_size']), reverse=True)
+
+    def test_partitioned_and_incremental(self):
+        with DummyTapServer(make_observations(300)) as server:
+            p2sa = local_client(server)
+            arguments = dict(from_date='2015-08-02', to_date='2015-08-12', columns=['observation_oid'], **FILTERS)
+            expected = p2sa.query_p2sa_observations(**arguments)
+            server.queries[:] = []
+            partitioned = p2sa.query_p2sa_observations(partitioned=True, target_rows=10, **arguments)
+            incremental = p2sa.query_p2sa_observations(incremental=True, target_rows=7, **arguments)
+            assert len(expected) > 7
+            for result in (partitioned, incremental):
+                assert result.colnames == ['observation_oid']
+                assert list(result['observation_oid']) == list(expected['observation_oid'])
+            # Every window has an explicit TOP, gaps are read in pages
+            assert all(query.startswith("SELECT TOP ") or "COUNT(*)" in query for query in server.queries)
+            assert any(" OFFSET 7" in query for query in server.queries)
+
+            # The range cache keeps filtered observations apart
+            other = p2sa.query_p2sa_observations(incremental=True, from_date='2015-08-02', to_date='2015-08-12',
+                                                 processing_level='LV2')
+            assert set(other['processing_level']) == {'LV2'}
+
+            assert p2sa.query_p2sa_observations(incremental=True, top=5, **arguments) is None
+
+    def test_mirror(self, tmpdir):
+        observations = make_observations(200)
+        path = os.path.join(str(tmpdir), "mirror.sqlite")
+        with DummyTapServer(observations) as server:
+            p2sa = local_client(server)
+            p2sa.sync_observations(path)
+            arguments = dict(columns=['observation_oid', 'file_size'], order_by='file_size DESC', top=5, offset=3,
+                             **FILTERS)
+            expected = p2sa.query_p2sa_observations(**arguments)
+            result = p2sa.query_p2sa_observations(mirror=path, **arguments)
+        assert result.colnames == ['observation_oid', 'file_size']
+        assert list(result['observation_oid']) == list(expected['observation_oid'])
+        assert len(result) == 5
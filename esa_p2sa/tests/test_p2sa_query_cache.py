@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import os
+import pickle
+import time
+
+import pytest
+from astropy.table import MaskedColumn, Table
+
+from esa_p2sa.p2sa_cache import QueryCache
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+QUERY = "SELECT * FROM p2sa.v_observation as obs WHERE obs.observation_oid < 1005"
+
+
+def data_queries(server):
+    # Without the COUNT(*) queries of 'auto' execution
+    return [query for query in server.queries if "COUNT(*)" not in query]
+
+
+def cached_client(server, cache):
+    p2sa = local_client(server)
+    p2sa.query_cache = cache
+    return p2sa
+
+
+def assert_same_table(result, expected):
+    assert result.colnames == expected.colnames
+    assert result.dtype == expected.dtype
+    for name in expected.colnames:
+        assert type(result[name]) is type(expected[name])
+        assert list(result[name]) == list(expected[name])
+
+
+class TestQueryCache:
+
+    def test_memory_and_disk_hits(self, tmp_path):
+        with DummyTapServer(make_observations(20)) as server:
+            p2sa = cached_client(server, QueryCache(str(tmp_path), max_entries=4))
+            expected = p2sa.query_p2sa_tap(QUERY)
+            result = p2sa.query_p2sa_tap("  SELECT *\n FROM p2sa.v_observation as obs "
+                                         "WHERE obs.observation_oid < 1005;")
+            assert_same_table(result, expected)
+            assert len(data_queries(server)) == 1
+            # The result and its COUNT(*) query
+            assert p2sa.query_cache.stats()['memory_hits'] == 2
+
+            # A new session reads the on-disk tier
+            p2sa = cached_client(server, QueryCache(str(tmp_path)))
+            assert_same_table(p2sa.query_p2sa_tap(QUERY), expected)
+            assert_same_table(p2sa.query_p2sa_tap(QUERY), expected)
+            assert len(data_queries(server)) == 1
+            assert p2sa.query_cache.disk_hits == 2
+            assert p2sa.query_cache.memory_hits == 2
+
+    def test_output_format_is_part_of_the_key(self, tmp_path):
+        with DummyTapServer(make_observations(20)) as server:
+            p2sa = cached_client(server, QueryCache(str(tmp_path)))
+            votable = p2sa.query_p2sa_tap(QUERY, output_format='votable')
+            csv = p2sa.query_p2sa_tap(QUERY, output_format='csv')
+            assert len(data_queries(server)) == 2
+            assert_same_table(p2sa.query_p2sa_tap(QUERY, output_format='csv'), csv)
+            assert_same_table(p2sa.query_p2sa_tap(QUERY, output_format='votable'), votable)
+            assert len(data_queries(server)) == 2
+            # Both formats and the COUNT(*) query they share
+            assert p2sa.query_cache.misses == 3
+
+    def test_bypass_and_refresh(self, tmp_path):
+        with DummyTapServer(make_observations(20)) as server:
+            p2sa = cached_client(server, QueryCache(str(tmp_path)))
+            p2sa.query_p2sa_tap(QUERY)
+            p2sa.query_p2sa_tap(QUERY, use_cache=False)
+            assert len(data_queries(server)) == 2
+
+            server.observations = make_observations(20, start="2016-01-01")
+            assert p2sa.query_p2sa_tap(QUERY)["begin_date"][0].startswith("2015")
+            assert p2sa.query_p2sa_tap(QUERY, refresh_cache=True)["begin_date"][0].startswith("2016")
+            assert p2sa.query_p2sa_tap(QUERY)["begin_date"][0].startswith("2016")
+            assert len(data_queries(server)) == 3
+
+    def test_observations_use_the_cache(self, tmp_path):
+        with DummyTapServer(make_observations(50)) as server:
+            p2sa = cached_client(server, QueryCache(str(tmp_path)))
+            arguments = dict(instruments=['SWAP'], from_date='2015-08-01', to_date='2015-08-02')
+            expected = p2sa.query_p2sa_observations(**arguments)
+            assert_same_table(p2sa.query_p2sa_observations(**arguments), expected)
+            assert len(data_queries(server)) == 1
+            p2sa.query_p2sa_observations(use_cache=False, **arguments)
+            assert len(data_queries(server)) == 2
+
+    def test_row_limit_is_part_of_the_key(self, tmp_path):
+        query = "SELECT * FROM p2sa.v_observation as obs"
+        with DummyTapServer(make_observations(2500)) as server:
+            p2sa = cached_client(server, QueryCache(str(tmp_path)))
+            # Synchronous jobs are capped at 2000 rows, as launch_job
+            assert len(p2sa.query_p2sa_tap(query, execution='sync')) == 2000
+            assert len(p2sa.query_p2sa_tap(query, execution='async')) == 2500
+            assert len(p2sa.query_p2sa_tap(query)) == 2500
+            assert len(p2sa.query_p2sa_tap(query, execution='sync')) == 2000
+            assert len(data_queries(server)) == 2
+            assert len(p2sa.execute_query(query)) == 2000
+            assert len(p2sa.execute_query(query, execution='auto')) == 2500
+            assert len(data_queries(server)) == 2
+
+    def test_expired_entries(self, tmp_path):
+        cache = QueryCache(str(tmp_path), ttl=60)
+        cache.put(QUERY, 'csv', Table({'a': [1, 2]}))
+        assert cache.get(QUERY, 'csv') is not None
+
+        # Entries of both tiers older than the ttl are misses and are removed
+        old = time.time() - 120
+        cache._memory[cache.key(QUERY, 'csv')] = (old, Table({'a': [1, 2]}))
+        os.utime(cache.path(cache.key(QUERY, 'csv')), (old, old))
+        assert cache.get(QUERY, 'csv') is None
+        assert not os.path.exists(cache.path(cache.key(QUERY, 'csv')))
+
+        cache.put(QUERY, 'csv', Table({'a': [1, 2]}))
+        os.utime(cache.path(cache.key(QUERY, 'csv')), (old, old))
+        cache.prune()
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_memory_tier_is_bounded(self, tmp_path):
+        cache = QueryCache(str(tmp_path), max_entries=2)
+        for index in range(3):
+            cache.put("SELECT %d" % index, 'csv', Table({'a': [index]}))
+        assert cache.stats()['memory_entries'] == 2
+        assert cache.get("SELECT 0", 'csv')['a'][0] == 0
+        assert cache.stats()['disk_hits'] == 1
+        assert cache.stats()['memory_hits'] == 0
+
+    def test_masks_and_units_survive_the_disk_tier(self, tmp_path):
+        table = Table([MaskedColumn([1, 2, 3], mask=[False, True, False], unit='s'),
+                       MaskedColumn(['a', 'b', 'c']),
+                       [1.5, 2.5, 3.5]], names=('duration', 'name', 'size'))
+        QueryCache(str(tmp_path)).put(QUERY, 'votable', table)
+        result = QueryCache(str(tmp_path)).get(QUERY, 'votable')
+        assert_same_table(result, table)
+        assert list(result['duration'].mask) == [False, True, False]
+        assert result['duration'].unit == 's'
+        assert result.meta == {}
+
+    def test_returned_tables_are_copies(self, tmp_path):
+        cache = QueryCache(str(tmp_path))
+        table = Table({'a': [1, 2]})
+        cache.put(QUERY, 'csv', table)
+        table['a'][0] = 10
+        cache.get(QUERY, 'csv')['a'][1] = 20
+        assert list(cache.get(QUERY, 'csv')['a']) == [1, 2]
+
+    def test_corrupted_entry_is_a_miss(self, tmp_path):
+        cache = QueryCache(str(tmp_path), max_entries=0)
+        with open(cache.path(cache.key(QUERY, 'csv')), 'wb') as fh:
+            fh.write(b"not a table")
+        assert cache.get(QUERY, 'csv') is None
+        assert cache.misses == 1
+
+    def test_normalize(self):
+        assert QueryCache.normalize(" SELECT  *\n\tFROM t WHERE a = 'x  y';  ") == "SELECT * FROM t WHERE a = 'x  y'"
+        assert QueryCache.key("SELECT 1", 'CSV') == QueryCache.key("SELECT   1", 'csv')
+        assert QueryCache.key("SELECT 'a'", 'csv') != QueryCache.key("SELECT 'A'", 'csv')
+
+    def test_pickle(self, tmp_path):
+        cache = QueryCache(str(tmp_path), max_entries=3, ttl=10)
+        cache.put(QUERY, 'csv', Table({'a': [1]}))
+        copy = pickle.loads(pickle.dumps(cache))
+        assert (copy.directory, copy.max_entries, copy.ttl) == (cache.directory, 3, 10)
+        assert copy.get(QUERY, 'csv')['a'][0] == 1
+        assert copy.disk_hits == 1
+
+    def test_invalid_parameters(self, tmp_path):
+        with pytest.raises(ValueError):
+            QueryCache(str(tmp_path), max_entries=-1)
+        with pytest.raises(ValueError):
+            QueryCache(str(tmp_path), ttl=0)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+from esa_p2sa import conf
+from esa_p2sa.p2sa_cache import QueryCache
+from esa_p2sa.p2sa_core import ESAP2SAClass, QueryPlan
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+QUERY = "SELECT * FROM p2sa.v_observation as obs WHERE obs.instrument_name = 'SWAP'"
+
+
+class TestQueryPlan:
+
+    def test_dry_run(self):
+        with DummyTapServer(make_observations(300)) as server:
+            p2sa = local_client(server)
+            plan = p2sa.query_p2sa_observations(instruments=['SWAP'], from_date='2015-08-02',
+                                                to_date='2015-08-05', dry_run=True)
+            assert isinstance(plan, QueryPlan)
+            assert plan.execution == 'sync'
+            assert plan.row_count == len(p2sa.query_p2sa_observations(instruments=['SWAP'],
+                                                                      from_date='2015-08-02',
+                                                                      to_date='2015-08-05', execution='sync'))
+            assert "COUNT(*)" in plan.count_query and "ORDER BY" not in plan.count_query
+            assert server.queries[0].endswith(plan.count_query.replace("SELECT COUNT", "COUNT"))
+            assert len(server.queries) == 2
+
+            plan = p2sa.query_p2sa_observations(top=10, offset=295, dry_run=True)
+            assert plan.row_count == 5
+
+            plan = p2sa.query_p2sa_tap(QUERY, dry_run=True)
+            assert plan.row_count == 150
+            assert plan.count_query == ESAP2SAClass._build_count_query(QUERY)
+
+    def test_large_results_run_asynchronously(self):
+        with DummyTapServer(make_observations(2500)) as server:
+            p2sa = local_client(server)
+            assert p2sa.query_p2sa_tap(QUERY, dry_run=True).execution == 'sync'
+            assert len(p2sa.query_p2sa_observations(execution='sync')) == 2000
+            server.queries[:] = []
+
+            # Synchronous queries are truncated to 2000 rows, asynchronous jobs are not
+            result = p2sa.query_p2sa_observations()
+            assert len(result) == 2500
+            assert len(server.jobs) == 1
+            assert "COUNT(*)" in server.queries[0]
+
+            with conf.set_temp("SYNC_MAX_ROWS", 100):
+                result = p2sa.query_p2sa_tap(QUERY, output_format='csv')
+            assert len(result) == 1250
+            assert len(server.jobs) == 2
+
+    def test_very_large_results_are_partitioned(self):
+        with DummyTapServer(make_observations(400)) as server:
+            p2sa = local_client(server)
+            arguments = dict(from_date='2015-08-01', to_date='2015-08-20', target_rows=100)
+            expected = p2sa.query_p2sa_observations(execution='sync', **arguments)
+            server.queries[:] = []
+            with conf.set_temp("SYNC_MAX_ROWS", 10), conf.set_temp("ASYNC_MAX_ROWS", 50):
+                assert p2sa.query_p2sa_observations(dry_run=True, **arguments).execution == 'partitioned'
+                result = p2sa.query_p2sa_observations(**arguments)
+                # Without both dates, the query cannot be partitioned
+                assert p2sa.query_p2sa_observations(from_date='2015-08-01', dry_run=True).execution == 'async'
+            assert list(result['observation_oid']) == list(expected['observation_oid'])
+            assert len(server.jobs) == 0
+            assert sum(query.startswith("SELECT TOP ") for query in server.queries) == 4
+
+    def test_small_or_cached_results_skip_the_count(self, tmp_path):
+        with DummyTapServer(make_observations(50)) as server:
+            p2sa = local_client(server)
+            p2sa.query_p2sa_tap("SELECT TOP 10 * FROM p2sa.v_observation")
+            p2sa.query_p2sa_observations(top=5)
+            assert not any("COUNT(*)" in query for query in server.queries)
+
+            p2sa.query_cache = QueryCache(str(tmp_path))
+            server.queries[:] = []
+            expected = p2sa.query_p2sa_tap(QUERY)
+            assert len(server.queries) == 2
+            assert len(p2sa.query_p2sa_tap(QUERY)) == len(expected)
+            assert len(server.queries) == 2
+
+    def test_count_failure_falls_back_to_sync(self):
+        with DummyTapServer(make_observations(20)) as server:
+            p2sa = local_client(server)
+            # The dummy server does not know this count query
+            p2sa._build_count_query = lambda query: "SELECT COUNT(*) FROM unknown"
+            result = p2sa.query_p2sa_tap(QUERY)
+            assert len(result) == 10
+            assert len(server.jobs) == 0
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import numpy as np
+import pytest
+
+from esa_p2sa.p2sa_cache import ObservationRangeCache
+from esa_p2sa.p2sa_core import OBSERVATION_COLUMNS
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+
+def assert_fresh(p2sa, server, **arguments):
+    """
+    Checks that an incremental query returns what a fresh query returns.
+    Returns the number of queries sent by the incremental query
+    """
+    sent = len(server.queries)
+    result = p2sa.query_p2sa_observations(incremental=True, **arguments)
+    incremental_queries = len(server.queries) - sent
+    expected = p2sa.query_p2sa_observations(**arguments)
+    assert result.colnames == expected.colnames
+    assert len(result) == len(expected)
+    for name in expected.colnames:
+        assert result[name].dtype.kind == expected[name].dtype.kind
+        assert list(result[name]) == list(expected[name])
+    return incremental_queries
+
+
+class TestObservationRangeCache:
+
+    def test_sliding_window_fetches_only_the_gap(self):
+        with DummyTapServer(make_observations(500, duration_minutes=600)) as server:
+            p2sa = local_client(server)
+            instruments = ['SWAP', 'LYRA']
+            assert assert_fresh(p2sa, server, instruments=instruments, from_date='2015-08-01',
+                                to_date='2015-08-10') == 1
+            server.queries[:] = []
+            assert assert_fresh(p2sa, server, instruments=instruments, from_date='2015-08-04',
+                                to_date='2015-08-12') == 1
+            assert "(obs.end_date >= '2015-08-10 00:00:00')" in server.queries[0]
+            assert "(obs.begin_date < '2015-08-12 00:00:00')" in server.queries[0]
+
+            # Covered ranges, with the instruments in any order, are served from memory
+            assert assert_fresh(p2sa, server, instruments=['LYRA', 'SWAP'], from_date='2015-08-02 10:30:00',
+                                to_date='2015-08-11') == 0
+            assert p2sa.range_cache.fetched_gaps == 2
+            # Observations overlapping both ranges are stored once
+            stored = p2sa.range_cache.select(p2sa.range_cache.key(instruments, OBSERVATION_COLUMNS),
+                                             ObservationRangeCache.START, ObservationRangeCache.END)
+            assert len(stored) == p2sa.range_cache.rows() == len(np.unique(stored["observation_oid"]))
+
+    def test_gaps_between_covered_ranges(self):
+        with DummyTapServer(make_observations(300)) as server:
+            p2sa = local_client(server)
+            assert_fresh(p2sa, server, instruments=['SWAP'], from_date='2015-08-03', to_date='2015-08-04')
+            assert_fresh(p2sa, server, instruments=['SWAP'], from_date='2015-08-06', to_date='2015-08-07')
+            assert assert_fresh(p2sa, server, instruments=['SWAP'], from_date='2015-08-02',
+                                to_date='2015-08-08') == 3
+            assert assert_fresh(p2sa, server, instruments=['SWAP'], from_date='2015-08-02',
+                                to_date='2015-08-08') == 0
+
+    def test_observations_at_the_boundaries(self):
+        # Instantaneous observations starting and ending on the edge of a fetched range
+        with DummyTapServer(make_observations(24, duration_minutes=0)) as server:
+            p2sa = local_client(server)
+            assert_fresh(p2sa, server, from_date='2015-08-01 05:00:00', to_date='2015-08-01 10:00:00')
+            assert_fresh(p2sa, server, from_date='2015-08-01 00:00:00', to_date='2015-08-01 05:00:00')
+            assert assert_fresh(p2sa, server, from_date='2015-08-01 02:00:00',
+                                to_date='2015-08-01 08:00:00') == 0
+
+    def test_open_ranges(self):
+        with DummyTapServer(make_observations(100)) as server:
+            p2sa = local_client(server)
+            assert_fresh(p2sa, server, instruments=['LYRA'], from_date='2015-08-03')
+            assert assert_fresh(p2sa, server, instruments=['LYRA'], to_date='2015-08-04') == 1
+            assert assert_fresh(p2sa, server, instruments=['LYRA']) == 0
+            # Another instrument set has its own coverage
+            assert assert_fresh(p2sa, server, instruments=['SWAP'], from_date='2015-08-03') == 1
+
+    def test_partitioned_gaps(self):
+        with DummyTapServer(make_observations(400)) as server:
+            p2sa = local_client(server)
+            arguments = dict(instruments=['SWAP', 'LYRA'], partitioned=True, target_rows=40)
+            assert assert_fresh(p2sa, server, from_date='2015-08-02', to_date='2015-08-08', **arguments) > 2
+            sent = len(server.queries)
+            assert_fresh(p2sa, server, from_date='2015-08-05', to_date='2015-08-12', **arguments)
+            assert "COUNT(*)" in server.queries[sent]
+            assert "(obs.end_date >= '2015-08-08 00:00:00')" in server.queries[sent]
+
+    def test_gaps_above_the_sync_row_limit(self):
+        # Synchronous jobs without TOP return 2000 rows at most
+        with DummyTapServer(make_observations(6000, step_minutes=5, duration_minutes=4)) as server:
+            p2sa = local_client(server)
+            for target_rows in (None, 2500):
+                p2sa.range_cache = None
+                arguments = dict(from_date='2015-08-01', to_date='2015-09-01', incremental=True)
+                if target_rows is not None:
+                    arguments['target_rows'] = target_rows
+                # __end_if
+                result = p2sa.query_p2sa_observations(**arguments)
+                assert list(result['observation_oid']) == list(range(1000, 7000))
+                # The cache holds every observation of the range
+                sent = len(server.queries)
+                assert len(p2sa.query_p2sa_observations(**arguments)) == 6000
+                assert len(server.queries) == sent
+            # __end_for
+            assert sum(" OFFSET " in query for query in server.queries) == 1 + 3
+
+    def test_missing(self):
+        cache = ObservationRangeCache()
+        key = cache.key(['SWAP'], ('observation_oid',))
+        day = [np.datetime64('2015-08-%02d' % index, 'ms') for index in range(1, 10)]
+        assert cache.missing(key, day[1], day[5]) == [(day[1], day[5])]
+        cache._entries[key] = ([(day[2], day[3]), (day[4], day[6])], None)
+        assert cache.missing(key, day[1], day[8]) == [(day[1], day[2]), (day[3], day[4]), (day[6], day[8])]
+        assert cache.missing(key, day[4], day[5]) == []
+        assert cache._merge([(day[4], day[6]), (day[1], day[2]), (day[2], day[3])]) == \
+            [(day[1], day[3]), (day[4], day[6])]
+
+    def test_dates(self):
+        assert ObservationRangeCache.to_text(ObservationRangeCache.to_datetime('2015-08-01')) == \
+            '2015-08-01 00:00:00'
+        assert ObservationRangeCache.to_text(ObservationRangeCache.to_datetime('2015-08-01 10:00:00.250Z')) == \
+            '2015-08-01 10:00:00.250'
+        assert ObservationRangeCache.to_text(ObservationRangeCache.to_datetime('', start=True)) == ''
+        assert ObservationRangeCache.to_datetime(None, start=False) == ObservationRangeCache.END
+
+    def test_least_recently_used_sets_are_evicted(self):
+        with DummyTapServer(make_observations(100)) as server:
+            p2sa = local_client(server)
+            p2sa.range_cache = ObservationRangeCache(max_rows=60)
+            for instruments in (['SWAP'], ['LYRA'], ['SWAP', 'LYRA']):
+                p2sa.query_p2sa_observations(instruments=instruments, incremental=True)
+            assert len(p2sa.range_cache._entries) == 1
+            assert p2sa.range_cache.rows() == 100
+
+    def test_invalid_range(self):
+        p2sa = local_client(DummyTapServer(make_observations(1)))
+        with pytest.raises(ValueError):
+            p2sa._query_observations_incremental(['SWAP'], '2015-08-02', '2015-08-01')
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import json
+import os
+import pickle
+import time
+
+import pytest
+
+from esa_p2sa.p2sa_cache import SchemaCatalog
+from esa_p2sa.tests.dummy_http_server import DummyHTTPServer
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+
+def data_path(filename):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', filename)
+
+
+def schema_server(server):
+    with open(data_path('test_tables.xml'), 'rb') as fh:
+        tables = fh.read()
+    server.set_payload(server.url + "p2sa-sl-tap/tap/tables", tables)
+    server.set_payload(server.url + "p2sa-sl-tap/tap/tables?only_tables=true", tables)
+
+
+def schema_client(server, catalog):
+    p2sa = local_client(server)
+    p2sa.schema_catalog = catalog
+    p2sa.p2sa_url = server.url
+    return p2sa
+
+
+class TestSchemaCatalog:
+
+    def test_loaded_once(self):
+        with DummyHTTPServer() as server:
+            schema_server(server)
+            p2sa = schema_client(server, SchemaCatalog(""))
+            assert p2sa.get_p2sa_columns("table") == ["table1_col1", "table1_col2"]
+            assert p2sa.get_p2sa_columns("table2")[0] == "table2_col1"
+            assert p2sa.get_p2sa_columns("table", only_names=False)[0].description == "Table1 Column1 desc"
+            # The full catalog answers the table names as well
+            assert p2sa.get_p2sa_tables() == ["table", "table2"]
+            assert len(server.requests) == 1
+
+            start = time.time()
+            for attempt in range(1000):
+                p2sa.get_p2sa_columns("table2")
+            assert (time.time() - start) / 1000 < 0.001
+
+            with pytest.raises(ValueError):
+                p2sa.get_p2sa_columns("missing")
+            assert len(server.requests) == 1
+
+            p2sa.get_p2sa_columns("table", refresh=True)
+            assert len(server.requests) == 2
+
+    def test_table_names_only(self):
+        with DummyHTTPServer() as server:
+            schema_server(server)
+            p2sa = schema_client(server, SchemaCatalog(""))
+            assert p2sa.get_p2sa_tables() == ["table", "table2"]
+            assert p2sa.get_p2sa_tables() == ["table", "table2"]
+            assert [request[1] for request in server.requests] == ["/p2sa-sl-tap/tap/tables?only_tables=true"]
+            # Columns need the full catalog
+            p2sa.get_p2sa_columns("table")
+            assert server.requests[-1][1] == "/p2sa-sl-tap/tap/tables"
+
+    def test_persisted(self, tmp_path):
+        with DummyHTTPServer() as server:
+            schema_server(server)
+            p2sa = schema_client(server, SchemaCatalog(str(tmp_path), ttl=60))
+            expected = p2sa.get_p2sa_columns("table", only_names=False)
+
+            # A new session reads the catalog from disk
+            p2sa = schema_client(server, SchemaCatalog(str(tmp_path), ttl=60))
+            columns = p2sa.get_p2sa_columns("table", only_names=False)
+            assert [vars(column) for column in columns] == [vars(column) for column in expected]
+            assert p2sa.get_p2sa_tables(only_names=False)[0].description == "Table1 desc"
+            assert len(server.requests) == 1
+
+            # Expired catalogs are reloaded
+            path = p2sa.schema_catalog.path(p2sa._get_tap_url())
+            with open(path) as fh:
+                content = json.load(fh)
+            content["loaded_at"] = time.time() - 120
+            with open(path, 'w') as fh:
+                json.dump(content, fh)
+            p2sa = schema_client(server, SchemaCatalog(str(tmp_path), ttl=60))
+            p2sa.get_p2sa_columns("table")
+            assert len(server.requests) == 2
+
+            # Catalogs of another version are ignored
+            content["version"] = 0
+            content["loaded_at"] = time.time()
+            with open(path, 'w') as fh:
+                json.dump(content, fh)
+            p2sa = schema_client(server, SchemaCatalog(str(tmp_path), ttl=60))
+            p2sa.get_p2sa_columns("table")
+            assert len(server.requests) == 3
+
+    def test_lookup(self):
+        tables = []
+        for name in ("p2sa.v_observation", "p2sa.file", "other.file"):
+            table = type("Table", (object,), {})()
+            table.name = name
+            tables.append(table)
+        catalog = SchemaCatalog("")
+        load = lambda only_names: tables
+        assert catalog.table("url", "p2sa.v_observation", load) is tables[0]
+        assert catalog.table("url", "P2SA.V_OBSERVATION", load) is tables[0]
+        assert catalog.table("url", "v_observation", load) is tables[0]
+        # Ambiguous names are not resolved
+        assert catalog.table("url", "file", load) is None
+        assert catalog.loads == 1
+
+    def test_pickle(self, tmp_path):
+        catalog = pickle.loads(pickle.dumps(SchemaCatalog(str(tmp_path), ttl=10)))
+        assert catalog.directory == str(tmp_path)
+        assert catalog.ttl == 10
+        with pytest.raises(ValueError):
+            SchemaCatalog("", ttl=0)
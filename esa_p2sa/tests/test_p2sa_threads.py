@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import io
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from astropy.io.votable import from_table
+from astropy.table import Table
+
+from esa_p2sa import conf
+from esa_p2sa.p2sa_core import ESAP2SAClass
+from esa_p2sa.p2sa_transport import P2SATransport, TransportTapConn
+from esa_p2sa.tests.dummy_http_server import DummyHTTPServer
+
+
+def votable(instrument):
+    table = Table(rows=[(int(instrument[3:]), instrument)], names=("observation_oid", "instrument_name"))
+    output = io.BytesIO()
+    from_table(table).to_xml(output)
+    return output.getvalue()
+
+
+def answer_query(method, path, body):
+    """Answers every ADQL query with a row holding the instrument it asked for"""
+    if method != "POST":
+        return None
+    query = parse_qs(body.decode("utf-8"))["QUERY"][0]
+    return votable(re.search(r"instrument_name='(\w+)'", query).group(1))
+
+
+class TestThreadSafety:
+
+    def test_concurrent_queries_and_postcards(self, tmp_path):
+        with DummyHTTPServer() as server:
+            server.responder = answer_query
+            transport = P2SATransport(max_connections_per_host=8)
+            p2sa = ESAP2SAClass(TransportTapConn(transport, server.url, server_context="p2sa-sl-tap",
+                                                 tap_context="tap", data_context="data"),
+                                transport=transport)
+            p2sa.data_url = server.url + "p2sa-sl-tap/data?"
+            for oid in range(200):
+                server.set_payload(p2sa._build_postcard_link(str(oid)), b"jpg %d" % oid)
+
+            def query(index):
+                table = p2sa.query_p2sa_observations(instruments=["INS%d" % index], from_date="2020-01-01")
+                return list(table["instrument_name"]) == ["INS%d" % index] and \
+                    list(table["observation_oid"]) == [index]
+
+            def postcard(index):
+                filename = str(tmp_path / ("postcard_%d.jpg" % index))
+                p2sa.get_p2sa_postcard(observation_oid=str(index), filename=filename)
+                with open(filename, 'rb') as fh:
+                    return fh.read() == b"jpg %d" % index
+
+            # One request per query, without the COUNT(*) queries of 'auto' execution
+            with conf.set_temp("QUERY_EXECUTION", "sync"), ThreadPoolExecutor(max_workers=32) as executor:
+                queries = [executor.submit(query, index) for index in range(200)]
+                postcards = [executor.submit(postcard, index) for index in range(200)]
+                assert all(future.result() for future in queries)
+                assert all(future.result() for future in postcards)
+
+            assert len(server.requests) == 400
+            assert server.connections <= 8
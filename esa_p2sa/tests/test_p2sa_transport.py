@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from astropy.utils.exceptions import AstropyDeprecationWarning
+
+from esa_p2sa.p2sa_core import ESAP2SAClass
+from esa_p2sa.p2sa_download import download_resumable, open_url
+from esa_p2sa.p2sa_transport import P2SATransport, TransportTapConn
+from esa_p2sa.tests.dummy_http_server import DummyHTTPServer
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+
+
+def local_client(server, transport=None):
+    if transport is None:
+        transport = P2SATransport()
+    handler = TransportTapConn(transport, server.url, server_context="p2sa-sl-tap",
+                               tap_context="tap", data_context="data")
+    p2sa = ESAP2SAClass(handler, transport=transport)
+    p2sa.data_url = server.url + "p2sa-sl-tap/data?"
+    p2sa.metadata_url = server.url + "p2sa-sl-tap/tap/sync?"
+    return p2sa
+
+
+class TestP2SATransport:
+
+    def test_postcards_reuse_one_connection(self, tmp_path):
+        with DummyHTTPServer() as server:
+            p2sa = local_client(server)
+            for oid in range(50):
+                server.set_payload(p2sa.data_url + "RETRIEVAL_TYPE=PRODUCT&observation_oid=%d"
+                                   "&resolution=low&PRODUCT_TYPE=POSTCARD&data_retrieval_origin=P2SAPY" % oid,
+                                   b"jpg %d" % oid)
+
+            for oid in range(50):
+                filename = str(tmp_path / ("postcard_%d.jpg" % oid))
+                p2sa.get_p2sa_postcard(observation_oid=str(oid), filename=filename)
+                with open(filename, 'rb') as fh:
+                    assert fh.read() == b"jpg %d" % oid
+
+            assert len(server.requests) == 50
+            assert server.connections == 1
+
+    def test_tap_queries_use_transport(self):
+        with DummyHTTPServer() as server:
+            p2sa = local_client(server)
+            server.set_payload(server.url + "p2sa-sl-tap/tap/sync", b"observation_oid,instrument\n1,SWAP\n")
+
+            for attempt in range(10):
+                table = p2sa.query_p2sa_tap("SELECT TOP 1 * FROM p2sa.v_observation", output_format='csv')
+                assert list(table["instrument"]) == ["SWAP"]
+
+            assert [request[0] for request in server.requests] == ["POST"] * 10
+            assert server.connections == 1
+
+    def test_tap_conn_public_methods(self):
+        # Only the public execute_* methods of TapConn are overridden
+        assert not [name for name in vars(TransportTapConn) if name.startswith("_TapConn__")]
+        with DummyHTTPServer() as server:
+            server.set_payload(server.url + "p2sa-sl-tap/tap/tables", b"tables")
+            server.set_payload(server.url + "p2sa-sl-tap/data?retrieval_type=PRODUCT", b"data")
+            server.set_payload(server.url + "p2sa-sl-tap/tap/sync", b"sync")
+            connection = TransportTapConn(P2SATransport(), server.url, server_context="p2sa-sl-tap",
+                                          tap_context="tap", data_context="data")
+            connection.set_cookie("JSESSIONID=1")
+
+            assert connection.execute_tapget("tables").read() == b"tables"
+            assert connection.execute_dataget("retrieval_type=PRODUCT").read() == b"data"
+            assert connection.execute_tappost("sync", "QUERY=1").read() == b"sync"
+            assert connection.get_response_status() == 200
+            with pytest.raises(ValueError):
+                connection.execute_upload("data")
+
+            assert [request[:2] for request in server.requests] == [
+                ("GET", "/p2sa-sl-tap/tap/tables"), ("GET", "/p2sa-sl-tap/data?retrieval_type=PRODUCT"),
+                ("POST", "/p2sa-sl-tap/tap/sync")]
+            assert all(request[2]["Cookie"] == "JSESSIONID=1" for request in server.requests)
+            assert server.requests[2][2]["Content-type"] == "application/x-www-form-urlencoded"
+            assert server.connections == 1
+
+    def test_open_url(self):
+        with DummyHTTPServer() as server:
+            server.set_payload(server.url + "file", b"content")
+            transport = P2SATransport()
+            for attempt in range(3):
+                assert open_url(server.url + "file", transport=transport).read() == b"content"
+            assert server.connections == 1
+            with pytest.raises(IOError):
+                open_url(server.url + "missing", transport=transport)
+            assert open_url(server.url + "file").read() == b"content"
+
+    def test_connections_per_host_limit(self):
+        with DummyHTTPServer() as server:
+            server.delay = 0.05
+            server.set_payload(server.url + "file", b"content")
+            transport = P2SATransport(max_connections_per_host=2)
+
+            def fetch(index):
+                return transport.get(server.url + "file").read()
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(fetch, range(16)))
+
+            assert results == [b"content"] * 16
+            assert server.connections <= 2
+
+    def test_failed_downloads_release_connections(self, tmp_path):
+        with DummyHTTPServer() as server:
+            p2sa = local_client(server, P2SATransport(max_connections_per_host=2, pool_timeout=5))
+            link = p2sa.data_url + "RETRIEVAL_TYPE=PRODUCT&observation_oid=1&resolution=low" \
+                                   "&PRODUCT_TYPE=POSTCARD&data_retrieval_origin=P2SAPY"
+            server.set_payload(link, b"jpg 1")
+
+            # The output directory does not exist: every download fails after its request
+            for attempt in range(5):
+                assert p2sa.get_p2sa_postcard(observation_oid="1",
+                                              filename=str(tmp_path / "missing" / "postcard.jpg")) is None
+            for attempt in range(3):
+                with pytest.raises(IOError):
+                    download_resumable(link, str(tmp_path / "missing" / "postcard.jpg"), opener=p2sa._open_url)
+            assert len(server.requests) == 8
+
+            start = time.time()
+            filename = str(tmp_path / "postcard.jpg")
+            assert p2sa.get_p2sa_postcard(observation_oid="1", filename=filename) == link
+            assert time.time() - start < 5
+            with open(filename, 'rb') as fh:
+                assert fh.read() == b"jpg 1"
+
+    def test_submitted_jobs_release_connections(self):
+        with DummyTapServer(make_observations(20)) as server:
+            p2sa = local_client(server, P2SATransport(max_connections_per_host=1, pool_timeout=1))
+            # astroquery only reads the Location header of the 303 of each job
+            jobs = [p2sa.launch_job_async("SELECT * FROM p2sa.v_observation", background=True) for count in range(3)]
+            assert len(set(job.jobid for job in jobs)) == 3
+
+    def test_pool_timeout(self):
+        with DummyHTTPServer() as server:
+            server.set_payload(server.url + "file", b"content")
+            transport = P2SATransport(max_connections_per_host=1, pool_timeout=0.2)
+            held = transport.get(server.url + "file")
+            with pytest.raises(IOError):
+                transport.get(server.url + "file")
+            held.close()
+            assert transport.get(server.url + "file").read() == b"content"
+
+    def test_timeouts(self):
+        with DummyHTTPServer() as server:
+            server.delay = 0.5
+            server.set_payload(server.url + "file", b"content")
+            assert P2SATransport(read_timeout=2).get(server.url + "file").read() == b"content"
+            with pytest.raises(IOError):
+                P2SATransport(read_timeout=0.1).get(server.url + "file")
+
+    def test_deprecated_timeout(self):
+        p2sa = ESAP2SAClass(transport=P2SATransport(read_timeout=30))
+        with pytest.warns(AstropyDeprecationWarning):
+            assert p2sa.TIMEOUT == 30
+        with pytest.warns(AstropyDeprecationWarning):
+            p2sa.TIMEOUT = 5
+        assert p2sa.transport.read_timeout == 5
+
+    def test_error_status(self):
+        with DummyHTTPServer() as server:
+            p2sa = local_client(server)
+            with pytest.raises(IOError):
+                p2sa._execute_get(p2sa.data_url + "observation_oid=1")
+            assert p2sa.execute_download_query(p2sa.data_url + "observation_oid=1") is None
+
+    def test_invalid_parameters(self):
+        with pytest.raises(ValueError):
+            P2SATransport(max_connections_per_host=0)
+        with pytest.raises(ValueError):
+            P2SATransport(max_hosts=0)
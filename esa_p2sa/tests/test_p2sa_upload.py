@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Maria H. Sarmiento
+@contact: mhsarmiento@sciops.esa.int
+European Space Astronomy Centre (ESAC)
+European Space Agency (ESA)
+"""
+import pytest
+
+from esa_p2sa import conf
+from esa_p2sa.p2sa_core import ESAP2SAClass
+from esa_p2sa.tests.dummy_tap_server import DummyTapServer, make_observations
+from esa_p2sa.tests.test_p2sa_transport import local_client
+
+
+class TestUploadJoin:
+
+    def test_build_query(self):
+        query = ESAP2SAClass._build_upload_join_query('p2sa.file', 'file_oid', ['file_name', 'file_path'], 10)
+        assert query == ("SELECT TOP 10 obs.file_name, obs.file_path FROM p2sa.file AS obs "
+                         "JOIN tap_upload.oids AS up ON up.file_oid = obs.file_oid ORDER BY obs.file_oid")
+        assert ESAP2SAClass._build_upload_join_query('p2sa.v_observation', 'observation_oid').startswith(
+            "SELECT obs.* FROM p2sa.v_observation AS obs")
+
+    def test_one_request_for_many_oids(self):
+        with DummyTapServer(make_observations(3000)) as server:
+            p2sa = local_client(server)
+            oids = list(range(3999, 999, -2)) + [1001, 999999]
+            result = p2sa.query_p2sa_oids(oids, columns=['observation_oid', 'file_size'])
+            assert result.colnames == ['observation_oid', 'file_size']
+            # 1500 matching oids: more than the 2000 rows of synchronous jobs would not be
+            assert list(result['observation_oid']) == list(range(1001, 4000, 2))
+            assert len(server.requests) == 1
+            assert "JOIN tap_upload.oids AS up" in server.queries[0]
+
+    def test_asynchronous_join(self):
+        with DummyTapServer(make_observations(100)) as server:
+            p2sa = local_client(server)
+            with conf.set_temp("SYNC_MAX_ROWS", 10):
+                result = p2sa.query_p2sa_oids(range(1000, 1050), table='v_observation', output_format='csv')
+            assert list(result['observation_oid']) == list(range(1000, 1050))
+            assert len(server.jobs) == 1
+            assert all(job["deleted"] for job in server.jobs.values())
+
+    def test_invalid_arguments(self):
+        with pytest.raises(ValueError):
+            ESAP2SAClass().query_p2sa_oids([1, 2], table='p2sa.instrument')
+        with pytest.raises(ValueError):
+            ESAP2SAClass().query_p2sa_oids([])
+        with pytest.raises(ValueError):
+            ESAP2SAClass().query_p2sa_oids([1], key='oid; DROP TABLE')
@@ -134,7 +134,8 @@ setup(name='esa_p2sa',
       license='ESDC',
       packages=packages,
       zip_safe=False,
-      install_requires=['astroquery', 'astropy', 'pytest', 'IPython', 'requests', 'six', 'python-dateutil'],
+      install_requires=['astroquery', 'astropy', 'pytest', 'IPython', 'requests', 'urllib3', 'six', 'python-dateutil'],
+      extras_require={'async': ['aiohttp']},
       cmdclass={
           'install': PostInstallCommand,
       })